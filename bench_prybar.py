@@ -0,0 +1,432 @@
+"""
+Benchmarks for prybar.
+
+Run all the benchmarks with ``python bench_prybar.py``, or specific ones by
+name, e.g. ``python bench_prybar.py import_time``. Pass ``--json`` to write
+the results to stdout as JSON instead of a table, e.g. to compare them with
+the results of a previous release.
+"""
+import argparse
+import contextlib
+import json
+import platform
+import subprocess
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    import pkg_resources
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+# The results reported by the benchmark that's running, and whether to print
+# them as they're reported (rather than as JSON once all have run).
+_results: List[Dict[str, Any]] = []
+_print_results = True
+_current_benchmark: Optional[str] = None
+
+
+def benchmark(func: Callable[[], None]) -> Callable[[], None]:
+    """Register a ``bench_*`` function to be run by :func:`main`."""
+    assert func.__name__.startswith('bench_')
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def report(name: str, seconds: float, **details):
+    _results.append({'benchmark': _current_benchmark, 'name': name,
+                     'seconds': seconds, **details})
+    if _print_results:
+        extra = ''.join(f' {k}={v}' for k, v in details.items())
+        print(f'{name:<48} {seconds * 1e6:12.2f} us{extra}')
+
+
+def _per_call(func: Callable[[], object]) -> float:
+    """Time func, calling it enough times to take at least 0.2 seconds."""
+    number, seconds = timeit.Timer(func).autorange()
+    return seconds / number
+
+
+def _time_import_in_subprocess(statement: str, repeat: int,
+                               setup: str = 'pass') -> float:
+    """Get the best of ``repeat`` timings of executing an import statement
+    (after ``setup``) in a fresh interpreter.
+    """
+    code = (f'{setup}; import time; t = time.perf_counter(); '
+            f'{statement}; print(time.perf_counter() - t)')
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', code]))
+        for _ in range(repeat))
+
+
+@benchmark
+def bench_import_time(repeat: int = 10):
+    """The cost of ``import prybar`` in a fresh interpreter.
+
+    ``import prybar, pkg_resources`` is the cost prybar's import used to
+    have before pkg_resources was imported lazily.
+    """
+    report('import prybar',
+           _time_import_in_subprocess('import prybar', repeat))
+    report('import prybar, pkg_resources',
+           _time_import_in_subprocess('import prybar, pkg_resources', repeat))
+
+
+@benchmark
+def bench_first_match_lookup(number: int = 1000):
+    """``next(iter_entry_points(group, name))`` for a dynamic entry point,
+    with prybar's distributions last (the default) and first.
+    """
+    import pkg_resources
+    import prybar
+
+    def lookup():
+        next(pkg_resources.iter_entry_points('bench.group', 'bench'))
+
+    dists = len(pkg_resources.working_set.entries)
+    for position in (None, 0):
+        with prybar.dynamic_entrypoint('bench.group', name='bench',
+                                       module='os', position=position):
+            seconds = timeit.timeit(lookup, number=number) / number
+        report(f'first match lookup, position={position}', seconds,
+               entries=dists)
+
+
+@benchmark
+def bench_scope_enter_exit(number: int = 1000):
+    """Entering and exiting a new scope while many other scopes are live.
+
+    The cost should stay flat as the number of live scopes grows.
+    """
+    import pkg_resources
+    import prybar
+
+    working_set = pkg_resources.WorkingSet([])
+    entrypoint = prybar.dynamic_entrypoint(
+        'bench.group', name='bench', module='os', scope='bench.scope',
+        working_set=working_set)
+
+    def enter_exit():
+        with entrypoint:
+            pass
+
+    for live in (1, 10, 100, 1000, 10000):
+        live_scopes = [
+            prybar.dynamic_entrypoint(
+                'bench.group', name='bench', module='os',
+                scope=f'bench.live.{i}', working_set=working_set)
+            for i in range(live)]
+        for live_scope in live_scopes:
+            live_scope.start()
+        try:
+            seconds = timeit.timeit(enter_exit, number=number) / number
+        finally:
+            for live_scope in live_scopes:
+                live_scope.stop()
+        report('scope enter/exit', seconds, live_scopes=live)
+
+
+@benchmark
+def bench_group_discovery(number: int = 1000):
+    """Repeatedly discovering a group's entry points with
+    ``pkg_resources.iter_entry_points()`` and with prybar's cache.
+    """
+    import pkg_resources
+    import prybar
+
+    with prybar.dynamic_entrypoint('bench.group', name='bench', module='os'):
+        for name, func in [('pkg_resources.iter_entry_points',
+                            pkg_resources.iter_entry_points),
+                           ('prybar.iter_entry_points',
+                            prybar.iter_entry_points)]:
+            seconds = timeit.timeit(lambda: list(func('bench.group')),
+                                    number=number) / number
+            report(f'group discovery, {name}', seconds,
+                   dists=len(pkg_resources.working_set.by_key))
+
+
+@benchmark
+def bench_load(number: int = 1000):
+    """Repeatedly loading a dynamic entry point, with and without ``require``,
+    compared with a plain ``pkg_resources.EntryPoint`` which doesn't memoise.
+    """
+    import pkg_resources
+    import prybar
+
+    cases = [
+        ('plain EntryPoint', pkg_resources.EntryPoint.parse(
+            'bench = os.path:join'), True),
+        ('memoised, require=True', 'bench = os.path:join', True),
+        ('memoised, require=False', 'bench = os.path:join', False),
+    ]
+    for name, entrypoint, require in cases:
+        registration = prybar.dynamic_entrypoint(
+            'bench.group', entrypoint, require=require)
+        with registration:
+            seconds = timeit.timeit(registration.entrypoint.load,
+                                    number=number) / number
+        report(f'load, {name}', seconds)
+
+
+@benchmark
+def bench_parse(number: int = 10000):
+    """Creating an entry point from a spec string, uncached (as
+    ``pkg_resources.EntryPoint.parse()`` does) and from prybar's cache of
+    parsed specs.
+    """
+    import pkg_resources
+    import prybar
+
+    spec = 'bench = os.path:join [extra]'
+    for name, parse in [
+            ('EntryPoint.parse()', pkg_resources.EntryPoint.parse),
+            ('prybar, cached', lambda spec: prybar._create_entrypoint(
+                'bench.group', spec))]:
+        seconds = timeit.timeit(lambda: parse(spec), number=number) / number
+        report(f'parse, {name}', seconds)
+
+
+@benchmark
+def bench_isolated_working_set(number: int = 100):
+    """Creating a working set to register entry points in privately, by
+    scanning ``sys.path`` and with :func:`prybar.isolated_working_set`.
+    """
+    import pkg_resources
+    import prybar
+
+    for name, create in [('WorkingSet()', pkg_resources.WorkingSet),
+                         ('isolated_working_set()',
+                          prybar.isolated_working_set)]:
+        seconds = timeit.timeit(create, number=number) / number
+        report(f'create {name}', seconds,
+               dists=len(pkg_resources.working_set.by_key))
+
+
+@benchmark
+def bench_manifest(size: int = 10000):
+    """Registering and de-registering the entry points of a large
+    entry_points.txt manifest, compared with a dynamic_entrypoint() each.
+    """
+    import io
+    import prybar
+
+    lines = [f'ep{i} = os.path:join' for i in range(size)]
+    manifest = '[bench.group]\n' + '\n'.join(lines) + '\n'
+
+    def from_manifest():
+        with prybar.from_manifest(io.StringIO(manifest)):
+            pass
+
+    def individually():
+        with contextlib.ExitStack() as stack:
+            for line in lines:
+                stack.enter_context(
+                    prybar.dynamic_entrypoint('bench.group', line))
+
+    for name, func in [('from_manifest()', from_manifest),
+                       ('dynamic_entrypoint() each', individually)]:
+        report(f'manifest, {name}', timeit.timeit(func, number=1),
+               entrypoints=size)
+
+
+@benchmark
+def bench_index(repeat: int = 10):
+    """Discovering a group's entry points for the first time in a fresh
+    interpreter, by importing pkg_resources (which reads every installed
+    distribution's metadata) and by loading an index written by
+    :func:`prybar.export_index`. Imports are included in the timings.
+    """
+    import os
+    import tempfile
+    import pkg_resources
+    import prybar
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = os.path.join(tmp, 'index.json')
+        prybar.export_index(index)
+        report('discovery, pkg_resources', _time_import_in_subprocess(
+            'import pkg_resources; '
+            'list(pkg_resources.iter_entry_points("console_scripts"))',
+            repeat))
+        report('discovery, prybar.load_index()', _time_import_in_subprocess(
+            f'import prybar; list(prybar.load_index({index!r})'
+            f'.iter_entry_points("console_scripts"))', repeat),
+               dists=len(pkg_resources.working_set.by_key))
+
+
+@benchmark
+def bench_construction():
+    """Creating a ``dynamic_entrypoint()`` (without registering it) from each
+    form of entry point spec.
+    """
+    import os
+    import pkg_resources
+    import prybar
+
+    entrypoint = pkg_resources.EntryPoint.parse('bench = os.path:join')
+    specs = [
+        ('callable', lambda: prybar.dynamic_entrypoint(
+            'bench.group', os.path.join)),
+        ('string', lambda: prybar.dynamic_entrypoint(
+            'bench.group', 'bench = os.path:join')),
+        ('EntryPoint', lambda: prybar.dynamic_entrypoint(
+            'bench.group', entrypoint)),
+        ('name/module', lambda: prybar.dynamic_entrypoint(
+            'bench.group', name='join', module='os.path')),
+    ]
+    for name, create in specs:
+        report(f'dynamic_entrypoint(), {name}', _per_call(create))
+
+
+@benchmark
+def bench_enter_exit():
+    """Entering and exiting a ``dynamic_entrypoint()``'s ``with`` block, when
+    that registers the entry point and when it re-enters a block that's
+    already active, at increasing depths of nesting.
+    """
+    import prybar
+
+    entrypoint = prybar.dynamic_entrypoint('bench.group', name='bench',
+                                           module='os')
+
+    def enter_exit():
+        with entrypoint:
+            pass
+
+    report('enter/exit, registering', _per_call(enter_exit))
+    for depth in (1, 10, 100):
+        with contextlib.ExitStack() as stack:
+            for _ in range(depth):
+                stack.enter_context(entrypoint)
+            report('enter/exit, re-entering', _per_call(enter_exit),
+                   depth=depth)
+
+
+@benchmark
+def bench_start_stop():
+    """A ``start()``/``stop()`` cycle of a ``dynamic_entrypoint()`` and of a
+    ``dynamic_entrypoints()`` batch of 100 entry points.
+    """
+    import prybar
+
+    single = prybar.dynamic_entrypoint('bench.group', name='bench',
+                                       module='os')
+    batch = prybar.dynamic_entrypoints([
+        ('bench.group', f'bench{i} = os.path:join') for i in range(100)])
+    for name, registration in [('dynamic_entrypoint()', single),
+                               ('dynamic_entrypoints(), 100', batch)]:
+        def start_stop():
+            registration.start()
+            registration.stop()
+        report(f'start/stop, {name}', _per_call(start_stop))
+
+
+def _synthetic_working_set(dists: int) -> 'pkg_resources.WorkingSet':
+    """Create a working set of ``dists`` distributions, each with an entry
+    point in a group other than the one the benchmarks look up.
+    """
+    import pkg_resources
+
+    working_set = pkg_resources.WorkingSet([])
+    for i in range(dists):
+        dist = pkg_resources.Distribution(
+            location=f'/bench/{i}', project_name=f'bench-dist-{i}',
+            version='1.0')
+        dist._ep_map = {'bench.other': {
+            'other': pkg_resources.EntryPoint.parse('other = os', dist=dist)}}
+        working_set.add(dist)
+    return working_set
+
+
+@benchmark
+def bench_iter_entry_points():
+    """Looking up a group's entry points in synthetic working sets of
+    increasing numbers of distributions, with increasing numbers of dynamic
+    entry points registered in the group. Compares
+    ``WorkingSet.iter_entry_points()`` with :func:`prybar.iter_entry_points`
+    (which caches the group's entry points until they change).
+    """
+    import prybar
+
+    for dists in (10, 100, 1000, 5000):
+        working_set = _synthetic_working_set(dists)
+        for live in (1, 100, 10000):
+            registration = prybar.dynamic_entrypoints(
+                [('bench.group', f'bench{i} = os.path:join')
+                 for i in range(live)], working_set=working_set)
+            with registration:
+                for name, lookup in [
+                        ('WorkingSet.iter_entry_points',
+                         lambda: list(working_set.iter_entry_points(
+                             'bench.group'))),
+                        ('prybar.iter_entry_points',
+                         lambda: list(prybar.iter_entry_points(
+                             'bench.group', working_set=working_set)))]:
+                    report(f'lookup, {name}', _per_call(lookup),
+                           dists=dists, live_entrypoints=live)
+
+
+@benchmark
+def bench_preload(repeat: int = 5):
+    """Entering a ``dynamic_entrypoints()`` batch whose targets are in
+    modules that haven't been imported yet, and then loading all of the
+    targets (e.g. while handling a first request), with and without
+    ``preload=True``, in a fresh interpreter.
+    """
+    modules = ['calendar', 'colorsys', 'csv', 'difflib', 'fractions',
+               'ftplib', 'imaplib', 'plistlib', 'poplib', 'smtplib',
+               'statistics', 'tabnanny', 'tarfile', 'uuid', 'wave',
+               'zipfile']
+    entrypoints = [('bench.group', f'{module} = {module}')
+                   for module in modules]
+    for preload in (False, True):
+        setup = (f'import pkg_resources, prybar; '
+                 f'batch = prybar.dynamic_entrypoints({entrypoints!r}, '
+                 f'preload={preload})')
+        enter = _time_import_in_subprocess('batch.start()', repeat, setup)
+        load = _time_import_in_subprocess(
+            '[ep.load() for ep in '
+            'pkg_resources.iter_entry_points("bench.group")]',
+            repeat, f'{setup}; batch.start()')
+        report(f'preload={preload}, enter', enter, modules=len(modules))
+        report(f'preload={preload}, first load of all', load,
+               modules=len(modules))
+
+
+def main(argv: Optional[List[str]] = None):
+    global _print_results, _current_benchmark
+
+    parser = argparse.ArgumentParser(description='Benchmarks for prybar.')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help=f'benchmarks to run (default: all of '
+                             f'{", ".join(BENCHMARKS)})')
+    parser.add_argument('--json', action='store_true',
+                        help='write the results to stdout as JSON')
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}; '
+                     f'available: {", ".join(BENCHMARKS)}')
+
+    import prybar
+
+    _results.clear()
+    _print_results = not args.json
+    for name in names:
+        _current_benchmark = name
+        BENCHMARKS[name]()
+    _current_benchmark = None
+
+    if args.json:
+        json.dump({'prybar': prybar.__version__,
+                   'python': platform.python_version(),
+                   'implementation': platform.python_implementation(),
+                   'results': _results}, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
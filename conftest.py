@@ -0,0 +1,18 @@
+import sys
+
+import pytest
+
+
+def pytest_collection_modifyitems(items):
+    # The examples use importlib.metadata.entry_points(group=...), which
+    # was added in Python 3.10
+    if sys.version_info >= (3, 10):
+        return
+    skip = pytest.mark.skip(
+        reason='the example uses the importlib.metadata API of Python 3.10')
+    for item in items:
+        doctest = getattr(item, 'dtest', None)
+        if doctest is not None and any(
+                'importlib.metadata' in example.source
+                for example in doctest.examples):
+            item.add_marker(skip)
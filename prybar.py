@@ -1,30 +1,328 @@
 """
-Create temporary pkg_resources entry points at runtime.
+Create temporary pkg_resources (or importlib.metadata) entry points at runtime.
 """
+import atexit
+from collections import ChainMap, namedtuple
 from contextlib import contextmanager
-import pkg_resources
-from typing import Union, Type, Callable, Optional
-from functools import wraps
+import copy
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+import types
+from typing import (
+    IO, Union, Type, Callable, Optional, Iterable, Iterator, List, Sequence,
+    Tuple, TYPE_CHECKING)
+from functools import lru_cache, wraps
+import weakref
 
-__all__ = ['dynamic_entrypoint']
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # Python 3.6 — context-local registrations are not supported
+    contextvars = None
+
+# Importing pkg_resources is expensive (it scans every sys.path entry to build
+# the global WorkingSet), so it's imported on first use rather than here. So
+# are the standard library modules that only a few functions need, to keep
+# importing prybar cheap. Annotations naming them are strings, which
+# typing.get_type_hints() can only resolve if they're passed in localns (a
+# module __getattr__ doesn't help, as it looks names up in the module's dict).
+if TYPE_CHECKING:  # pragma: no cover
+    import importlib.metadata
+    import pkg_resources
+
+__all__ = ['dynamic_entrypoint', 'dynamic_entrypoints', 'set_default_backend',
+           'iter_entry_points', 'get_group', 'subscribe', 'EntrypointEvent',
+           'isolated_working_set', 'only_dynamic', 'RegistrationSnapshot',
+           'snapshot_registrations', 'init_worker', 'MaterialisedEntrypoints',
+           'materialise_entrypoints', 'from_manifest', 'export_index',
+           'load_index', 'EntrypointIndex', 'IndexedEntrypoint', 'Stats',
+           'StatsEvent', 'collect_stats', 'trace_discovery', 'DiscoveryTrace',
+           'DiscoveryQuery', 'active', 'stop_all', 'detect_leaks',
+           'ActiveRegistration',
+           'MetadataWorkingSet', 'metadata_working_set']
 __version__ = '1.0.0'
 
+PKG_RESOURCES = 'pkg_resources'
+IMPORTLIB_METADATA = 'importlib.metadata'
+_BACKENDS = (PKG_RESOURCES, IMPORTLIB_METADATA)
+_default_backend = PKG_RESOURCES
+
+# Held while prybar modifies a working set
+_lock = threading.RLock()
+
+# Incremented whenever prybar changes the entry points visible in any working
+# set (other than context-local ones), while holding _lock
+_generation = 0
+
+# The (group, callback) pairs registered with subscribe(). Replaced rather
+# than modified so that it can be iterated without holding _lock.
+_subscribers = ()
+
+# Callbacks registered with _subscribe_batches(), which receive all the
+# events of a change at once. Replaced rather than modified, like _subscribers.
+_batch_subscribers = ()
+
+# Events generated in a thread while it holds a registration's lock are queued
+# in this thread's ``pending`` list, and sent to subscribers once the lock is
+# released, so that subscribers can use the registration.
+_deferred_events = threading.local()
+
+# The Stats objects collecting, from collect_stats(). Replaced rather than
+# modified, like _subscribers.
+_collectors = ()
+
+_INACTIVE = (0, False, None)
+
+# The active registrations (other than context-local ones), in the order they
+# were activated: {registration: ActiveRegistration}. Modified while holding
+# _lock.
+_active_registrations = {}
+
+# The value of an entry point's load() cache when it's empty
+_NOT_LOADED = object()
+
+# Objects registered with dynamic_entrypoint(obj=...). Their entry points
+# reference them as attributes of this namespace, e.g. prybar:_objects.o0
+_objects = types.SimpleNamespace()
+_object_ids = itertools.count()
+
+if contextvars is not None:
+    # The state of context-local registrations in the current context
+    _context_activations = contextvars.ContextVar(
+        'prybar_context_activations', default={})
+    # The context-local entry points of each dist in the current context:
+    # {id(dist): {group: {name: entrypoint}}}
+    _context_entrypoints = contextvars.ContextVar(
+        'prybar_context_entrypoints', default={})
+
+_EntrypointSpec = Union[Callable, Type[object], str,
+                        'pkg_resources.EntryPoint',
+                        'importlib.metadata.EntryPoint']
+
+
+class _DynamicRegistration:
+    """Implements the re-entrant context manager, decorator and
+    ``start()``/``stop()`` behaviour shared by prybar's registration objects.
+
+    Subclasses implement :meth:`_activate` to return a context manager which
+    registers their entry points while it's active.
+    """
+
+    def __init__(self, context_local: bool = False):
+        if context_local and contextvars is None:  # pragma: no cover
+            raise RuntimeError('context_local requires Python 3.7 or greater')
+        self.__context_local = context_local
+        # Guards the active state. Re-entering an already active registration
+        # only needs this lock, not the global _lock used to modify working
+        # sets.
+        self.__lock = threading.Lock()
+        self.__state = _INACTIVE
+
+    @property
+    def context_local(self): return self.__context_local
+
+    def _activate(self):
+        raise NotImplementedError()
+
+    # The active state is a tuple of (active_count, active_via_start,
+    # active_context_manager). Context-local registrations keep a separate
+    # state in each context, so that each context activates them
+    # independently.
+    def __get_state(self):
+        if self.__context_local:
+            return _context_activations.get().get(self, _INACTIVE)
+        return self.__state
+
+    def __set_state(self, state):
+        if self.__context_local:
+            activations = dict(_context_activations.get())
+            if state == _INACTIVE:
+                activations.pop(self, None)
+            else:
+                activations[self] = state
+            _context_activations.set(activations)
+        else:
+            self.__state = state
+
+    @contextmanager
+    def _holding_state(self) -> Iterator[bool]:
+        """Prevent the registration being activated or deactivated within
+        the with block, which gets whether it's active (in the current
+        context, if it's context-local).
+        """
+        with _deferring_events(), self.__lock:
+            active_count, active_via_start, _ = self.__get_state()
+            yield active_count > 0 or active_via_start
+
+    def __enter__(self):
+        with _deferring_events(), self.__lock:
+            active_count, active_via_start, context_manager = \
+                self.__get_state()
+            if active_via_start:
+                raise RuntimeError(
+                    'can\'t __enter__() while active via start()')
+
+            assert active_count >= 0
+            if active_count == 0:
+                assert context_manager is None
+                context_manager = self._activate()
+                context_manager.__enter__()
+                self.__track()
+
+            self.__set_state((active_count + 1, False, context_manager))
 
-class DynamicEntrypoint:
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with _deferring_events(), self.__lock:
+            active_count, active_via_start, context_manager = \
+                self.__get_state()
+            if active_via_start:
+                raise RuntimeError(
+                    'can\'t __exit__() while active via start()')
+
+            if active_count < 1:
+                raise RuntimeError('__exit__() called more than __enter__()')
+
+            if active_count == 1:
+                assert context_manager is not None
+                self.__set_state(_INACTIVE)
+                self.__untrack()
+                context_manager.__exit__(exc_type, exc_val, exc_tb)
+            else:
+                self.__set_state(
+                    (active_count - 1, False, context_manager))
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.__exit__(exc_type, exc_val, exc_tb)
+
+    def __call__(self, func: Callable):
+        """
+        Decorate a function to have this entry point enabled before it runs and
+        removed afterwards.
+
+        Coroutine functions and asynchronous generator functions are supported
+        — the entry point remains enabled until the coroutine finishes or the
+        generator is exhausted or closed.
+
+        :param func: The function to decorate
+        :return: The decorated function
+        """
+        import inspect
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def with_dynamic_entrypoint(*args, **kwargs):
+                with self:
+                    return await func(*args, **kwargs)
+        elif inspect.isasyncgenfunction(func):
+            @wraps(func)
+            async def with_dynamic_entrypoint(*args, **kwargs):
+                with self:
+                    agen = func(*args, **kwargs)
+                    try:
+                        item = await agen.__anext__()
+                        while True:
+                            try:
+                                sent = yield item
+                            except GeneratorExit:
+                                raise
+                            except BaseException as e:
+                                item = await agen.athrow(e)
+                            else:
+                                item = await agen.asend(sent)
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        await agen.aclose()
+        else:
+            @wraps(func)
+            def with_dynamic_entrypoint(*args, **kwargs):
+                with self:
+                    return func(*args, **kwargs)
+        return with_dynamic_entrypoint
+
+    def start(self):
+        with _deferring_events(), self.__lock:
+            active_count, active_via_start, context_manager = \
+                self.__get_state()
+            if active_count > 0:
+                raise RuntimeError(
+                    'can\'t start() while active via __enter__()')
+
+            if active_via_start:
+                return
+
+            assert context_manager is None
+            context_manager = self._activate()
+            context_manager.__enter__()
+            self.__track()
+            self.__set_state((0, True, context_manager))
+
+    def stop(self):
+        with _deferring_events(), self.__lock:
+            active_count, active_via_start, context_manager = \
+                self.__get_state()
+            if active_count > 0:
+                raise RuntimeError(
+                    'can\'t stop() while active via __enter__()')
+
+            if not active_via_start:
+                return
+
+            assert context_manager is not None
+            self.__set_state(_INACTIVE)
+            self.__untrack()
+            context_manager.__exit__(None, None, None)
+
+    def _force_stop(self) -> bool:
+        """Deactivate the registration however it was activated, returning
+        whether it was active.
+        """
+        with _deferring_events(), self.__lock:
+            context_manager = self.__get_state()[2]
+            if context_manager is None:
+                return False
+            self.__set_state(_INACTIVE)
+            self.__untrack()
+            context_manager.__exit__(None, None, None)
+            return True
+
+    def __track(self):
+        # Context-local registrations can't outlive their contexts' use of
+        # them, so aren't tracked.
+        if not self.__context_local:
+            active = ActiveRegistration(self, self.scope, self.working_set,
+                                        _caller())
+            with _lock:
+                _active_registrations[self] = active
+
+    def __untrack(self):
+        if not self.__context_local:
+            with _lock:
+                _active_registrations.pop(self, None)
+
+
+class DynamicEntrypoint(_DynamicRegistration):
     """The type of the context manager objects returned by
     :meth:`prybar.dynamic_entrypoint`.
     """
 
-    def __init__(self, group: str, entrypoint: pkg_resources.EntryPoint,
-                 working_set: pkg_resources.WorkingSet, scope: str):
+    def __init__(self, group: str, entrypoint: 'pkg_resources.EntryPoint',
+                 working_set: 'pkg_resources.WorkingSet', scope: str,
+                 context_local: bool = False, position: Optional[int] = None,
+                 preload: bool = False):
+        super().__init__(context_local=context_local)
         self.__group = group
         self.__entrypoint = entrypoint
         self.__working_set = working_set
         self.__scope = scope
-
-        self.__active_via_start = False
-        self.__active_count = 0
-        self.__active_context_manager = None
+        self.__position = position
+        self.__preload = preload
 
     @property
     def group(self): return self.__group
@@ -38,84 +336,528 @@ class DynamicEntrypoint:
     @property
     def scope(self): return self.__scope
 
-    def __enter__(self):
-        if self.__active_via_start:
-            raise RuntimeError('can\'t __enter__() while active via start()')
+    @property
+    def position(self): return self.__position
 
-        assert self.__active_count >= 0
-        self.__active_count += 1
+    @property
+    def preload(self): return self.__preload
 
-        if self.__active_count == 1:
-            assert self.__active_context_manager is None
-            self.__active_context_manager = self._create_context_manager(
-                self.group, self.entrypoint, self.working_set, self.scope)
-            self.__active_context_manager.__enter__()
+    def swap(self, entrypoint: Optional[_EntrypointSpec] = None, *,
+             obj: Optional[object] = None
+             ) -> Union['pkg_resources.EntryPoint',
+                        'importlib.metadata.EntryPoint']:
+        """
+        Change the target of the entry point, keeping its group and name.
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.__active_via_start:
-            raise RuntimeError('can\'t __exit__() while active via start()')
+        If the entry point is registered, the new one replaces it in the
+        working set in a single step, so lookups made concurrently find
+        either the old or the new entry point, never neither. Caches of the
+        working set's entry points are invalidated, and subscribers receive
+        a ``'replaced'`` :class:`prybar.EntrypointEvent`. If it isn't
+        registered, the new entry point is used when it next is.
 
-        if self.__active_count < 1:
-            raise RuntimeError('__exit__() called more than __enter__()')
+        >>> registration = dynamic_entrypoint('example.types', 'int = '
+        ...                                   'builtins:int')
+        >>> with registration:
+        ...     old = registration.swap('builtins:float')
+        ...     registration.entrypoint.load()('1.5')
+        1.5
 
-        if self.__active_count == 1:
-            assert self.__active_context_manager is not None
-            self.__active_context_manager.__exit__(exc_type, exc_val, exc_tb)
-            self.__active_context_manager = None
+        :param entrypoint: The new target, as a function or class, an
+            entry point string (``'name = module:attrs'``, or just
+            ``'module:attrs'``), or an ``EntryPoint``. The name must match
+            the current entry point's.
+        :param obj: An object to register directly instead. See
+            :meth:`prybar.dynamic_entrypoint`.
+        :return: The entry point that was replaced.
+        """
+        # The name and requirement setting are the same for every entry point
+        # this registration has had, so can be read before locking
+        current = self.entrypoint
+        name = current.name
+        backend = (IMPORTLIB_METADATA
+                   if isinstance(self.working_set, MetadataWorkingSet)
+                   else PKG_RESOURCES)
+        if isinstance(entrypoint, str) and '=' not in entrypoint:
+            entrypoint = f'{name} = {entrypoint}'
+        replacement = _create_entrypoint(
+            self.group, entrypoint,
+            name=name if obj is not None or callable(entrypoint) else None,
+            backend=backend, require=getattr(current, '_require', True),
+            obj=obj)
+        if replacement.name != name:
+            raise ValueError(f'can\'t swap entry point {name!r} for one '
+                             f'named {replacement.name!r}')
+        if obj is not None:
+            _keep_object(self, replacement)
+        if self.preload:
+            _preload_entrypoints(((self.group, replacement),))
 
-        self.__active_count -= 1
+        with self._holding_state() as active:
+            if active and self.context_local:
+                raise RuntimeError('can\'t swap() a context-local entry '
+                                   'point while it\'s active')
+            # Read under the lock so that concurrent swaps replace each other
+            previous = self.entrypoint
+            if not active:
+                self.__entrypoint = replacement
+                return previous
+            with _lock:
+                started = time.perf_counter()
+                registry = _registry_for(self.working_set)
+                dist = _scope_dist(self.working_set, self.scope)
+                registry.replace_entrypoint(dist, self.group, previous,
+                                            replacement)
+                self.__entrypoint = replacement
+                _record(StatsEvent.MUTATION, self.scope, started)
+            _notify(EntrypointEvent.REPLACED, ((self.group, replacement),),
+                    self.scope, self.working_set)
+        return previous
 
-    def __call__(self, func: Callable):
-        """
-        Decorate a function to have this entry point enabled before it runs and
-        removed afterwards.
+    def _activate(self):
+        return self._create_context_manager(
+            self.group, self.entrypoint, self.working_set, self.scope,
+            context_local=self.context_local, position=self.position,
+            preload=self.preload)
 
-        :param func: The function to decorate
-        :return: The decorated function
-        """
-        @wraps(func)
-        def with_dynamic_entrypoint(*args, **kwargs):
-            with self:
-                return func(*args, **kwargs)
-        return with_dynamic_entrypoint
+    @staticmethod
+    def _create_context_manager(group: str,
+                                entrypoint: 'pkg_resources.EntryPoint',
+                                working_set: 'pkg_resources.WorkingSet',
+                                scope: str, context_local: bool = False,
+                                position: Optional[int] = None,
+                                preload: bool = False):
+        return DynamicEntrypoints._create_context_manager(
+            ((group, entrypoint),), working_set, scope,
+            context_local=context_local, position=position, preload=preload)
 
-    def start(self):
-        if self.__active_count > 0:
-            raise RuntimeError('can\'t start() while active via __enter__()')
 
-        if self.__active_via_start:
+class DynamicEntrypoints(_DynamicRegistration):
+    """The type of the context manager objects returned by
+    :meth:`prybar.dynamic_entrypoints`.
+    """
+
+    def __init__(self,
+                 entrypoints: Sequence[Tuple[str, 'pkg_resources.EntryPoint']],
+                 working_set: 'pkg_resources.WorkingSet', scope: str,
+                 context_local: bool = False, position: Optional[int] = None,
+                 preload: bool = False):
+        super().__init__(context_local=context_local)
+        self.__entrypoints = tuple(entrypoints)
+        self.__working_set = working_set
+        self.__scope = scope
+        self.__position = position
+        self.__preload = preload
+
+    @property
+    def entrypoints(self): return self.__entrypoints
+
+    @property
+    def working_set(self): return self.__working_set
+
+    @property
+    def scope(self): return self.__scope
+
+    @property
+    def position(self): return self.__position
+
+    @property
+    def preload(self): return self.__preload
+
+    def _activate(self):
+        return self._create_context_manager(
+            self.entrypoints, self.working_set, self.scope,
+            context_local=self.context_local, position=self.position,
+            preload=self.preload)
+
+    @staticmethod
+    def _create_context_manager(
+            entrypoints: Sequence[Tuple[str, 'pkg_resources.EntryPoint']],
+            working_set: 'pkg_resources.WorkingSet', scope: str,
+            context_local: bool = False, position: Optional[int] = None,
+            preload: bool = False):
+        if context_local:
+            registration = _ContextLocalRegistration(
+                entrypoints, working_set, scope, position, preload)
+        else:
+            registration = _register_entrypoints(entrypoints, working_set,
+                                                 scope, position, preload)
+        if _collectors:
+            return _TimedRegistration(registration, scope)
+        return registration
+
+
+@contextmanager
+def _register_entrypoints(
+        entrypoints: Sequence[Tuple[str, 'pkg_resources.EntryPoint']],
+        working_set: 'pkg_resources.WorkingSet', scope: str,
+        position: Optional[int] = None, preload: bool = False):
+    if not entrypoints:
+        yield
+        return
+
+    if preload:
+        _preload_entrypoints(entrypoints)
+    with _lock:
+        started = time.perf_counter()
+        registry = _registry_for(working_set)
+        dist = _acquire_for_entrypoints(registry, scope, entrypoints,
+                                        position)
+        registry.add_entrypoints(dist, entrypoints)
+        _record(StatsEvent.MUTATION, scope, started)
+
+    # Wait for something to happen with the entrypoints...
+    try:
+        _notify(EntrypointEvent.ADDED, entrypoints, scope, working_set)
+        yield
+    finally:
+        # Tidy up
+        with _lock:
+            started = time.perf_counter()
+            removed = registry.remove_entrypoints(dist, entrypoints)
+            registry.release(dist)
+            _record(StatsEvent.MUTATION, scope, started)
+        _notify(EntrypointEvent.REMOVED, removed, scope, working_set)
+
+
+class _ContextLocalRegistration:
+    """Registers entry points which are only visible in the current context.
+
+    The state of an active context-local registration is inherited by copies
+    of the context it's active in, so it can be exited from more than one
+    context. Each exit hides the entry points in the exiting context, and the
+    first releases the scope's dist.
+    """
+
+    def __init__(self, entrypoints, working_set, scope: str,
+                 position: Optional[int] = None, preload: bool = False):
+        self.entrypoints = entrypoints
+        self.working_set = working_set
+        self.scope = scope
+        self.position = position
+        self.preload = preload
+        self.released = False
+
+    def __enter__(self):
+        if not self.entrypoints:
             return
 
-        assert self.__active_context_manager is None
-        self.__active_via_start = True
-        self.__active_context_manager = self._create_context_manager(
-            self.group, self.entrypoint, self.working_set, self.scope)
-        self.__active_context_manager.__enter__()
+        if self.preload:
+            _preload_entrypoints(self.entrypoints)
 
-    def stop(self):
-        if self.__active_count > 0:
-            raise RuntimeError('can\'t stop() while active via __enter__()')
+        with _lock:
+            self.registry = _registry_for(self.working_set)
+            self.dist = _acquire_for_entrypoints(
+                self.registry, self.scope, self.entrypoints, self.position)
+            # The dist must remain in the working set while any context has
+            # entry points in it.
+            self.dist._local_count += 1
 
-        if not self.__active_via_start:
+        self.local_entrypoints = [
+            (group, self.registry.bind_local(self.dist, entrypoint))
+            for group, entrypoint in self.entrypoints]
+        _update_context_entrypoints(self.dist, add=self.local_entrypoints)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.entrypoints:
             return
 
-        assert self.__active_context_manager is not None
-        self.__active_context_manager.__exit__(None, None, None)
-        self.__active_context_manager = None
-        self.__active_via_start = False
+        _update_context_entrypoints(self.dist, remove=self.local_entrypoints)
+        with _lock:
+            if not self.released:
+                self.released = True
+                self.dist._local_count -= 1
+                self.registry.release(self.dist)
 
-    @staticmethod
-    @contextmanager
-    def _create_context_manager(group: str,
-                                entrypoint: pkg_resources.EntryPoint,
-                                working_set: pkg_resources.WorkingSet,
-                                scope: str):
-        name = entrypoint.name
+
+# The maximum number of threads used to import the modules of entry points
+# registered with preload=True
+_PRELOAD_THREADS = 8
+
+
+def _preload_entrypoints(entrypoints):
+    """Import the modules of entrypoints, in parallel, and check that their
+    targets exist.
+
+    An ImportError for the first entry point (in entrypoints' order) whose
+    target can't be loaded is raised.
+    """
+    targets = []
+    for group, entrypoint in entrypoints:
+        value, obj = _entrypoint_value(entrypoint)
+        if obj is None:
+            module, _, attrs = value.partition('[')[0].partition(':')
+            targets.append((group, entrypoint, module.strip(), attrs.strip()))
+
+    errors = {}
+    modules = list(dict.fromkeys(module for _, _, module, _ in targets
+                                 if module not in sys.modules))
+    if len(modules) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def import_module(module):
+            try:
+                __import__(module)
+            except Exception as e:
+                errors[module] = e
+
+        with ThreadPoolExecutor(min(len(modules), _PRELOAD_THREADS)) as pool:
+            for _ in pool.map(import_module, modules):
+                pass
+
+    for group, entrypoint, module, attrs in targets:
+        try:
+            if module in errors:
+                raise errors[module]
+            __import__(module)
+            target = sys.modules[module]
+            for attr in attrs.split('.') if attrs else ():
+                target = getattr(target, attr)
+        except Exception as e:
+            raise ImportError(f'failed to preload {entrypoint.name!r} in '
+                              f'group {group!r}: {e}') from e
+
+
+def _acquire_for_entrypoints(registry, scope: str, entrypoints,
+                             position: Optional[int] = None):
+    """Get the dist of scope to register entrypoints in, after checking that
+    none of them are already registered in it.
+    """
+    dist = registry.acquire(scope, position)
+    entry_map = dist._ep_map
+    local_entry_map = _context_entry_map(dist)
+
+    try:
+        # Check everything before touching the entry map so that a conflict
+        # leaves the working set exactly as we found it.
+        pending = set()
+        for group, entrypoint in entrypoints:
+            name = entrypoint.name
+            if (name in entry_map.get(group, ()) or
+                    name in local_entry_map.get(group, ()) or
+                    (group, name) in pending):
+                raise ValueError(
+                    f'{name!r} is already registered under {group!r} in '
+                    f'scope {format_scope(scope, dist)}')
+            pending.add((group, name))
+            assert getattr(entrypoint, 'dist', None) is None
+    except BaseException:
+        registry.release(dist)
+        raise
+    return dist
+
+
+class _EntryKeys:
+    """The keys of the Distributions at prybar's location in a WorkingSet.
+
+    This stands in for the list pkg_resources keeps in ``entry_keys`` for
+    each location, supporting the parts of the list interface it uses.
+    Every scope's Distribution shares prybar's location, so with a list,
+    adding and removing a scope would scan the keys of every other live
+    scope. The keys are held in a dict instead, which keeps them in order.
+
+    ``WorkingSet.__iter__`` iterates the keys without holding prybar's lock,
+    so iteration is over a snapshot; iterating the dict itself could fail if
+    another thread added or removed a scope meanwhile. Keys removed since the
+    snapshot was taken are skipped, as their dists are about to be removed
+    from ``by_key``.
+    """
+    __slots__ = ('_keys',)
+
+    def __init__(self, keys: Iterable[str] = ()):
+        self._keys = dict.fromkeys(keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        keys = self._keys
+        # list() copies the keys atomically
+        for key in list(keys):
+            if key in keys:
+                yield key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self._keys)!r})'
+
+    def __copy__(self):
+        return type(self)(self._keys)
+
+    def append(self, key: str):
+        self._keys[key] = None
+
+    def remove(self, key: str):
+        try:
+            del self._keys[key]
+        except KeyError:
+            raise ValueError(f'{key!r} is not in {self!r}') from None
+
+
+class _EntryMap(dict):
+    """The dict type of the entry maps of prybar's dists, and of each of
+    their groups.
+
+    Lookups iterate entry maps without holding prybar's lock, so iteration
+    is over a snapshot; iterating the dict itself could fail if another
+    thread registered or removed an entry point meanwhile. Copying a dict's
+    contents into a list is atomic.
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)))
+
+    def keys(self):
+        return list(dict.keys(self))
+
+    def values(self):
+        return list(dict.values(self))
+
+    def items(self):
+        return list(dict.items(self))
+
+
+class _OverlayEntryKeys(_EntryKeys):
+    """The _EntryKeys of an isolated working set.
+
+    Only the keys of scopes registered in the isolated working set are held;
+    the keys of the base working set's scopes are read through from its
+    current ``entry_keys``, so scopes the base adds or removes later are
+    found (or not) in the same way as its dists are in ``by_key``.
+    """
+    __slots__ = ('_base',)
+
+    def __init__(self, base: dict, keys: Iterable[str] = ()):
+        super().__init__(keys)
+        self._base = base
+
+    def _base_keys(self) -> Iterable[str]:
+        return self._base.get(__file__, ())
+
+    def __contains__(self, key):
+        return key in self._keys or key in self._base_keys()
+
+    def __iter__(self):
+        seen = set()
+        for key in itertools.chain(self._base_keys(), super().__iter__()):
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self)!r})'
+
+    def __copy__(self):
+        return type(self)(self._base, self._keys)
+
+    def remove(self, key: str):
+        if key in self._keys:
+            del self._keys[key]
+        elif key not in self._base_keys():
+            raise ValueError(f'{key!r} is not in {self!r}')
+
+
+# The number of dists prybar has removed from a working set which are kept to
+# be found by lookups that raced with their removal
+_RELEASED_DISTS = 32
+
+
+class _ReleasedDists:
+    """Makes a ``by_key`` mapping find the dists of recently released scopes.
+
+    ``WorkingSet.__iter__`` gets a key from ``entry_keys``, then looks it up
+    in ``by_key``, without holding prybar's lock. If another thread releases
+    the scope in between, the lookup finds the released dist (which has no
+    entry points left), as if the iteration had happened just before the
+    release, rather than raising ``KeyError``. ``in`` and ``get()`` don't
+    find released dists.
+    """
+
+    def __missing__(self, key):
+        released = getattr(self, 'released', None)
+        if released is not None and key in released:
+            return released[key]
+        raise KeyError(key)
+
+    def add_released(self, dist: 'pkg_resources.Distribution'):
+        released = self.released
+        released.pop(dist.key, None)
+        released[dist.key] = dist
+        if len(released) > _RELEASED_DISTS:
+            del released[next(iter(released))]
+
+
+class _ByKey(_ReleasedDists, dict):
+    """The ``by_key`` of a working set prybar has registered scopes in."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.released = {}
+
+
+class _Overlay(_ReleasedDists, ChainMap):
+    """A mapping of an isolated working set, which reads through to the
+    mapping of the working set it's based on, but only modifies its own.
+
+    pkg_resources modifies the lists it gets from ``entry_keys.setdefault()``
+    in place, so base values are copied before setdefault() returns them.
+    """
+
+    def setdefault(self, key, default=None):
+        own = self.maps[0]
+        if key not in own:
+            own[key] = copy.copy(self[key]) if key in self else default
+        return own[key]
+
+    def __delitem__(self, key):
+        if key in self.maps[0]:
+            del self.maps[0][key]
+        # Deleting a key which is only in the base reveals the base's value,
+        # as if the key had been copied and then deleted.
+        elif key not in self:
+            raise KeyError(key)
+
+
+def _is_inherited(mapping, key) -> bool:
+    """Check if key is only present in mapping because an isolated working
+    set inherited it from its base.
+    """
+    return isinstance(mapping, _Overlay) and key not in mapping.maps[0]
+
+
+class _WorkingSetRegistry:
+    """Manages the Distributions prybar creates to hold the entry points of
+    each scope in a pkg_resources.WorkingSet.
+    """
+
+    def __init__(self, working_set: 'pkg_resources.WorkingSet'):
+        self.working_set = working_set
+        by_key = working_set.by_key
+        if isinstance(by_key, _Overlay):
+            by_key.released = {}
+        elif not isinstance(by_key, _ByKey):
+            working_set.by_key = _ByKey(by_key)
+
+    def acquire(self, scope: str, position: Optional[int] = None
+                ) -> 'pkg_resources.Distribution':
+        """Get the Distribution representing scope, creating and registering
+        it if it doesn't exist yet.
+
+        All of prybar's Distributions share one path entry in the working
+        set's ``entries``. If it doesn't exist yet, it's inserted at
+        ``position``, otherwise it's appended.
+        """
+        working_set = self.working_set
         # We need a Distribution to register our dynamic entrypoints within.
         # We have to always instantiate it to find our key, as key can be
         # different from the project_name
-        dist = pkg_resources.Distribution(location=__file__,
-                                          project_name=scope)
+        dist = _scope_distribution_type()(scope)
 
         # Prevent creating entrypoints in distributions not created by us,
         # otherwise we could remove the distributions when cleaning up.
@@ -126,123 +868,1740 @@ class DynamicEntrypoint:
                              f'{working_set.by_key[dist.key].location}')
 
         if dist.key not in working_set.by_key:
+            if position is not None and __file__ not in working_set.entries:
+                # add() won't move the entry if it's already present
+                working_set.entries.insert(position, __file__)
+            self._own_entry_keys()
             working_set.add(dist)
+        elif _is_inherited(working_set.by_key, dist.key):
+            # Copy the base working set's dist rather than modifying it
+            if __file__ not in working_set.entries:
+                # The base added its first dist after we copied its entries
+                working_set.entries.insert(
+                    len(working_set.entries) if position is None
+                    else position, __file__)
+            self._own_entry_keys()
+            # Keep the copy visible if the base removes its scope
+            working_set.entry_keys[__file__].append(dist.key)
+            working_set.by_key[dist.key] = self._copy_dist(
+                working_set.by_key[dist.key])
         # Reference the actual registered dist if we didn't just register it
-        dist = working_set.by_key[dist.key]
+        return working_set.by_key[dist.key]
 
-        # Ensure the group exists in our distribution
-        group_entries = dist.get_entry_map().setdefault(group, {})
+    def _own_entry_keys(self):
+        """Make the entry_keys value for our location an _EntryKeys owned by
+        this working set. add() modifies the existing value.
+        """
+        entry_keys = self.working_set.entry_keys
+        if isinstance(entry_keys, _Overlay):
+            # Copying the base's keys would keep them after the base
+            # removes their dists, so read them through instead.
+            if __file__ not in entry_keys.maps[0]:
+                entry_keys.maps[0][__file__] = _OverlayEntryKeys(
+                    entry_keys.maps[1])
+            return
+        keys = entry_keys.setdefault(__file__, _EntryKeys())
+        if not isinstance(keys, _EntryKeys):
+            entry_keys[__file__] = _EntryKeys(keys)
 
-        # Create an entry for the specified entrypoint
-        if name in group_entries:
-            raise ValueError(f'{name!r} is already registered under {group!r} '
-                             f'in scope {format_scope(scope, dist)}')
+    @staticmethod
+    def _copy_dist(base_dist: 'pkg_resources.Distribution'
+                   ) -> 'pkg_resources.Distribution':
+        dist = _scope_distribution_type()(base_dist.project_name)
+        for group, entries in base_dist._ep_map.items():
+            dist._ep_map[group] = group_entries = _EntryMap()
+            for name, entrypoint in entries.items():
+                group_entries[name] = entrypoint = copy.copy(entrypoint)
+                entrypoint.dist = dist
+        return dist
 
-        assert entrypoint.dist is None
-        entrypoint.dist = dist
-        group_entries[name] = entrypoint
+    def release(self, dist: 'pkg_resources.Distribution'):
+        """Remove a scope's Distribution if it no longer contains any entry
+        points.
+        """
+        working_set = self.working_set
+        if not (dist._ep_map or dist._local_count):
+            # Remove the key from entry_keys before by_key, in the reverse of
+            # the order add() adds them, so that a concurrent iteration of the
+            # working set doesn't find a key without its dist.
+            working_set.entry_keys[__file__].remove(dist.key)
+            working_set.by_key.add_released(dist)
+            del working_set.by_key[dist.key]
+            # Added in setuptools 62.3
+            canonical_keys = getattr(
+                working_set, 'normalized_to_canonical_keys', {})
+            name = _canonical_name(dist.key)
+            if canonical_keys.get(name) == dist.key:
+                del canonical_keys[name]
 
-        # Wait for something to happen with the entrypoint...
-        try:
-            yield
-        finally:
-            # Tidy up
-            del group_entries[name]
+            if not working_set.entry_keys[__file__]:
+                working_set.entries.remove(__file__)
+                del working_set.entry_keys[__file__]
+
+    def add_entrypoints(
+            self, dist: 'pkg_resources.Distribution',
+            entrypoints: Iterable[Tuple[str, 'pkg_resources.EntryPoint']]):
+        entry_map = dist._ep_map
+        for group, entrypoint in entrypoints:
+            entrypoint.dist = dist
+            _forget_loaded(entrypoint)
+            entries = entry_map.get(group)
+            if entries is None:
+                entries = entry_map[group] = _EntryMap()
+            entries[entrypoint.name] = entrypoint
+        _entrypoints_changed()
+
+    def remove_entrypoints(
+            self, dist: 'pkg_resources.Distribution',
+            entrypoints: Iterable[Tuple[str, 'pkg_resources.EntryPoint']]):
+        entry_map = dist._ep_map
+        removed = []
+        for group, entrypoint in entrypoints:
+            group_entries = entry_map[group]
+            # The registered entry point differs if it's been swapped
+            entrypoint = group_entries.pop(entrypoint.name)
             # If we re-use this entrypoint (by re-entering the context) the
             # dist may well have changed (because it gets deleted from the
             # working set) so we shouldn't remember it.
             assert entrypoint.dist is dist
             entrypoint.dist = None
+            _forget_loaded(entrypoint)
             if len(group_entries) == 0:
-                del dist.get_entry_map()[group]
+                del entry_map[group]
+            removed.append((group, entrypoint))
+        _entrypoints_changed()
+        return removed
 
-            if len(dist.get_entry_map()) == 0:
-                del working_set.by_key[dist.key]
-                working_set.entry_keys[__file__].remove(dist.key)
+    def replace_entrypoint(self, dist: 'pkg_resources.Distribution',
+                           group: str, entrypoint: 'pkg_resources.EntryPoint',
+                           replacement: 'pkg_resources.EntryPoint'):
+        group_entries = dist._ep_map[group]
+        assert group_entries[entrypoint.name] is entrypoint
+        replacement.dist = dist
+        _forget_loaded(replacement)
+        group_entries[entrypoint.name] = replacement
+        entrypoint.dist = None
+        _forget_loaded(entrypoint)
+        _entrypoints_changed()
 
-                if not working_set.entry_keys[__file__]:
-                    del working_set.entry_keys[__file__]
-                    working_set.entries.remove(__file__)
+    def bind_local(self, dist: 'pkg_resources.Distribution',
+                   entrypoint: 'pkg_resources.EntryPoint'
+                   ) -> 'pkg_resources.EntryPoint':
+        """Get the EntryPoint to make visible in a context for a context-local
+        registration.
 
+        A context-local registration can be active in several contexts at
+        once, so each gets its own copy, attached to dist.
+        """
+        entrypoint = copy.copy(entrypoint)
+        entrypoint.dist = dist
+        return entrypoint
 
-def dynamic_entrypoint(
-        group: str,
-        entrypoint: Optional[Union[Callable, Type[object], str,
-                                   pkg_resources.EntryPoint]] = None, *,
-        name: Optional[str] = None, module: Optional[str] = None,
-        attribute: Optional[str] = None, scope: Optional[str] = None,
-        working_set: Optional[pkg_resources.WorkingSet] = None
-        ) -> DynamicEntrypoint:
+
+class MetadataWorkingSet:
+    """An in-memory set of distributions which are visible to
+    :mod:`importlib.metadata`.
+
+    This is the ``importlib.metadata`` counterpart to a
+    ``pkg_resources.WorkingSet``. It's a ``DistributionFinder`` which is
+    inserted into :data:`sys.meta_path` while it contains any distributions,
+    so entry points registered in it are returned by
+    ``importlib.metadata.entry_points()`` without touching the filesystem.
+
+    The default instance used by prybar's ``importlib.metadata`` backend is
+    :data:`prybar.metadata_working_set`.
     """
-    :meth:`prybar.dynamic_entrypoint` registers and de-registers
-    :mod:`pkg_resources` `entry points`_ at runtime.
 
-    .. _entry points: https://setuptools.readthedocs.io/en/latest/pkg_resources.html#entry-points  # noqa: E501
+    def __init__(self):
+        self.by_key = {}
 
-    It acts as a context manager and function decorator. The entrypoint is
-    registered within the ``with`` statement, or while the decorated function
-    is running. It can also be registered and de-registered manually using
-    its ``start()`` and ``stop()`` methods.
+    def __iter__(self):
+        return iter(list(self.by_key.values()))
 
-    The context manager/decorator is re-entrant, i.e. a single instance can be
-    used in multiple with statements, or decorate multiple functions, and each
-    usage site can be entered multiple times while the same or other usage
-    sites are still in use. The entry point is registered once when the first
-    with block or decorated function is entered, and remains registered until
-    all with blocks/decorated functions have been left.
+    def find_spec(self, fullname, path=None, target=None):
+        # We only find distributions, not modules
+        return None
 
-    In contrast, the ``start()``/``stop()`` API immediatley registers and
-    deregisters the entry point. Calling ``start`` multiple times has no effect
-    after the first, neither does calling ``stop``.
+    def invalidate_caches(self):
+        pass
 
-    Use of the ``start()``/``stop()`` API is incompatible with the context
-    manager/decorator API. An error will be raised if an attempt is made
-    to ``start()``/``stop()`` while a with block or decorated function is
-    active, and vice versa.
+    def find_distributions(self, context=None):
+        name = getattr(context, 'name', None)
+        if name is None:
+            return iter(self)
+        dist = self.by_key.get(_canonical_name(name))
+        return iter(() if dist is None else (dist,))
 
-    The ``group`` must always be provided as a string, but he entrypoint can
-    be specified in several ways:
 
-      - By providing a ``name`` and ``module``. The target in the module can be
-        specified with ``attribute`` if it differs from ``name``.
-      - By passing a function or class as ``entrypoint``. The ``name``,
-        ``module`` and ``attribute`` are then inferred automatically. The
-        ``name`` can be overriden.
-      - By passing a string to be parsed as ``entrypoint``. The format is the
-        same as used in setup.py, e.g.
-        ``"my_name = my_module.submodule:my_func"``.
-      - By passing a pre-created ``pkg_resources.EntryPoint`` object as
-        ``entrypoint``.
+class _MetadataRegistry:
+    """Manages the in-memory Distributions prybar creates to hold the entry
+    points of each scope in a :class:`MetadataWorkingSet`.
+    """
 
-    :param group: The name of the entrypoint group to register the entrypoint
-        under. For example, ``myproject.plugins``.
-    :param name: The name of the entrypoint.
-    :param module: The dotted path of the module the entrypoint references.
-    :param attribute: The name of the object within the module the entrypoint
-        references (defaults to name).
-    :param entrypoint: Either a function (or other object), or an entrypoint
-        string to parse, or a pre-created pkg_resources.Entrypoint object
-    :param scope: A name to scope your entrypoints within. ``group``, ``name``
-        pairs must be unique within a scope, but multiple entrypoints with
-        the same ``group`` and ``name`` can be created in different scopes. The
-        scope defaults to ``prybar.scope.default`` if not specified.
+    def __init__(self, working_set: MetadataWorkingSet):
+        self.working_set = working_set
 
-        Note: internally this defines the name of the
+    def acquire(self, scope: str, position: Optional[int] = None):
+        working_set = self.working_set
+        key = _canonical_name(scope)
+        dist = working_set.by_key.get(key)
+        if dist is not None:
+            return dist
+
+        metadata = _importlib_metadata()
+        dist = _metadata_distribution_type()(scope, key)
+
+        # As with pkg_resources, don't shadow (or get shadowed by) an
+        # installed distribution of the same name.
+        context = metadata.DistributionFinder.Context(name=scope)
+        for finder in sys.meta_path:
+            find_distributions = getattr(finder, 'find_distributions', None)
+            if finder is working_set or find_distributions is None:
+                continue
+            for existing in find_distributions(context):
+                raise ValueError(f'scope {format_scope(scope, dist)} already '
+                                 f'exists in working set at location '
+                                 f'{existing.locate_file("")}')
+
+        if not working_set.by_key:
+            if position is None:
+                sys.meta_path.append(working_set)
+            else:
+                sys.meta_path.insert(position, working_set)
+        working_set.by_key[key] = dist
+        return dist
+
+    def release(self, dist):
+        working_set = self.working_set
+        if not (dist._ep_map or dist._local_count):
+            del working_set.by_key[dist.key]
+
+            if not working_set.by_key:
+                sys.meta_path.remove(working_set)
+
+    def add_entrypoints(self, dist, entrypoints):
+        entry_map = dist._ep_map
+        for group, entrypoint in entrypoints:
+            entries = entry_map.get(group)
+            if entries is None:
+                entries = entry_map[group] = _EntryMap()
+            entries[entrypoint.name] = entrypoint
+        dist.entry_points_changed()
+        _entrypoints_changed()
+
+    def remove_entrypoints(self, dist, entrypoints):
+        entry_map = dist._ep_map
+        removed = []
+        for group, entrypoint in entrypoints:
+            group_entries = entry_map[group]
+            removed.append((group, group_entries.pop(entrypoint.name)))
+            if len(group_entries) == 0:
+                del entry_map[group]
+        dist.entry_points_changed()
+        _entrypoints_changed()
+        return removed
+
+    def replace_entrypoint(self, dist, group, entrypoint, replacement):
+        dist._ep_map[group][entrypoint.name] = replacement
+        dist.entry_points_changed()
+        _entrypoints_changed()
+
+    def bind_local(self, dist, entrypoint):
+        # importlib.metadata EntryPoints are immutable and not bound to dists
+        return entrypoint
+
+
+def _entrypoints_changed():
+    global _generation
+    _generation += 1
+
+
+_registries = weakref.WeakKeyDictionary()
+
+
+def _registry_for(working_set):
+    try:
+        return _registries[working_set]
+    except KeyError:
+        if isinstance(working_set, MetadataWorkingSet):
+            registry = _MetadataRegistry(working_set)
+        else:
+            registry = _WorkingSetRegistry(working_set)
+        _registries[working_set] = registry
+        return registry
+
+
+def _importlib_metadata():
+    try:
+        import importlib.metadata as metadata
+    except ImportError:  # pragma: no cover
+        # Python < 3.8 — the importlib_metadata backport must be installed
+        import importlib_metadata as metadata
+    return metadata
+
+
+def _canonical_name(name: str) -> str:
+    """Normalise a distribution name as described in PEP 503."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+@lru_cache(maxsize=None)
+def _metadata_distribution_type():
+    # Created on demand so that importing prybar doesn't import
+    # importlib.metadata.
+    metadata = _importlib_metadata()
+
+    class _MetadataDistribution(metadata.Distribution):
+        """An in-memory importlib.metadata Distribution holding the entry
+        points of a scope.
+        """
+
+        def __init__(self, project_name: str, key: str):
+            self.project_name = project_name
+            self.key = key
+            self._ep_map = _EntryMap()
+            self._local_count = 0
+            self._entry_points_txt = None
+
+        def get_entry_map(self, group: Optional[str] = None):
+            return _get_entry_map(self, group)
+
+        def entry_points_changed(self):
+            self._entry_points_txt = None
+
+        def read_text(self, filename):
+            if filename == 'METADATA':
+                return (f'Metadata-Version: 2.1\n'
+                        f'Name: {self.project_name}\n'
+                        f'Version: 0\n')
+            if filename == 'entry_points.txt':
+                if _collectors:
+                    started = time.perf_counter()
+                    try:
+                        return self._read_entry_points_txt()
+                    finally:
+                        _record(StatsEvent.READ, None, started)
+                return self._read_entry_points_txt()
+            return None
+
+        def _read_entry_points_txt(self):
+            if _context_entry_map(self):
+                return _render_entry_points(_find_entry_map(self))
+            if self._entry_points_txt is None:
+                self._entry_points_txt = _render_entry_points(self._ep_map)
+            return self._entry_points_txt
+
+        def locate_file(self, path):
+            import pathlib
+            return pathlib.Path(__file__).parent / path
+
+        def __repr__(self):
+            return f'<prybar scope {self.project_name!r}>'
+
+    return _MetadataDistribution
+
+
+def _render_entry_points(entry_map: dict) -> str:
+    """Render an entry map in the format of an entry_points.txt file."""
+    return ''.join(
+        f'[{group}]\n' + ''.join(
+            f'{name} = {_entrypoint_value(ep)[0]}\n'
+            for name, ep in entries.items()) + '\n'
+        for group, entries in entry_map.items())
+
+
+@lru_cache(maxsize=None)
+def _scope_distribution_type():
+    # Created on demand so that importing prybar doesn't import pkg_resources
+    import pkg_resources
+
+    class _ScopeDistribution(pkg_resources.Distribution):
+        """A pkg_resources Distribution holding the entry points of a scope.
+        """
+
+        def __init__(self, project_name: str):
+            super().__init__(location=__file__, project_name=project_name)
+            # Entry points registered for everyone. We never read entry
+            # points from metadata, as there is none.
+            self._ep_map = _EntryMap()
+            # The number of context-local registrations using this dist
+            self._local_count = 0
+
+        def get_entry_map(self, group: Optional[str] = None):
+            return _get_entry_map(self, group)
+
+    return _ScopeDistribution
+
+
+@lru_cache(maxsize=None)
+def _entrypoint_type():
+    import pkg_resources
+
+    class _PrybarEntryPoint(pkg_resources.EntryPoint):
+        """A pkg_resources EntryPoint created by prybar.
+
+        load() remembers the object it loads while the entry point is
+        registered. The registry forgets it when the entry point is added or
+        removed.
+        """
+        # Whether load() resolves the requirements of the entry point's dist
+        # by default. prybar's dists don't have any, but resolving them
+        # still takes time.
+        _require = True
+        _loaded = _NOT_LOADED
+        # The object registered with dynamic_entrypoint(obj=...), if any
+        _object = _NOT_LOADED
+
+        def load(self, require=True, *args, **kwargs):
+            if _collectors:
+                started = time.perf_counter()
+                try:
+                    return self._load(require, *args, **kwargs)
+                finally:
+                    _record(StatsEvent.LOAD, self.name, started)
+            return self._load(require, *args, **kwargs)
+
+        def _load(self, require=True, *args, **kwargs):
+            loaded = self._loaded
+            if loaded is not _NOT_LOADED:
+                return loaded
+
+            if not require or args or kwargs:
+                loaded = super().load(require, *args, **kwargs)
+            else:
+                if self._require:
+                    self.require()
+                loaded = self.resolve()
+            if self.dist is not None:
+                self._loaded = loaded
+            return loaded
+
+        def resolve(self):
+            if self._object is not _NOT_LOADED:
+                return self._object
+            if _collectors and self.module_name not in sys.modules:
+                # Time the import separately from the rest of the load
+                started = time.perf_counter()
+                try:
+                    __import__(self.module_name)
+                finally:
+                    _record(StatsEvent.IMPORT, self.module_name, started)
+            return super().resolve()
+
+        def _forget_loaded(self):
+            self._loaded = _NOT_LOADED
+
+    return _PrybarEntryPoint
+
+
+def _forget_loaded(entrypoint):
+    forget_loaded = getattr(entrypoint, '_forget_loaded', None)
+    if forget_loaded is not None:
+        forget_loaded()
+
+
+def _context_entry_map(dist) -> dict:
+    """Get the entry points registered in dist for the current context only.
+    """
+    if contextvars is None:  # pragma: no cover
+        return {}
+    return _context_entrypoints.get().get(id(dist), {})
+
+
+def _get_entry_map(dist, group: Optional[str] = None) -> dict:
+    """The get_entry_map() implementation of prybar's dists, which includes
+    the context-local entry points of the current context.
+    """
+    if _collectors:
+        started = time.perf_counter()
+        try:
+            return _find_entry_map(dist, group)
+        finally:
+            _record(StatsEvent.READ, group, started)
+    return _find_entry_map(dist, group)
+
+
+def _find_entry_map(dist, group: Optional[str] = None) -> dict:
+    local_entry_map = _context_entry_map(dist)
+    if not local_entry_map:
+        if group is not None:
+            return dist._ep_map.get(group, {})
+        return dist._ep_map
+
+    if group is not None:
+        return {**dist._ep_map.get(group, {}),
+                **local_entry_map.get(group, {})}
+    entry_map = {group: dict(entries)
+                 for group, entries in dist._ep_map.items()}
+    for group, entries in local_entry_map.items():
+        entry_map.setdefault(group, {}).update(entries)
+    return entry_map
+
+
+def _update_context_entrypoints(dist, add=(), remove=()):
+    """Add or remove entry points of dist which are visible in the current
+    context only.
+    """
+    context_entrypoints = dict(_context_entrypoints.get())
+    entry_map = {group: dict(entries) for group, entries in
+                 context_entrypoints.get(id(dist), {}).items()}
+
+    for group, entrypoint in add:
+        entry_map.setdefault(group, {})[entrypoint.name] = entrypoint
+    for group, entrypoint in remove:
+        entries = entry_map.get(group, {})
+        # This context may not be the one the entry point was added in
+        if entries.get(entrypoint.name) is entrypoint:
+            del entries[entrypoint.name]
+            if not entries:
+                del entry_map[group]
+
+    if entry_map:
+        context_entrypoints[id(dist)] = entry_map
+    else:
+        context_entrypoints.pop(id(dist), None)
+    _context_entrypoints.set(context_entrypoints)
+
+
+metadata_working_set = MetadataWorkingSet()
+"""The default :class:`MetadataWorkingSet` used by the
+``importlib.metadata`` backend."""
+
+
+def dynamic_entrypoint(
+        group: str, entrypoint: Optional[_EntrypointSpec] = None, *,
+        name: Optional[str] = None, module: Optional[str] = None,
+        attribute: Optional[str] = None, scope: Optional[str] = None,
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None,
+        backend: Optional[str] = None, context_local: bool = False,
+        position: Optional[int] = None, require: bool = True,
+        obj: Optional[object] = None,
+        preload: bool = False) -> DynamicEntrypoint:
+    """
+    :meth:`prybar.dynamic_entrypoint` registers and de-registers
+    :mod:`pkg_resources` `entry points`_ at runtime.
+
+    .. _entry points: https://setuptools.readthedocs.io/en/latest/pkg_resources.html#entry-points  # noqa: E501
+
+    It acts as a context manager and function decorator. The entrypoint is
+    registered within the ``with`` statement, or while the decorated function
+    is running. It can also be registered and de-registered manually using
+    its ``start()`` and ``stop()`` methods.
+
+    The context manager/decorator is re-entrant, i.e. a single instance can be
+    used in multiple with statements, or decorate multiple functions, and each
+    usage site can be entered multiple times while the same or other usage
+    sites are still in use. The entry point is registered once when the first
+    with block or decorated function is entered, and remains registered until
+    all with blocks/decorated functions have been left.
+
+    In contrast, the ``start()``/``stop()`` API immediatley registers and
+    deregisters the entry point. Calling ``start`` multiple times has no effect
+    after the first, neither does calling ``stop``.
+
+    Use of the ``start()``/``stop()`` API is incompatible with the context
+    manager/decorator API. An error will be raised if an attempt is made
+    to ``start()``/``stop()`` while a with block or decorated function is
+    active, and vice versa.
+
+    The ``group`` must always be provided as a string, but he entrypoint can
+    be specified in several ways:
+
+      - By providing a ``name`` and ``module``. The target in the module can be
+        specified with ``attribute`` if it differs from ``name``.
+      - By passing a function or class as ``entrypoint``. The ``name``,
+        ``module`` and ``attribute`` are then inferred automatically. The
+        ``name`` can be overriden.
+      - By passing a string to be parsed as ``entrypoint``. The format is the
+        same as used in setup.py, e.g.
+        ``"my_name = my_module.submodule:my_func"``.
+      - By passing a pre-created ``pkg_resources.EntryPoint`` (or
+        ``importlib.metadata.EntryPoint``) object as ``entrypoint``.
+      - By passing any object — including ones which can't be imported, like
+        lambdas, closures, ``functools.partial`` objects and instances — as
+        ``obj``, along with a ``name``. Loading the entry point returns the
+        object itself.
+
+    :param group: The name of the entrypoint group to register the entrypoint
+        under. For example, ``myproject.plugins``.
+    :param name: The name of the entrypoint.
+    :param module: The dotted path of the module the entrypoint references.
+    :param attribute: The name of the object within the module the entrypoint
+        references (defaults to name).
+    :param entrypoint: Either a function (or other object), or an entrypoint
+        string to parse, or a pre-created pkg_resources.Entrypoint object
+    :param scope: A name to scope your entrypoints within. ``group``, ``name``
+        pairs must be unique within a scope, but multiple entrypoints with
+        the same ``group`` and ``name`` can be created in different scopes. The
+        scope defaults to ``prybar.scope.default`` if not specified.
+
+        Note: internally this defines the name of the
         ``pkg_resources.Distribution`` that the entrypoint is registered under.
         If you specify a scope you should use your package's name as the prefix
         to avoid conflicts with entry points from other packages.
     :param working_set: The pkg_resources.WorkingSet to register entrypoints
-        in. Defaults to the default pkg_resources.working_set.
+        in. Defaults to the default pkg_resources.working_set. With the
+        ``importlib.metadata`` backend this is a
+        :class:`prybar.MetadataWorkingSet`, defaulting to
+        :data:`prybar.metadata_working_set`.
+    :param backend: ``'pkg_resources'`` to register the entrypoint in a
+        ``pkg_resources.WorkingSet``, or ``'importlib.metadata'`` to make it
+        visible to ``importlib.metadata.entry_points()``. Defaults to the
+        backend of ``working_set`` if it's specified, otherwise the backend
+        set with :meth:`prybar.set_default_backend` (initially
+        ``'pkg_resources'``).
+    :param context_local: If ``True`` the entrypoint is only visible in the
+        :mod:`contextvars` context it's registered in (and contexts copied
+        from it, such as those of asyncio tasks it creates, or functions run
+        with ``contextvars.copy_context().run()``), rather than to
+        everything using the working set. New threads start with an empty
+        context, so don't see it. This allows concurrent asyncio tasks to
+        each see their own set of entry points. A context-local
+        ``DynamicEntrypoint`` is activated separately in each context it's
+        entered (or started) in. Requires Python 3.7 or greater.
+    :param position: Where to place prybar's distributions in the
+        working set's ``entries`` (or in :data:`sys.meta_path` with the
+        ``importlib.metadata`` backend), e.g. ``0`` to put them first. By
+        default they go after all the installed distributions, so lookups
+        like ``next(iter_entry_points(group, name))`` for a dynamic entry
+        point have to check every installed distribution first. All of
+        prybar's distributions share one position, so this has no effect if
+        any are already registered in the working set. The original order is
+        restored when they're all removed.
+    :param require: If ``False``, the entry point's ``load()`` doesn't
+        resolve its distribution's requirements by default. prybar's
+        distributions never have any requirements, so this just skips the
+        work of checking. Only applies to the ``pkg_resources`` backend, and
+        to entry points prybar creates (i.e. not a ``pkg_resources.EntryPoint``
+        passed as ``entrypoint``).
+
+        Either way, ``load()`` remembers the object it loads while the entry
+        point is registered.
+    :param obj: An object to register directly, which the entry point's
+        ``load()`` returns without importing anything (with the
+        ``importlib.metadata`` backend it only looks up the already-imported
+        ``prybar`` module). Requires ``name``;
+        can't be used with ``entrypoint``, ``module`` or ``attribute``. The
+        entry point's value refers to the object as an attribute of
+        prybar's ``_objects`` namespace while the entry point exists (or
+        while the registration does, for ``importlib.metadata`` entry
+        points before Python 3.11, which can't be weakly referenced).
+    :param preload: If ``True``, import the entry point's module and check
+        that its target exists each time the entry point is registered,
+        before registering it. An error is raised by ``__enter__()`` or
+        ``start()`` rather than the first ``load()``, and the entry point
+        isn't registered. ``load()`` is still needed to get the target.
     :return: The context manager/decorator —
         a :class:`prybar.DynamicEntrypoint`, which also supports ``start()``
         and ``stop()`` methods.
     """
-    if not isinstance(group, str):
-        raise TypeError(f'group must be a string, got: {group!r}')
+    if not isinstance(group, str):
+        raise TypeError(f'group must be a string, got: {group!r}')
+
+    backend, working_set = _resolve_backend(backend, working_set)
+    entrypoint = _create_entrypoint(group, entrypoint, name=name,
+                                    module=module, attribute=attribute,
+                                    backend=backend, require=require,
+                                    obj=obj)
+
+    registration = DynamicEntrypoint(
+        group, entrypoint, working_set, _default_scope(scope),
+        context_local=context_local, position=position, preload=preload)
+    if obj is not None:
+        _keep_object(registration, entrypoint)
+    return registration
+
+
+def dynamic_entrypoints(
+        entrypoints: Iterable[Tuple[str, _EntrypointSpec]], *,
+        scope: Optional[str] = None,
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None,
+        backend: Optional[str] = None, context_local: bool = False,
+        position: Optional[int] = None, require: bool = True,
+        preload: bool = False) -> DynamicEntrypoints:
+    """
+    Register and de-register many entry points in one operation.
+
+    This behaves like :meth:`prybar.dynamic_entrypoint`, except that it
+    manages any number of entry points at once. The scope's distribution is
+    looked up once, all the entry points are inserted in a single pass when
+    the context is entered and removed in a single pass when it's left. This
+    makes it much cheaper than entering thousands of individual
+    ``dynamic_entrypoint()`` context managers.
+
+    Registration is all-or-nothing: if any of the entry points conflicts with
+    one already registered in the scope (or with another in the same batch),
+    a ``ValueError`` is raised and none of them are registered.
+
+    >>> from pkg_resources import iter_entry_points
+    >>> with dynamic_entrypoints([('example.types', 'int = builtins:int'),
+    ...                           ('example.types', 'str = builtins:str')]):
+    ...     sorted(ep.name for ep in iter_entry_points('example.types'))
+    ['int', 'str']
+
+    :param entrypoints: An iterable of ``(group, entrypoint)`` pairs. Each
+        ``entrypoint`` can be anything accepted by the ``entrypoint`` argument
+        of :meth:`prybar.dynamic_entrypoint` — a function or class, an
+        entrypoint string to parse, or a pre-created ``EntryPoint``.
+    :param scope: The scope to register all of the entrypoints in. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param working_set: The working set to register entrypoints in. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param backend: The backend to register entrypoints with. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param context_local: Register the entrypoints in the current
+        :mod:`contextvars` context only. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param position: Where to place prybar's distributions in the working
+        set. See :meth:`prybar.dynamic_entrypoint`.
+    :param require: If ``False``, the entrypoints' ``load()`` doesn't resolve
+        requirements by default. See :meth:`prybar.dynamic_entrypoint`.
+    :param preload: If ``True``, import the entrypoints' modules in parallel
+        (using up to 8 threads) and check that their targets exist, before
+        registering them. If any can't be loaded, an ``ImportError`` is
+        raised for the first and none are registered. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :return: The context manager/decorator —
+        a :class:`prybar.DynamicEntrypoints`, which also supports ``start()``
+        and ``stop()`` methods.
+    """
+    backend, working_set = _resolve_backend(backend, working_set)
+
+    resolved = []
+    for group, entrypoint in entrypoints:
+        if not isinstance(group, str):
+            raise TypeError(f'group must be a string, got: {group!r}')
+        if entrypoint is None:
+            raise TypeError(f'entrypoint must be specified for group '
+                            f'{group!r}')
+        resolved.append(
+            (group, _create_entrypoint(group, entrypoint, backend=backend,
+                                       require=require)))
+
+    return DynamicEntrypoints(resolved, working_set, _default_scope(scope),
+                              context_local=context_local, position=position,
+                              preload=preload)
+
+
+def from_manifest(
+        manifest: Union[str, 'os.PathLike', IO], *,
+        format: Optional[str] = None, scope: Optional[str] = None,
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None,
+        backend: Optional[str] = None, context_local: bool = False,
+        position: Optional[int] = None, require: bool = True,
+        preload: bool = False) -> DynamicEntrypoints:
+    """
+    Register all the entry points declared in a manifest file in one batch.
+
+    The manifest can be an ``entry_points.txt`` file, as found in a
+    ``.dist-info`` directory::
+
+        [myproject.plugins]
+        a = myproject.plugins:a
+        b = myproject.plugins:b
+
+    or a ``pyproject.toml`` file, whose ``[project.entry-points]``,
+    ``[project.scripts]`` and ``[project.gui-scripts]`` tables are used.
+    ``entry_points.txt`` files are parsed a line at a time rather than read
+    into memory all at once. TOML can't be parsed incrementally, so
+    ``pyproject.toml`` files are read whole, using :mod:`tomllib` (or the
+    ``tomli`` package before Python 3.11).
+
+    :param manifest: The path of the manifest, or a file object to read it
+        from.
+    :param format: ``'ini'`` for ``entry_points.txt`` or ``'toml'`` for
+        ``pyproject.toml``. Defaults to ``'toml'`` if the manifest's file name
+        ends with ``.toml``, otherwise ``'ini'``.
+    :param scope: The scope to register all of the entrypoints in. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param working_set: See :meth:`prybar.dynamic_entrypoints`.
+    :param backend: See :meth:`prybar.dynamic_entrypoints`.
+    :param context_local: See :meth:`prybar.dynamic_entrypoints`.
+    :param position: See :meth:`prybar.dynamic_entrypoints`.
+    :param require: See :meth:`prybar.dynamic_entrypoints`.
+    :param preload: See :meth:`prybar.dynamic_entrypoints`.
+    :return: A :class:`prybar.DynamicEntrypoints` registering the manifest's
+        entry points.
+    """
+    if format is None:
+        name = getattr(manifest, 'name', manifest)
+        if isinstance(name, (str, os.PathLike)):
+            format = 'toml' if os.fspath(name).endswith('.toml') else 'ini'
+        else:
+            format = 'ini'
+    if format == 'ini':
+        entrypoints = _read_manifest(manifest, _parse_ini_manifest)
+    elif format == 'toml':
+        entrypoints = _read_manifest(manifest, _parse_toml_manifest)
+    else:
+        raise ValueError(f"unknown manifest format: {format!r}, expected "
+                         f"'ini' or 'toml'")
+
+    return dynamic_entrypoints(
+        entrypoints, scope=scope, working_set=working_set, backend=backend,
+        context_local=context_local, position=position, require=require,
+        preload=preload)
+
+
+def _read_manifest(manifest, parse: Callable[[IO, str], Iterator]
+                   ) -> Iterator[Tuple[str, str]]:
+    if isinstance(manifest, (str, os.PathLike)):
+        with open(manifest, 'rb') as f:
+            yield from parse(f, os.fspath(manifest))
+    else:
+        yield from parse(manifest, getattr(manifest, 'name', repr(manifest)))
+
+
+def _parse_ini_manifest(f: IO, source: str) -> Iterator[Tuple[str, str]]:
+    """Generate (group, entrypoint string) pairs from the lines of an
+    entry_points.txt file.
+    """
+    group = None
+    for lineno, line in enumerate(f, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line[0] == '[':
+            if line[-1] != ']':
+                raise ValueError(f'{source}:{lineno}: invalid section '
+                                 f'header: {line!r}')
+            group = line[1:-1].strip()
+        elif group is None:
+            raise ValueError(f'{source}:{lineno}: entry point outside of a '
+                             f'group section: {line!r}')
+        elif '=' not in line:
+            raise ValueError(f'{source}:{lineno}: expected an entry point '
+                             f'like \'name = module:attrs\': {line!r}')
+        else:
+            yield group, line
+
+
+def _parse_toml_manifest(f: IO, source: str) -> Iterator[Tuple[str, str]]:
+    """Generate (group, entrypoint string) pairs from the entry point tables
+    of a pyproject.toml file.
+    """
+    try:
+        import tomllib
+    except ImportError:  # pragma: no cover
+        # Python < 3.11
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ImportError('reading pyproject.toml manifests requires the '
+                              'tomli package before Python 3.11') from None
+
+    content = f.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    project = tomllib.loads(content).get('project', {})
+
+    tables = [('console_scripts', project.get('scripts', {})),
+              ('gui_scripts', project.get('gui-scripts', {}))]
+    tables.extend(project.get('entry-points', {}).items())
+    for group, entries in tables:
+        for name, value in entries.items():
+            if not isinstance(value, str):
+                raise ValueError(f'{source}: entry point {name!r} in group '
+                                 f'{group!r} is not a string: {value!r}')
+            yield group, f'{name} = {value}'
+
+
+def isolated_working_set(
+        working_set: Optional['pkg_resources.WorkingSet'] = None
+        ) -> 'pkg_resources.WorkingSet':
+    """
+    Create a ``pkg_resources.WorkingSet`` which contains everything in an
+    existing working set, but which can be modified without affecting it.
+
+    Registering entry points in the isolated working set (by passing it as
+    ``working_set``) makes them visible only to code using the isolated
+    working set. Unlike creating a new ``pkg_resources.WorkingSet()``, this
+    doesn't scan ``sys.path`` — the isolated working set reads through to
+    the existing one, and only copies the parts that get modified. So it's
+    cheap enough to create one per test.
+
+    The existing working set's ``entries`` are copied when the isolated one
+    is created. Distributions added to the existing working set afterwards
+    are visible in the isolated one only if they're in one of those entries.
+    When entry points are first registered in the isolated working set under
+    a scope which also exists in the existing one, the scope is copied along
+    with its entry points. After that, changes to the scope in the existing
+    working set aren't visible in the isolated one. Scopes which haven't been
+    copied are read through, so they appear and disappear in the isolated
+    working set as they're registered and removed in the existing one.
+
+    The isolated working set doesn't call the existing one's callbacks, so
+    distributions added to it are not added to ``sys.path``.
+
+    :param working_set: The ``pkg_resources.WorkingSet`` to base the isolated
+        working set on. Defaults to ``pkg_resources.working_set``.
+    :return: The isolated working set.
+    """
+    import pkg_resources
+
+    if working_set is None:
+        working_set = pkg_resources.working_set
+    elif not isinstance(working_set, pkg_resources.WorkingSet):
+        raise TypeError(f'working_set must be a pkg_resources.WorkingSet, '
+                        f'got: {working_set!r}')
+
+    with _lock:
+        # The registry replaces the base's by_key, which the isolated working
+        # set has to read through to
+        _registry_for(working_set)
+    isolated = pkg_resources.WorkingSet([])
+    isolated.entries = list(working_set.entries)
+    isolated.entry_keys = _Overlay({}, working_set.entry_keys)
+    isolated.by_key = _Overlay({}, working_set.by_key)
+    # Added in setuptools 62.3
+    if hasattr(working_set, 'normalized_to_canonical_keys'):
+        isolated.normalized_to_canonical_keys = _Overlay(
+            {}, working_set.normalized_to_canonical_keys)
+    return isolated
+
+
+@contextmanager
+def only_dynamic(groups: Optional[Iterable[str]] = None,
+                 working_set: Optional['pkg_resources.WorkingSet'] = None):
+    """
+    Hide the entry points of installed distributions, so that only entry
+    points registered with prybar are discovered.
+
+    Within the ``with`` block, the distributions in ``working_set`` which
+    weren't created by prybar report no entry points in ``groups``. This
+    makes discovery independent of what happens to be installed, which is
+    useful when testing a plugin host. Everything is put back as it was on
+    exit.
+
+    >>> import pkg_resources
+    >>> with only_dynamic(), dynamic_entrypoint(
+    ...         'console_scripts', name='example', module='builtins',
+    ...         attribute='print'):
+    ...     [ep.name for ep in pkg_resources.iter_entry_points(
+    ...         'console_scripts')]
+    ['example']
+
+    Distributions added to the working set within the block aren't hidden.
+    In a working set created by :meth:`prybar.isolated_working_set`, the
+    distributions it shares with its base working set are copied before
+    being hidden, so the base working set's entry points stay visible.
+
+    :param groups: The groups to hide installed entry points in. Defaults to
+        all groups.
+    :param working_set: The ``pkg_resources.WorkingSet`` to hide installed
+        entry points in. Defaults to ``pkg_resources.working_set``.
+    """
+    import pkg_resources
+
+    if working_set is None:
+        working_set = pkg_resources.working_set
+    elif not isinstance(working_set, pkg_resources.WorkingSet):
+        raise TypeError(f'working_set must be a pkg_resources.WorkingSet, '
+                        f'got: {working_set!r}')
+    if groups is not None:
+        if isinstance(groups, str):
+            raise TypeError(f'groups must be an iterable of str, not a str: '
+                            f'{groups!r}')
+        groups = frozenset(groups)
+
+    masked = []
+    copied = []
+    with _lock:
+        try:
+            by_key = working_set.by_key
+            for key, dist in list(by_key.items()):
+                if dist.location == __file__:
+                    continue
+                if _is_inherited(by_key, key):
+                    # The dist is shared with the base working set, so mask
+                    # a copy of it to leave the base unaffected.
+                    dist = by_key.maps[0][key] = copy.copy(dist)
+                    copied.append((key, dist))
+                previous = vars(dist).get('get_entry_map')
+                dist.get_entry_map = mask = _hide_entry_map(
+                    dist.get_entry_map, groups)
+                masked.append((dist, previous, mask))
+        finally:
+            _entrypoints_changed()
+
+    try:
+        yield
+    finally:
+        with _lock:
+            for dist, previous, mask in reversed(masked):
+                if previous is not None:
+                    dist.get_entry_map = previous
+                elif vars(dist).get('get_entry_map') is mask:
+                    del dist.get_entry_map
+            for key, dist in copied:
+                if working_set.by_key.maps[0].get(key) is dist:
+                    del working_set.by_key.maps[0][key]
+            _entrypoints_changed()
+
+
+def _hide_entry_map(get_entry_map: Callable,
+                    groups: Optional[frozenset]) -> Callable:
+    """Wrap a dist's get_entry_map() to hide the entry points in groups (or
+    all groups).
+    """
+    if groups is None:
+        return lambda group=None: {}
+
+    def hidden_get_entry_map(group: Optional[str] = None):
+        if group is None:
+            return {group: entries
+                    for group, entries in get_entry_map().items()
+                    if group not in groups}
+        if group in groups:
+            return {}
+        return get_entry_map(group)
+    return hidden_get_entry_map
+
+
+class ActiveRegistration(namedtuple(
+        'ActiveRegistration', 'registration scope working_set caller')):
+    """
+    A registration which is active, as returned by :meth:`prybar.active`.
+
+    :ivar registration: The :class:`prybar.DynamicEntrypoint` or
+        :class:`prybar.DynamicEntrypoints`.
+    :ivar scope: The scope its entry points are registered in.
+    :ivar working_set: The working set its entry points are registered in.
+    :ivar caller: Where it was activated from (by entering its first
+        ``with`` block or calling ``start()``), as ``'file:line in
+        function'``.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        entrypoints = _registration_entrypoints(self.registration)
+        names = ', '.join(f'{group}:{entrypoint.name}'
+                          for group, entrypoint in entrypoints[:3])
+        if len(entrypoints) > 3:
+            names += f' and {len(entrypoints) - 3} more'
+        return (f'{names} in scope {self.scope!r}, registered at '
+                f'{self.caller}')
+
+
+def _registration_entrypoints(registration) -> tuple:
+    if isinstance(registration, DynamicEntrypoint):
+        return ((registration.group, registration.entrypoint),)
+    return registration.entrypoints
+
+
+def active() -> List[ActiveRegistration]:
+    """
+    Get the registrations which are currently active, in the order they
+    were activated.
+
+    Context-local registrations aren't included.
+
+    :return: A list of :class:`prybar.ActiveRegistration`.
+    """
+    with _lock:
+        return list(_active_registrations.values())
+
+
+def stop_all(scope: Optional[str] = None) -> List[ActiveRegistration]:
+    """
+    Deactivate every active registration, or those in one scope, removing
+    their entry points.
+
+    This is intended for recovering from registrations which were never
+    stopped, e.g. because a test failed between ``start()`` and ``stop()``.
+    Registrations stopped this way can be used again, but exiting a ``with``
+    block of one which was active raises ``RuntimeError``, as it's no
+    longer active.
+
+    Context-local registrations aren't stopped.
+
+    :param scope: Only stop registrations in this scope, i.e. those whose
+        scope shares a distribution with it in their working set.
+    :return: The :class:`prybar.ActiveRegistration` of each registration
+        stopped.
+    """
+    stopped = []
+    for registration in active():
+        # Scopes are the same if they share a dist, which depends on the
+        # backend's normalisation of names
+        working_set = registration.working_set
+        if scope is not None and (_scope_key(working_set, registration.scope)
+                                  != _scope_key(working_set, scope)):
+            continue
+        if registration.registration._force_stop():
+            stopped.append(registration)
+    return stopped
+
+
+@contextmanager
+def detect_leaks(stop: bool = True) -> Iterator[None]:
+    """
+    Check that registrations activated within the ``with`` block are
+    deactivated by the end of it.
+
+    If any are still active, a ``RuntimeError`` listing them and where they
+    were activated from is raised. This makes it easy to find the test or
+    code path which leaked them:
+
+    >>> with detect_leaks():
+    ...     dynamic_entrypoint('example.types', 'int = builtins:int').start()
+    Traceback (most recent call last):
+    ...
+    RuntimeError: 1 prybar registration was not stopped:
+      example.types:int in scope 'prybar.scope.default', registered at ...
+
+    :param stop: Stop the leaked registrations, as :meth:`prybar.stop_all`
+        does, before raising the error. If the block raises an exception,
+        they are stopped but no error is raised for them.
+    """
+    with _lock:
+        before = set(_active_registrations)
+    try:
+        yield
+    except BaseException:
+        if stop:
+            _stop_leaked(before)
+        raise
+    leaked = _stop_leaked(before) if stop else [
+        registration for registration in active()
+        if registration.registration not in before]
+    if leaked:
+        raise RuntimeError(
+            f'{len(leaked)} prybar registration'
+            f'{" was" if len(leaked) == 1 else "s were"} not stopped:\n' +
+            '\n'.join(f'  {registration}' for registration in leaked))
+
+
+def _stop_leaked(before: set) -> List[ActiveRegistration]:
+    return [registration for registration in active()
+            if registration.registration not in before and
+            registration.registration._force_stop()]
+
+
+class RegistrationSnapshot:
+    """
+    A picklable record of the entry points registered with prybar, which
+    can be registered again in another process. Create one with
+    :meth:`prybar.snapshot_registrations`.
+    """
+
+    def __init__(self, entrypoints: Iterable[tuple]):
+        # (backend, scope, group, name, value, obj) tuples. obj is None unless
+        # the entry point was registered with obj.
+        self.entrypoints = tuple(entrypoints)
+
+    def __repr__(self):
+        return (f'<{type(self).__name__} of {len(self.entrypoints)} entry '
+                f'points>')
+
+    def apply(self) -> List[_DynamicRegistration]:
+        """
+        Register the snapshot's entry points in this process.
+
+        Entry points which are already registered, for example because this
+        process was forked from the one the snapshot was taken in, are
+        skipped.
+
+        :return: The started registrations. Stop them to de-register the
+            entry points again.
+        """
+        registered = {entry[:4] for entry in _registered_entrypoints()}
+        # Registrations, or lists of entry points to register in a batch, in
+        # the order of the snapshot.
+        pending = []
+        batches = {}
+        for backend, scope, group, name, value, obj in self.entrypoints:
+            if (backend, scope, group, name) in registered:
+                continue
+            if obj is not None:
+                pending.append(dynamic_entrypoint(
+                    group, name=name, obj=obj, scope=scope, backend=backend))
+                continue
+            if (backend, scope) not in batches:
+                batches[backend, scope] = []
+                pending.append((backend, scope, batches[backend, scope]))
+            batches[backend, scope].append((group, f'{name} = {value}'))
+        registrations = [
+            dynamic_entrypoints(item[2], scope=item[1], backend=item[0])
+            if isinstance(item, tuple) else item
+            for item in pending]
+
+        started = []
+        try:
+            for registration in registrations:
+                registration.start()
+                started.append(registration)
+        except BaseException:
+            for registration in reversed(started):
+                registration.stop()
+            raise
+        return registrations
+
+
+def snapshot_registrations() -> RegistrationSnapshot:
+    """
+    Take a :class:`prybar.RegistrationSnapshot` of the entry points currently
+    registered with prybar in ``pkg_resources.working_set`` and
+    :data:`prybar.metadata_working_set`.
+
+    Context-local entry points and entry points registered in other working
+    sets aren't included. Entry points registered with ``obj`` are included
+    only if their object can be pickled. Those which can't (such as
+    lambdas) are left out with a ``RuntimeWarning``, rather than making the
+    whole snapshot unpicklable.
+    """
+    import pickle
+    import warnings
+
+    entrypoints = []
+    for entry in _registered_entrypoints():
+        backend, scope, group, name, value, obj = entry
+        if obj is not None:
+            try:
+                pickle.dumps(obj)
+            except Exception as e:
+                warnings.warn(
+                    f'entry point {name!r} in group {group!r} (scope '
+                    f'{scope!r}) is not included in the snapshot, as its '
+                    f'object can\'t be pickled: {e}', RuntimeWarning,
+                    stacklevel=2)
+                continue
+        entrypoints.append(entry)
+    return RegistrationSnapshot(entrypoints)
+
+
+# The registrations applied by init_worker(), which must be kept alive
+_worker_registrations = []
+
+
+def init_worker(snapshot: RegistrationSnapshot):
+    """
+    Register the entry points in a :class:`prybar.RegistrationSnapshot` for
+    the lifetime of the current process.
+
+    This is intended to be used as the ``initializer`` of a
+    ``concurrent.futures.ProcessPoolExecutor`` or ``multiprocessing.Pool``, so
+    that worker processes see the same dynamic entry points as the process
+    that created them::
+
+        ProcessPoolExecutor(initializer=prybar.init_worker,
+                            initargs=(prybar.snapshot_registrations(),))
+    """
+    if not _worker_registrations:
+        # Stop them while the interpreter is still intact
+        atexit.register(_stop_worker_registrations)
+    _worker_registrations.extend(snapshot.apply())
+
+
+def _stop_worker_registrations():
+    while _worker_registrations:
+        _worker_registrations.pop().stop()
+
+
+def _registered_entrypoints() -> Iterator[tuple]:
+    """Get (backend, scope, group, name, value, obj) tuples for the entry
+    points registered in the default working sets.
+    """
+    working_sets = [(IMPORTLIB_METADATA, metadata_working_set)]
+    # pkg_resources can't contain registrations if it hasn't been imported
+    pkg_resources = sys.modules.get('pkg_resources')
+    if pkg_resources is not None:
+        working_sets.insert(0, (PKG_RESOURCES, pkg_resources.working_set))
+
+    entrypoints = []
+    with _lock:
+        for backend, working_set in working_sets:
+            for dist in _scope_dists(working_set):
+                for group, entries in dist._ep_map.items():
+                    for name, entrypoint in entries.items():
+                        value, obj = _entrypoint_value(entrypoint)
+                        entrypoints.append((backend, dist.project_name, group,
+                                            name, value, obj))
+    return iter(entrypoints)
+
+
+def _scope_dists(working_set) -> list:
+    """Get the dists prybar has created in a working set."""
+    dists = list(working_set.by_key.values())
+    if isinstance(working_set, MetadataWorkingSet):
+        return dists
+    return [dist for dist in dists if dist.location == __file__]
+
+
+def _scope_key(working_set, scope: str) -> str:
+    """Get the key of scope's dist in a working set's by_key."""
+    if isinstance(working_set, MetadataWorkingSet):
+        return _canonical_name(scope)
+    import pkg_resources
+    return pkg_resources.safe_name(scope).lower()
+
+
+def _scope_dist(working_set, scope: str):
+    """Get the dist prybar has created for scope in a working set, if any."""
+    dist = working_set.by_key.get(_scope_key(working_set, scope))
+    if isinstance(working_set, MetadataWorkingSet):
+        return dist
+    if dist is not None and dist.location == __file__:
+        return dist
+    return None
+
+
+class MaterialisedEntrypoints:
+    """
+    A directory of ``.dist-info`` directories mirroring the scopes prybar has
+    registered in a working set, which is kept up to date as entry points
+    are registered and de-registered. Create one with
+    :meth:`prybar.materialise_entrypoints`.
+
+    Adding :attr:`path` to ``PYTHONPATH`` makes the entry points visible to
+    ``pkg_resources`` and ``importlib.metadata`` in other processes.
+    """
+
+    def __init__(self, working_set, directory: Optional[str] = None):
+        self.working_set = working_set
+        self._owns_directory = directory is None
+        if directory is None:
+            import tempfile
+            directory = tempfile.mkdtemp(prefix='prybar-')
+        #: The directory containing the ``.dist-info`` directories.
+        self.path = os.fspath(directory)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._written = set()
+
+        # Subscribe first so no changes are missed; updating is idempotent
+        self._unsubscribe = _subscribe_batches(self._on_events)
+        with _lock:
+            scopes = [dist.project_name
+                      for dist in _scope_dists(working_set)]
+        for scope in scopes:
+            self._update(scope)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} at {self.path!r}>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def env(self, environ: Optional[dict] = None) -> dict:
+        """
+        Get a copy of ``environ`` (defaulting to :data:`os.environ`) with
+        :attr:`path` prepended to ``PYTHONPATH``, for passing to a
+        subprocess.
+        """
+        env = dict(os.environ if environ is None else environ)
+        pythonpath = env.get('PYTHONPATH')
+        env['PYTHONPATH'] = (self.path if not pythonpath
+                             else self.path + os.pathsep + pythonpath)
+        return env
+
+    def close(self):
+        """Stop updating the directory, and remove what was written to it."""
+        self._unsubscribe()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            import shutil
+            if self._owns_directory:
+                shutil.rmtree(self.path, ignore_errors=True)
+            else:
+                for name in self._written:
+                    shutil.rmtree(os.path.join(self.path, name),
+                                  ignore_errors=True)
+            self._written.clear()
+
+    def _on_events(self, events: List['EntrypointEvent']):
+        # Rewrite each scope once per change, not once per entry point
+        scopes = dict.fromkeys(event.scope for event in events
+                               if event.working_set is self.working_set)
+        for scope in scopes:
+            self._update(scope)
+
+    def _update(self, scope: str):
+        """Rewrite the dist-info of scope to match its current state."""
+        with self._lock:
+            if self._closed:
+                return
+            with _lock:
+                dist = _scope_dist(self.working_set, scope)
+                entry_map = {} if dist is None else {
+                    group: {name: ep for name, ep in entries.items()
+                            # Objects can't be loaded in other processes
+                            if _entrypoint_value(ep)[1] is None}
+                    for group, entries in dist._ep_map.items()}
+            entry_map = {group: entries
+                         for group, entries in entry_map.items() if entries}
+
+            name = (f'{_canonical_name(scope).replace("-", "_")}'
+                    f'-0.dist-info')
+            dist_info = os.path.join(self.path, name)
+            if not entry_map:
+                if name in self._written:
+                    import shutil
+                    shutil.rmtree(dist_info, ignore_errors=True)
+                    self._written.discard(name)
+                return
+
+            if name not in self._written:
+                os.makedirs(dist_info, exist_ok=True)
+                self._write(dist_info, 'METADATA',
+                            f'Metadata-Version: 2.1\nName: {scope}\n'
+                            f'Version: 0\n')
+                self._written.add(name)
+            self._write(dist_info, 'entry_points.txt',
+                        _render_entry_points(entry_map))
+
+    @staticmethod
+    def _write(directory: str, filename: str, text: str):
+        import tempfile
+        # Replace the file atomically so readers never see part of it
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, os.path.join(directory, filename))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def materialise_entrypoints(
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None, *,
+        backend: Optional[str] = None,
+        directory: Optional[str] = None) -> MaterialisedEntrypoints:
+    """
+    Write the entry points registered with prybar to disk as ``.dist-info``
+    directories, so that other processes can discover them.
+
+    A ``.dist-info`` (containing ``METADATA`` and ``entry_points.txt``) is
+    written for each scope with entry points, and rewritten or removed as
+    entry points in the scope are registered and de-registered. Pass
+    :meth:`MaterialisedEntrypoints.env` to a subprocess (or add
+    :attr:`MaterialisedEntrypoints.path` to its ``PYTHONPATH``) to let it see
+    them:
+
+    >>> import subprocess, sys
+    >>> with materialise_entrypoints() as materialised, dynamic_entrypoint(
+    ...         'example.hash_types', name='sha256', module='hashlib'):
+    ...     print(subprocess.check_output(
+    ...         [sys.executable, '-c',
+    ...          'from importlib.metadata import entry_points; '
+    ...          'eps = entry_points(group="example.hash_types"); '
+    ...          'print(eps["sha256"].value)'],
+    ...         env=materialised.env(), text=True).strip())
+    hashlib:sha256
+
+    Context-local entry points and entry points registered with ``obj`` are
+    not written.
+
+    :param working_set: The working set whose entry points are written. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param backend: The backend of the working set. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param directory: The directory to write to. Defaults to a new temporary
+        directory, which is removed when the
+        :class:`prybar.MaterialisedEntrypoints` is closed.
+    :return: A :class:`prybar.MaterialisedEntrypoints`, which can be used as
+        a context manager to close it.
+    """
+    backend, working_set = _resolve_backend(backend, working_set)
+    return MaterialisedEntrypoints(working_set, directory)
+
+
+# The format version of files written by export_index()
+_INDEX_VERSION = 1
+
+
+def export_index(path: Union[str, 'os.PathLike'],
+                 working_set: Optional['pkg_resources.WorkingSet'] = None):
+    """
+    Write the entry points of every distribution in a working set —
+    installed and dynamic — to an index file, which
+    :meth:`prybar.load_index` can load much faster than ``pkg_resources``
+    can be imported and find them by scanning ``sys.path``.
+
+    This is intended to be run when building an application, so that it
+    can discover entry points at startup using the index. The index is a
+    JSON file.
+
+    Only distributions with entry points are included. Context-local entry
+    points and entry points registered with ``obj`` aren't included.
+
+    :param path: The file to write the index to.
+    :param working_set: The ``pkg_resources.WorkingSet`` whose entry points
+        are written. Defaults to ``pkg_resources.working_set``.
+    """
+    import pkg_resources
+
+    if working_set is None:
+        working_set = pkg_resources.working_set
+
+    distributions = []
+    with _lock:
+        for dist in working_set:
+            if dist.location == __file__:
+                # The location of prybar's dists doesn't mean anything in
+                # other processes.
+                location, version = None, None
+                entry_map = dist._ep_map
+            else:
+                location = dist.location
+                try:
+                    version = dist.version
+                except ValueError:
+                    version = None
+                entry_map = dist.get_entry_map()
+
+            entry_points = {}
+            for group, entries in entry_map.items():
+                for name, entrypoint in entries.items():
+                    value, obj = _entrypoint_value(entrypoint)
+                    if obj is None:
+                        entry_points.setdefault(group, {})[name] = value
+            if entry_points:
+                distributions.append({
+                    'name': dist.project_name, 'version': version,
+                    'location': location, 'entry_points': entry_points})
+
+    import json
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'version': _INDEX_VERSION, 'distributions': distributions},
+                  f, separators=(',', ':'))
+
+
+def load_index(path: Union[str, 'os.PathLike']) -> 'EntrypointIndex':
+    """
+    Load an index written by :meth:`prybar.export_index`.
+
+    Neither ``pkg_resources`` nor ``importlib.metadata`` is imported, and
+    nothing is scanned, so a freshly started process can find its entry
+    points in a fraction of the time it takes to import ``pkg_resources``
+    alone. Entry points are only parsed when their group is first looked
+    up.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'index.json')
+    >>> with dynamic_entrypoint('example.types', 'int = builtins:int'):
+    ...     export_index(path)
+    >>> index = load_index(path)
+    >>> [ep.load() for ep in index.iter_entry_points('example.types')]
+    [<class 'int'>]
+
+    :param path: The index file to read.
+    :return: An :class:`prybar.EntrypointIndex`.
+    """
+    import json
+
+    with open(path, encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get('version') != _INDEX_VERSION:
+        raise ValueError(f'unsupported index version: '
+                         f'{index.get("version")!r}, expected '
+                         f'{_INDEX_VERSION}')
+    return EntrypointIndex(os.fspath(path), index['distributions'])
+
+
+class IndexedEntrypoint(namedtuple(
+        'IndexedEntrypoint', 'name value group distribution')):
+    """
+    An entry point read from an index by :meth:`prybar.load_index`.
+
+    This has the same ``name``, ``value`` and ``group`` attributes as an
+    ``importlib.metadata.EntryPoint``, and ``load()`` imports its target in
+    the same way.
+
+    :ivar distribution: The name of the distribution it belongs to.
+    """
+    __slots__ = ()
+
+    @property
+    def module(self) -> str:
+        """The name of the module containing the entry point's target."""
+        return self.value.partition('[')[0].partition(':')[0].strip()
+
+    @property
+    def attr(self) -> str:
+        """The dotted path of the target within its module (may be empty)."""
+        return self.value.partition('[')[0].partition(':')[2].strip()
+
+    def load(self):
+        """Import the entry point's module and get its target."""
+        __import__(self.module)
+        target = sys.modules[self.module]
+        for attr in self.attr.split('.') if self.attr else ():
+            target = getattr(target, attr)
+        return target
+
+
+class EntrypointIndex:
+    """
+    The entry points of an index written by :meth:`prybar.export_index`, as
+    returned by :meth:`prybar.load_index`.
+
+    :ivar path: The path of the index file.
+    """
+
+    def __init__(self, path: str, distributions: List[dict]):
+        self.path = path
+        self._distributions = distributions
+        self._groups = {}
+
+    def __repr__(self):
+        return f'<prybar.EntrypointIndex {self.path!r}>'
+
+    def get_group(self, group: str) -> Tuple[IndexedEntrypoint, ...]:
+        """
+        Get all the entry points in a group, in the order
+        ``pkg_resources`` would find them.
+
+        :param group: The group to get entry points from.
+        :return: A tuple of :class:`prybar.IndexedEntrypoint`.
+        """
+        try:
+            return self._groups[group]
+        except KeyError:
+            pass
+        entrypoints = self._groups[group] = tuple(
+            IndexedEntrypoint(name, value, group, dist['name'])
+            for dist in self._distributions
+            for name, value in dist['entry_points'].get(group, {}).items())
+        return entrypoints
+
+    def iter_entry_points(self, group: str, name: Optional[str] = None
+                          ) -> Iterator[IndexedEntrypoint]:
+        """
+        Iterate over the entry points in a group, like
+        ``pkg_resources.iter_entry_points()``.
+
+        :param group: The group to get entry points from.
+        :param name: If specified, only entry points with this name are
+            included.
+        """
+        entrypoints = self.get_group(group)
+        if name is None:
+            return iter(entrypoints)
+        return (ep for ep in entrypoints if ep.name == name)
+
+    def to_working_set(self) -> 'pkg_resources.WorkingSet':
+        """
+        Create a ``pkg_resources.WorkingSet`` containing the index's
+        distributions, for code which needs ``pkg_resources`` entry points.
+
+        The working set is created without scanning ``sys.path``, but
+        importing ``pkg_resources`` does scan it, so this is no faster to
+        start up than using ``pkg_resources.working_set``. The distributions
+        don't have any metadata besides their name, version and entry
+        points, so loading their entry points doesn't check their
+        requirements.
+
+        :return: A new ``pkg_resources.WorkingSet``.
+        """
+        import pkg_resources
+
+        working_set = pkg_resources.WorkingSet([])
+        dist_type = _index_distribution_type()
+        for entry in self._distributions:
+            working_set.add(dist_type(
+                # Use the index's location for prybar's dists
+                location=entry['location'] or self.path,
+                project_name=entry['name'], version=entry['version'],
+                entry_points=entry['entry_points']))
+        return working_set
+
+
+@lru_cache(maxsize=None)
+def _index_distribution_type():
+    import pkg_resources
+
+    class _IndexDistribution(pkg_resources.Distribution):
+        """A pkg_resources Distribution whose entry points are read from an
+        index written by export_index().
+        """
+
+        def __init__(self, *, location: str, project_name: str,
+                     version: Optional[str], entry_points: dict):
+            super().__init__(location=location, project_name=project_name,
+                             version=version)
+            # {group: {name: value}}, parsed into _ep_map on demand
+            self._index_entry_points = entry_points
+            self._ep_map = {}
+
+        def get_entry_map(self, group: Optional[str] = None):
+            if group is None:
+                for group in self._index_entry_points:
+                    self.get_entry_map(group)
+                return self._ep_map
+
+            try:
+                return self._ep_map[group]
+            except KeyError:
+                pass
+            entries = {}
+            for name, value in self._index_entry_points.get(group, {}).items():
+                _, module, attrs, extras = _parse_pkg_resources_entrypoint(
+                    f'{name} = {value}')
+                entries[name] = pkg_resources.EntryPoint(
+                    name, module, attrs, extras, self)
+            if entries:
+                self._ep_map[group] = entries
+            return entries
+
+    return _IndexDistribution
+
+
+def _entrypoint_value(entrypoint) -> Tuple[str, Optional[object]]:
+    """Get the value of an entry point, and the object it was registered
+    with if it was registered with obj.
+    """
+    if _is_metadata_entrypoint(entrypoint):
+        value = entrypoint.value
+    else:
+        value = str(entrypoint).partition(' = ')[2]
+    prefix = f'{__name__}:_objects.'
+    if value.startswith(prefix):
+        return value, getattr(_objects, value[len(prefix):])
+    return value, None
+
+
+def _create_entrypoint(
+        group: str, entrypoint: Optional[_EntrypointSpec] = None, *,
+        name: Optional[str] = None, module: Optional[str] = None,
+        attribute: Optional[str] = None, backend: str = PKG_RESOURCES,
+        require: bool = True, obj: Optional[object] = None):
+    if obj is not None:
+        if not (entrypoint is None and module is None and attribute is None):
+            raise TypeError('can\'t specify entrypoint, module_name or '
+                            'attribute alongside obj')
+        if name is None:
+            raise TypeError('name must be specified with obj')
+        return _create_object_entrypoint(group, obj, name=name,
+                                         backend=backend, require=require)
+    if backend == IMPORTLIB_METADATA:
+        return _create_metadata_entrypoint(
+            group, entrypoint, name=name, module=module, attribute=attribute)
+
+    import pkg_resources
+    entrypoint_type = _entrypoint_type()
 
     if entrypoint is not None:
         if isinstance(entrypoint, str):
-            entrypoint = pkg_resources.EntryPoint.parse(entrypoint)
+            parsed_name, parsed_module, attrs, extras = (
+                _parse_pkg_resources_entrypoint(entrypoint))
+            entrypoint = entrypoint_type(parsed_name, parsed_module,
+                                         attrs=attrs, extras=extras)
+        elif _is_metadata_entrypoint(entrypoint):
+            entrypoint = entrypoint_type.parse(
+                f'{entrypoint.name} = {entrypoint.value}')
 
         if isinstance(entrypoint, pkg_resources.EntryPoint):
             if entrypoint.dist is not None:
@@ -254,43 +2613,824 @@ def dynamic_entrypoint(
                                 'attribute when entrypoint is a '
                                 'pkg_resources.Entrypoint')
         elif hasattr(entrypoint, '__qualname__'):  # classes and functions
-            if not (module is None and attribute is None):
-                raise TypeError('can\'t specify module_name and attribute '
-                                'alongside a callable entrypoint')
-            if name is None:
-                name = entrypoint.__name__
-
-            attrs = tuple(entrypoint.__qualname__.split('.'))
-            if '<locals>' in attrs:
-                raise ValueError(f'callable entrypoint is not '
-                                 f'importable: {entrypoint!r}')
-
-            if getattr(entrypoint, '__module__', None) is None:
-                raise ValueError(
-                    f'callable entrypoint has no __module__: {entrypoint!r}')
+            name, module, attrs = _callable_target(
+                entrypoint, name=name, module=module, attribute=attribute)
+            entrypoint = entrypoint_type(name, module, attrs=attrs)
+        else:
+            raise TypeError(f'unsupported entrypoint: {entrypoint!r}')
+    else:
+        name, module, attrs = _named_target(name, module, attribute)
+        entrypoint = entrypoint_type(name, module, attrs=attrs)
 
-            entrypoint = pkg_resources.EntryPoint(name, entrypoint.__module__,
-                                                  attrs=attrs)
+    if not require and isinstance(entrypoint, entrypoint_type):
+        entrypoint._require = False
+    return entrypoint
+
+
+def _create_metadata_entrypoint(
+        group: str, entrypoint: Optional[_EntrypointSpec] = None, *,
+        name: Optional[str] = None, module: Optional[str] = None,
+        attribute: Optional[str] = None) -> 'importlib.metadata.EntryPoint':
+    metadata = _importlib_metadata()
+
+    if entrypoint is None:
+        name, module, attrs = _named_target(name, module, attribute)
+        value = _format_entrypoint_value(module, attrs)
+    elif hasattr(entrypoint, '__qualname__'):  # classes and functions
+        name, module, attrs = _callable_target(
+            entrypoint, name=name, module=module, attribute=attribute)
+        value = _format_entrypoint_value(module, attrs)
+    else:
+        if isinstance(entrypoint, str):
+            parsed_name, value = _parse_entrypoint(entrypoint)
+        elif _is_metadata_entrypoint(entrypoint):
+            parsed_name, value = entrypoint.name, entrypoint.value
+        elif _is_pkg_resources_entrypoint(entrypoint):
+            if entrypoint.dist is not None:
+                raise ValueError('can\'t specify a pkg_resources.Entrypoint '
+                                 'instance with a dist already attached')
+            parsed_name, _, value = str(entrypoint).partition(' = ')
         else:
             raise TypeError(f'unsupported entrypoint: {entrypoint!r}')
+
+        if not (name is None and module is None and attribute is None):
+            raise TypeError('can\'t specify name, module_name or attribute '
+                            'when entrypoint is an entrypoint string or '
+                            'EntryPoint')
+        name = parsed_name
+
+    return metadata.EntryPoint(name=name, value=value, group=group)
+
+
+def _create_object_entrypoint(group: str, obj: object, *, name: str,
+                              backend: str, require: bool):
+    attr = f'o{next(_object_ids)}'
+    setattr(_objects, attr, obj)
+    if backend == IMPORTLIB_METADATA:
+        # importlib.metadata re-parses entry points from entry_points.txt, so
+        # they have to be loaded via the namespace.
+        entrypoint = _importlib_metadata().EntryPoint(
+            name=name, value=f'{__name__}:_objects.{attr}', group=group)
     else:
-        if name is None or module is None:
-            raise TypeError('name and module_name must be specified when '
-                            'entrypoint is not specified')
+        entrypoint = _entrypoint_type()(name, __name__,
+                                        attrs=('_objects', attr))
+        entrypoint._object = obj
+        if not require:
+            entrypoint._require = False
+    # Keep obj available for as long as the entry point could be loaded
+    if type(entrypoint).__weakrefoffset__:
+        weakref.finalize(entrypoint, delattr, _objects, attr)
+    return entrypoint
+
+
+def _keep_object(owner, entrypoint):
+    """Keep the object of an entry point created with obj available for as
+    long as owner exists, if the entry point can't be weakly referenced to
+    do so itself.
+
+    importlib.metadata.EntryPoint is a tuple before Python 3.11 (and in
+    older importlib_metadata backports), which can't be.
+    """
+    if not type(entrypoint).__weakrefoffset__:
+        value, _ = _entrypoint_value(entrypoint)
+        weakref.finalize(owner, delattr, _objects, value.rpartition('.')[2])
+
+
+def _callable_target(entrypoint: Union[Callable, Type[object]], *,
+                     name: Optional[str], module: Optional[str],
+                     attribute: Optional[str]) -> Tuple[str, str, Tuple[str]]:
+    """Get the name, module and attrs of an importable function or class."""
+    if not (module is None and attribute is None):
+        raise TypeError('can\'t specify module_name and attribute '
+                        'alongside a callable entrypoint')
+    if name is None:
+        name = entrypoint.__name__
+
+    attrs = tuple(entrypoint.__qualname__.split('.'))
+    if '<locals>' in attrs:
+        raise ValueError(f'callable entrypoint is not '
+                         f'importable: {entrypoint!r} (pass it as obj '
+                         f'instead)')
+
+    if getattr(entrypoint, '__module__', None) is None:
+        raise ValueError(
+            f'callable entrypoint has no __module__: {entrypoint!r} (pass '
+            f'it as obj instead)')
+
+    return name, entrypoint.__module__, attrs
+
+
+def _named_target(name: Optional[str], module: Optional[str],
+                  attribute: Optional[Union[str, Sequence[str]]]
+                  ) -> Tuple[str, str, Tuple[str]]:
+    if name is None or module is None:
+        raise TypeError('name and module_name must be specified when '
+                        'entrypoint is not specified')
 
-        if isinstance(attribute, str):
-            attribute = (attribute,)
-        if attribute is None:
-            attribute = (name,)
-        entrypoint = pkg_resources.EntryPoint(
-            name, module, attrs=attribute)
+    if isinstance(attribute, str):
+        attribute = (attribute,)
+    if attribute is None:
+        attribute = (name,)
+    return name, module, tuple(attribute)
+
+
+_ENTRYPOINT_PATTERN = re.compile(
+    r'\s*(?P<name>.+?)\s*=\s*'
+    r'(?P<value>[\w.]+\s*(:\s*[\w.]+\s*)?(\[.*\])?)\s*$')
+
+
+# The number of distinct entrypoint strings whose parsed form is cached
+_PARSE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _parse_entrypoint(src: str) -> Tuple[str, str]:
+    """Split an entrypoint string into its name and value without using
+    pkg_resources.
+    """
+    match = _ENTRYPOINT_PATTERN.match(src)
+    if not match:
+        raise ValueError('EntryPoint must be in \'name=module:attrs '
+                         '[extras]\' format', src)
+    return match.group('name'), match.group('value')
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _parse_pkg_resources_entrypoint(
+        src: str) -> Tuple[str, str, Tuple[str, ...], Tuple[str, ...]]:
+    """Parse an entrypoint string into the name, module, attrs and extras of
+    a pkg_resources.EntryPoint.
+
+    The components are cached rather than the EntryPoint, as each
+    registration needs its own EntryPoint to attach to a dist.
+    """
+    import pkg_resources
+    entrypoint = pkg_resources.EntryPoint.parse(src)
+    return (entrypoint.name, entrypoint.module_name, tuple(entrypoint.attrs),
+            tuple(entrypoint.extras))
+
+
+def _format_entrypoint_value(module: str, attrs: Sequence[str]) -> str:
+    if attrs:
+        return f'{module}:{".".join(attrs)}'
+    return module
+
+
+def _is_pkg_resources_entrypoint(obj) -> bool:
+    # If pkg_resources isn't imported yet obj can't be one of its EntryPoints
+    pkg_resources = sys.modules.get('pkg_resources')
+    return (pkg_resources is not None and
+            isinstance(obj, pkg_resources.EntryPoint))
+
+
+def _is_metadata_entrypoint(obj) -> bool:
+    return any(isinstance(obj, module.EntryPoint) for module in
+               (sys.modules.get('importlib.metadata'),
+                sys.modules.get('importlib_metadata'))
+               if module is not None)
+
+
+def _check_backend(backend: str):
+    if backend not in _BACKENDS:
+        raise ValueError(f'unknown backend: {backend!r}, expected one of: '
+                         f'{", ".join(map(repr, _BACKENDS))}')
+
+
+def _resolve_backend(backend: Optional[str], working_set
+                     ) -> Tuple[str, Union['pkg_resources.WorkingSet',
+                                           MetadataWorkingSet]]:
+    """Work out which backend and working set a registration uses."""
+    if backend is None:
+        if working_set is None:
+            backend = _default_backend
+        elif isinstance(working_set, MetadataWorkingSet):
+            backend = IMPORTLIB_METADATA
+        else:
+            backend = PKG_RESOURCES
+    _check_backend(backend)
 
     if working_set is None:
-        working_set = pkg_resources.working_set
+        if backend == IMPORTLIB_METADATA:
+            working_set = metadata_working_set
+        else:
+            import pkg_resources
+            working_set = pkg_resources.working_set
+    elif (isinstance(working_set, MetadataWorkingSet) !=
+            (backend == IMPORTLIB_METADATA)):
+        raise TypeError(f'working_set {working_set!r} can\'t be used with '
+                        f'the {backend!r} backend')
+    return backend, working_set
+
+
+def _default_scope(scope: Optional[str]) -> str:
     if scope is None:
-        scope = f'{__name__}.scope.default'
+        return f'{__name__}.scope.default'
+    return scope
+
+
+def set_default_backend(backend: str) -> str:
+    """
+    Set the backend used when ``dynamic_entrypoint()`` or
+    ``dynamic_entrypoints()`` are called without a ``backend`` or
+    ``working_set``.
+
+    :param backend: ``'pkg_resources'`` (the initial default) or
+        ``'importlib.metadata'``.
+    :return: The previous default backend.
+    """
+    global _default_backend
+    _check_backend(backend)
+    previous, _default_backend = _default_backend, backend
+    return previous
+
+
+def get_group(
+        group: str, *, backend: Optional[str] = None,
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None
+        ) -> Tuple[Union['pkg_resources.EntryPoint',
+                         'importlib.metadata.EntryPoint'], ...]:
+    """
+    Get all the entry points in a group, in the order they're discovered.
+
+    This gives the same entry points as
+    ``pkg_resources.iter_entry_points(group)`` (or
+    ``importlib.metadata.entry_points(group=group)``), but the result is
+    cached until prybar registers or unregisters an entry point, or a
+    distribution is added to the working set. So repeated lookups are
+    cheap, but changes to installed distributions made without going
+    through the working set aren't noticed.
+
+    Context-local entry points are included; the cache isn't used while
+    any are visible in the current context.
+
+    :param group: The group to get entry points from.
+    :param backend: ``'pkg_resources'`` or ``'importlib.metadata'``. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :param working_set: The working set to search. See
+        :meth:`prybar.dynamic_entrypoint`.
+    :return: A tuple of entry points.
+    """
+    if not isinstance(group, str):
+        raise TypeError(f'group must be a str, got: {group!r}')
+    backend, working_set = _resolve_backend(backend, working_set)
+
+    if contextvars is not None and _context_entrypoints.get():
+        return _find_group(backend, working_set, group)
+
+    # Read the stamp before searching so that a concurrent change results in
+    # a stale stamp rather than a stale cache.
+    stamp = _discovery_stamp(backend, working_set)
+    cached_stamp, groups = _discovery_caches.get(working_set, (None, None))
+    if cached_stamp != stamp:
+        groups = {}
+        _discovery_caches[working_set] = (stamp, groups)
+    try:
+        return groups[group]
+    except KeyError:
+        entrypoints = groups[group] = _find_group(backend, working_set, group)
+        return entrypoints
+
+
+def iter_entry_points(
+        group: str, name: Optional[str] = None, *,
+        backend: Optional[str] = None,
+        working_set: Optional[Union['pkg_resources.WorkingSet',
+                                    MetadataWorkingSet]] = None
+        ) -> Iterator[Union['pkg_resources.EntryPoint',
+                            'importlib.metadata.EntryPoint']]:
+    """
+    Iterate over the entry points in a group, like
+    ``pkg_resources.iter_entry_points()``, using the cache of
+    :meth:`prybar.get_group`.
+
+    :param group: The group to get entry points from.
+    :param name: If specified, only entry points with this name are
+        included.
+    :param backend: See :meth:`prybar.get_group`.
+    :param working_set: See :meth:`prybar.get_group`.
+    """
+    entrypoints = get_group(group, backend=backend, working_set=working_set)
+    if name is None:
+        return iter(entrypoints)
+    return (ep for ep in entrypoints if ep.name == name)
+
+
+_discovery_caches = weakref.WeakKeyDictionary()
+
+
+def _discovery_stamp(backend: str, working_set) -> tuple:
+    """Identify the state of the entry points visible to a get_group()
+    lookup.
+    """
+    if backend == IMPORTLIB_METADATA:
+        # importlib.metadata searches every finder, not just working_set
+        return _generation, tuple(map(id, sys.meta_path))
+    return _generation, len(working_set.by_key), len(working_set.entries)
+
+
+def _find_group(backend: str, working_set, group: str) -> tuple:
+    if backend == IMPORTLIB_METADATA:
+        metadata = _importlib_metadata()
+        try:
+            return tuple(metadata.entry_points(group=group))
+        except TypeError:  # pragma: no cover
+            # Python < 3.10 returns a dict of groups
+            return tuple(metadata.entry_points().get(group, ()))
+    return tuple(working_set.iter_entry_points(group))
+
+
+class EntrypointEvent(namedtuple(
+        'EntrypointEvent', 'kind group entrypoint scope working_set')):
+    """
+    A change to the entry points of a working set, passed to the callbacks
+    registered with :meth:`prybar.subscribe`.
+
+    :ivar kind: ``'added'``, ``'removed'`` or ``'replaced'`` (by
+        :meth:`prybar.DynamicEntrypoint.swap`).
+    :ivar group: The group of the entry point.
+    :ivar entrypoint: The entry point that was added or removed, or the new
+        entry point for ``'replaced'``.
+    :ivar scope: The scope the entry point was registered in.
+    :ivar working_set: The working set the entry point was registered in.
+    """
+    __slots__ = ()
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    REPLACED = 'replaced'
+
+
+def subscribe(group: Optional[str],
+              callback: Callable[[EntrypointEvent], None]
+              ) -> Callable[[], None]:
+    """
+    Call a function whenever prybar adds, removes or replaces an entry point.
+
+    The callback receives an :class:`prybar.EntrypointEvent` for each entry
+    point, after it has been added (when a registration is entered or
+    started), removed (when it's exited or stopped) or replaced (by
+    :meth:`prybar.DynamicEntrypoint.swap`). Callbacks are called
+    in the thread making the change, after it has finished making it and
+    without holding any of prybar's locks, so they can inspect the working
+    set, register entry points themselves, or enter, start or stop the
+    registration that changed. A registration is included in
+    :meth:`prybar.active` by the time its ``'added'`` events are sent.
+    Exceptions raised by callbacks are logged rather than propagated.
+
+    Context-local registrations don't generate events, as their entry points
+    aren't visible outside the context registering them.
+
+    :param group: Only call callback for entry points in this group. If
+        ``None``, call it for all groups.
+    :param callback: The function to call.
+    :return: A function which unsubscribes callback when called.
+    """
+    global _subscribers
+    if group is not None and not isinstance(group, str):
+        raise TypeError(f'group must be a str or None, got: {group!r}')
+    subscriber = (group, callback)
+    with _lock:
+        _subscribers = (*_subscribers, subscriber)
+
+    def unsubscribe():
+        global _subscribers
+        with _lock:
+            _subscribers = tuple(
+                s for s in _subscribers if s is not subscriber)
+    return unsubscribe
+
+
+def _subscribe_batches(callback: Callable[[List[EntrypointEvent]], None]
+                       ) -> Callable[[], None]:
+    """Like subscribe(), except that callback is called once per change with
+    a list of the events of all the entry points changed.
+    """
+    global _batch_subscribers
+    with _lock:
+        _batch_subscribers = (*_batch_subscribers, callback)
+
+    def unsubscribe():
+        global _batch_subscribers
+        with _lock:
+            _batch_subscribers = tuple(
+                s for s in _batch_subscribers if s is not callback)
+    return unsubscribe
+
+
+@contextmanager
+def _deferring_events() -> Iterator[None]:
+    """Queue the events generated by the current thread within the with
+    block, and send them to subscribers after it.
+    """
+    if getattr(_deferred_events, 'pending', None) is not None:
+        # Already deferring further out
+        yield
+        return
+    pending = _deferred_events.pending = []
+    try:
+        yield
+    finally:
+        _deferred_events.pending = None
+        for args in pending:
+            _notify(*args)
+
+
+def _notify(kind: str, entrypoints, scope: str, working_set):
+    pending = getattr(_deferred_events, 'pending', None)
+    if pending is not None:
+        pending.append((kind, entrypoints, scope, working_set))
+        return
+    subscribers = _subscribers
+    batch_subscribers = _batch_subscribers
+    if not (subscribers or batch_subscribers):
+        return
+    events = [EntrypointEvent(kind, group, entrypoint, scope, working_set)
+              for group, entrypoint in entrypoints]
+    for callback in batch_subscribers:
+        _call_subscriber(callback, events)
+    for event in events:
+        for subscribed_group, callback in subscribers:
+            if subscribed_group is None or subscribed_group == event.group:
+                _call_subscriber(callback, event)
+
+
+def _call_subscriber(callback: Callable, event):
+    try:
+        callback(event)
+    except Exception:
+        import logging
+        logging.getLogger(__name__).exception(
+            'prybar subscriber %r failed to handle %r', callback, event)
+
+
+class StatsEvent(namedtuple('StatsEvent', 'kind name seconds')):
+    """
+    Something timed by a :class:`prybar.Stats` object, passed to the hook of
+    :meth:`prybar.collect_stats`.
+
+    :ivar kind: One of:
+
+        - ``'enter'`` or ``'exit'``: A registration was activated or
+          deactivated (the first ``__enter__()`` or ``start()``, or the last
+          ``__exit__()`` or ``stop()``). ``name`` is the scope.
+        - ``'mutation'``: prybar added or removed entry points in a working
+          set. ``name`` is the scope.
+        - ``'read'``: The entry points of one of prybar's distributions
+          were read. ``name`` is the group read, or ``None`` if all of them
+          were. A single search, e.g. by ``iter_entry_points()``, reads
+          each of prybar's distributions in the working set, so it's
+          counted once per scope. Use :meth:`prybar.trace_discovery` to
+          count searches.
+        - ``'load'``: ``load()`` was called on an entry point prybar created.
+          ``name`` is the entry point's name.
+        - ``'import'``: Loading an entry point imported its module. ``name``
+          is the module. The time is also part of the ``'load'``.
+    :ivar name: What the event happened to, as described above.
+    :ivar seconds: How long it took.
+    """
+    __slots__ = ()
+
+    ENTER = 'enter'
+    EXIT = 'exit'
+    MUTATION = 'mutation'
+    READ = 'read'
+    LOAD = 'load'
+    IMPORT = 'import'
+
+
+class Stats:
+    """
+    Counts and timings of what prybar does, collected while enabled by
+    :meth:`prybar.collect_stats`.
+
+    For each kind of :class:`prybar.StatsEvent` there's a count and a total
+    time in seconds, e.g. ``enters`` and ``enter_time``, ``loads`` and
+    ``load_time``. ``reads_by_group`` counts the reads of each group,
+    and ``imports`` holds the time taken to import each module.
+    """
+    # The count and time attributes of each kind of event except imports
+    _ATTRIBUTES = {
+        StatsEvent.ENTER: ('enters', 'enter_time'),
+        StatsEvent.EXIT: ('exits', 'exit_time'),
+        StatsEvent.MUTATION: ('mutations', 'mutation_time'),
+        StatsEvent.READ: ('reads', 'read_time'),
+        StatsEvent.LOAD: ('loads', 'load_time')}
+
+    def __init__(self, hook: Optional[Callable[[StatsEvent], None]] = None):
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all the counts and timings to zero."""
+        with self._lock:
+            self.enters = self.exits = self.mutations = 0
+            self.reads = self.loads = 0
+            self.enter_time = self.exit_time = self.mutation_time = 0.0
+            self.read_time = self.load_time = 0.0
+            self.reads_by_group = {}
+            self.imports = {}
+
+    def as_dict(self) -> dict:
+        """Get the counts and timings as a dict, e.g. to log them."""
+        with self._lock:
+            return {
+                'enters': self.enters, 'enter_time': self.enter_time,
+                'exits': self.exits, 'exit_time': self.exit_time,
+                'mutations': self.mutations,
+                'mutation_time': self.mutation_time,
+                'reads': self.reads, 'read_time': self.read_time,
+                'reads_by_group': dict(self.reads_by_group),
+                'loads': self.loads, 'load_time': self.load_time,
+                'imports': dict(self.imports)}
+
+    def __repr__(self):
+        return (f'<prybar.Stats enters={self.enters} exits={self.exits} '
+                f'mutations={self.mutations} reads={self.reads} '
+                f'loads={self.loads} imports={len(self.imports)}>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Stop collecting. The counts and timings are kept."""
+        global _collectors
+        with _lock:
+            _collectors = tuple(c for c in _collectors if c is not self)
+
+    def _record(self, event: StatsEvent):
+        kind, name, seconds = event
+        with self._lock:
+            if kind == StatsEvent.IMPORT:
+                self.imports[name] = self.imports.get(name, 0.0) + seconds
+            else:
+                count, total = self._ATTRIBUTES[kind]
+                setattr(self, count, getattr(self, count) + 1)
+                setattr(self, total, getattr(self, total) + seconds)
+                if kind == StatsEvent.READ:
+                    self.reads_by_group[name] = (
+                        self.reads_by_group.get(name, 0) + 1)
+        if self.hook is not None:
+            try:
+                self.hook(event)
+            except Exception:
+                import logging
+                logging.getLogger(__name__).exception(
+                    'prybar stats hook %r failed to handle %r', self.hook,
+                    event)
+
+
+def collect_stats(hook: Optional[Callable[[StatsEvent], None]] = None
+                  ) -> Stats:
+    """
+    Start collecting counts and timings of what prybar does, e.g. to find
+    slow plugin imports or code which searches entry points too often.
+
+    Collection stops when the returned :class:`prybar.Stats` is closed, or
+    when the ``with`` block using it ends. Several collectors can be active
+    at once. While none are, prybar doesn't time anything.
+
+    Loads are only timed for entry points prybar created for the
+    pkg_resources backend; ``importlib.metadata`` entry points and
+    ``pkg_resources.EntryPoint`` objects passed to prybar are loaded
+    without prybar's involvement.
+
+    :param hook: A function to call with a :class:`prybar.StatsEvent` for
+        each thing timed, in the thread that did it. Exceptions raised by it
+        are logged rather than propagated.
+    :return: A :class:`prybar.Stats` which is collecting.
+    """
+    global _collectors
+    stats = Stats(hook)
+    with _lock:
+        _collectors = (*_collectors, stats)
+    return stats
+
+
+def _record(kind: str, name: Optional[str], started: float):
+    """Record something that happened to the active collectors, if any."""
+    collectors = _collectors
+    if not collectors:
+        return
+    event = StatsEvent(kind, name, time.perf_counter() - started)
+    for stats in collectors:
+        stats._record(event)
+
+
+class _TimedRegistration:
+    """Records the time taken to enter and exit a registration's context
+    manager.
+    """
+
+    def __init__(self, registration, scope: str):
+        self.registration = registration
+        self.scope = scope
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.registration.__enter__()
+        _record(StatsEvent.ENTER, self.scope, started)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        started = time.perf_counter()
+        try:
+            return self.registration.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            _record(StatsEvent.EXIT, self.scope, started)
+
+
+class DiscoveryQuery(namedtuple(
+        'DiscoveryQuery', 'function group name caller results seconds')):
+    """
+    A search for entry points recorded by :meth:`prybar.trace_discovery`.
+
+    :ivar function: The function called: ``'iter_entry_points'``,
+        ``'get_entry_map'`` or ``'get_entry_info'``.
+    :ivar group: The group searched, or ``None`` if ``get_entry_map()`` was
+        called for all groups.
+    :ivar name: The entry point name searched for, or ``None``.
+    :ivar caller: Where the search was made from, as ``'file:line in
+        function'``. Calls made via prybar (e.g. :meth:`prybar.get_group`)
+        are attributed to prybar's caller.
+    :ivar results: The number of entry points found. For
+        ``iter_entry_points()``, this is the number the caller consumed.
+    :ivar seconds: The time spent searching. For ``iter_entry_points()``,
+        this excludes time spent by the caller between results.
+    """
+    __slots__ = ()
+
+
+class DiscoveryTrace:
+    """
+    The searches recorded by :meth:`prybar.trace_discovery`.
+
+    :ivar queries: A list of :class:`prybar.DiscoveryQuery`, in the order
+        the searches finished.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __repr__(self):
+        return f'<prybar.DiscoveryTrace queries={len(self.queries)}>'
+
+    def top_callers(self, limit: Optional[int] = 10
+                    ) -> List[Tuple[str, int, float]]:
+        """
+        Get the callers which spent the most time searching.
+
+        :param limit: The maximum number of callers to return, or ``None``
+            for all of them.
+        :return: A list of ``(caller, queries, seconds)`` tuples, with the
+            greatest total seconds first.
+        """
+        callers = {}
+        for query in self.queries:
+            count, seconds = callers.get(query.caller, (0, 0.0))
+            callers[query.caller] = (count + 1, seconds + query.seconds)
+        top = sorted(((caller, count, seconds)
+                      for caller, (count, seconds) in callers.items()),
+                     key=lambda caller: caller[2], reverse=True)
+        return top if limit is None else top[:limit]
+
+    def report(self, limit: Optional[int] = 10) -> str:
+        """
+        Format :meth:`top_callers` as a table.
+
+        :param limit: See :meth:`top_callers`.
+        """
+        lines = [f'{"seconds":>10} {"queries":>8}  caller']
+        lines.extend(f'{seconds:10.6f} {count:8}  {caller}'
+                     for caller, count, seconds in self.top_callers(limit))
+        return '\n'.join(lines)
+
+    def _trace_iter_entry_points(self, iter_entry_points: Callable
+                                 ) -> Callable:
+        def traced_iter_entry_points(group, name=None):
+            return self._iterate(_caller(), group, name,
+                                 iter_entry_points(group, name))
+        return traced_iter_entry_points
+
+    def _iterate(self, caller: str, group: str, name: Optional[str],
+                 entrypoints: Iterator):
+        results = 0
+        seconds = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    entrypoint = next(entrypoints)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                results += 1
+                yield entrypoint
+        finally:
+            self.queries.append(DiscoveryQuery(
+                'iter_entry_points', group, name, caller, results, seconds))
+
+    def _trace_get_entry_map(self, get_entry_map: Callable) -> Callable:
+        def traced_get_entry_map(dist, group=None):
+            caller = _caller()
+            started = time.perf_counter()
+            entry_map = get_entry_map(dist, group)
+            self.queries.append(DiscoveryQuery(
+                'get_entry_map', group, None, caller, len(entry_map),
+                time.perf_counter() - started))
+            return entry_map
+        return traced_get_entry_map
+
+    def _trace_get_entry_info(self, get_entry_info: Callable) -> Callable:
+        def traced_get_entry_info(dist, group, name):
+            caller = _caller()
+            started = time.perf_counter()
+            entrypoint = get_entry_info(dist, group, name)
+            self.queries.append(DiscoveryQuery(
+                'get_entry_info', group, name, caller,
+                int(entrypoint is not None), time.perf_counter() - started))
+            return entrypoint
+        return traced_get_entry_info
+
+
+def _caller() -> str:
+    """Describe the frame which called the caller of this function, skipping
+    frames in prybar.
+    """
+    frame = sys._getframe(2)
+    while frame.f_back is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    code = frame.f_code
+    return f'{code.co_filename}:{frame.f_lineno} in {code.co_name}'
+
+
+@contextmanager
+def trace_discovery(working_set: Optional['pkg_resources.WorkingSet'] = None
+                    ) -> Iterator[DiscoveryTrace]:
+    """
+    Record the entry point searches made in a working set, and where they
+    were made from, to find code which searches more often than it needs to.
+
+    Within the ``with`` block, the working set's ``iter_entry_points()`` is
+    wrapped to record each search as a :class:`prybar.DiscoveryQuery`. When
+    ``working_set`` is ``pkg_resources.working_set``, the module-level
+    ``pkg_resources.iter_entry_points()``, ``get_entry_map()`` and
+    ``get_entry_info()`` functions are wrapped too. Everything is put back as
+    it was on exit.
+
+    >>> import pkg_resources
+    >>> def find_plugins():
+    ...     return list(pkg_resources.iter_entry_points('example.plugins'))
+    >>> with trace_discovery() as trace:
+    ...     for _ in range(3):
+    ...         plugins = find_plugins()
+    >>> caller, queries, seconds = trace.top_callers()[0]
+    >>> caller.endswith('in find_plugins'), queries
+    (True, 3)
+
+    :param working_set: The ``pkg_resources.WorkingSet`` to trace. Defaults
+        to ``pkg_resources.working_set``.
+    :return: A context manager which gives a :class:`prybar.DiscoveryTrace`
+        of the searches made.
+    """
+    import pkg_resources
+
+    if working_set is None:
+        working_set = pkg_resources.working_set
+    elif not isinstance(working_set, pkg_resources.WorkingSet):
+        raise TypeError(f'working_set must be a pkg_resources.WorkingSet, '
+                        f'got: {working_set!r}')
+
+    trace = DiscoveryTrace()
+    previous = vars(working_set).get('iter_entry_points')
+    working_set.iter_entry_points = traced = trace._trace_iter_entry_points(
+        working_set.iter_entry_points)
+    # The module-level functions use the global working set
+    module_functions = []
+    if working_set is pkg_resources.working_set:
+        for name, wrap in [
+                ('iter_entry_points', trace._trace_iter_entry_points),
+                ('get_entry_map', trace._trace_get_entry_map),
+                ('get_entry_info', trace._trace_get_entry_info)]:
+            function = getattr(pkg_resources, name)
+            wrapper = wrap(function)
+            setattr(pkg_resources, name, wrapper)
+            module_functions.append((name, function, wrapper))
 
-    return DynamicEntrypoint(group, entrypoint, working_set, scope)
+    try:
+        yield trace
+    finally:
+        for name, function, wrapper in reversed(module_functions):
+            if getattr(pkg_resources, name) is wrapper:
+                setattr(pkg_resources, name, function)
+        if previous is not None:
+            working_set.iter_entry_points = previous
+        elif vars(working_set).get('iter_entry_points') is traced:
+            del working_set.iter_entry_points
 
 
 def format_scope(scope, dist):
@@ -1,10 +1,53 @@
+import asyncio
+import collections
 import contextlib
+import functools
+import gc
+import io
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
 
 import pkg_resources
 import pytest
 
 import prybar
-from prybar import dynamic_entrypoint
+from prybar import dynamic_entrypoint, dynamic_entrypoints
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # Python 3.6
+    contextvars = None
+
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:  # pragma: no cover
+    # Python < 3.8 — prybar uses the importlib_metadata backport if it's
+    # installed
+    try:
+        import importlib_metadata
+    except ImportError:
+        importlib_metadata = None
+
+requires_metadata = pytest.mark.skipif(
+    importlib_metadata is None,
+    reason='the importlib.metadata backend requires Python 3.8 or the '
+           'importlib_metadata package')
+
+requires_contextvars = pytest.mark.skipif(
+    contextvars is None,
+    reason='context-local registrations and asyncio.run() require Python '
+           '3.7')
+
+BACKENDS = ['pkg_resources',
+            pytest.param('importlib.metadata', marks=requires_metadata)]
 
 
 @pytest.fixture(autouse=True)
@@ -24,6 +67,17 @@ def validate_entrypoint_cleanup():
                         f'test: key: {key}, dist: {dist}')
     if prybar.__file__ in pkg_resources.working_set.entries:
         pytest.fail('prybar.py in working_set.entries after running a test')
+    if prybar.metadata_working_set.by_key:
+        pytest.fail(f'a metadata dist created by prybar exists after running '
+                    f'a test: {prybar.metadata_working_set.by_key}')
+    if prybar.metadata_working_set in sys.meta_path:
+        pytest.fail('prybar.metadata_working_set in sys.meta_path after '
+                    'running a test')
+    if contextvars is not None and prybar._context_entrypoints.get():
+        pytest.fail('context-local entrypoints exist after running a test')
+    if prybar.active():
+        pytest.fail(f'registrations are active after running a test: '
+                    f'{prybar.active()}')
 
 
 class SomeClass:
@@ -426,3 +480,1775 @@ def test_scopes_are_normalised_by_pkg_resources():
     assert str(excinfo.value) == (
         "'ep_1' is already registered under 'test-group' in scope "
         "'foo_bar' ('foo-bar')")
+
+
+def test_dynamic_entrypoints_registers_many_entrypoints():
+    dep = dynamic_entrypoints([
+        ('test-group', ep_1),
+        ('test-group', f'ep_2 = {__name__}:ep_2'),
+        ('other-group', pkg_resources.EntryPoint('ep_3', __name__,
+                                                 attrs=('ep_3',))),
+    ])
+    assert list(pkg_resources.iter_entry_points('test-group')) == []
+
+    with dep:
+        eps = list(pkg_resources.iter_entry_points('test-group'))
+        assert [ep.name for ep in eps] == ['ep_1', 'ep_2']
+        assert [ep.load() for ep in eps] == [ep_1, ep_2]
+        assert ([ep.load() for ep in
+                 pkg_resources.iter_entry_points('other-group')] == [ep_3])
+
+    assert list(pkg_resources.iter_entry_points('test-group')) == []
+    assert list(pkg_resources.iter_entry_points('other-group')) == []
+
+    dep.start()
+    assert len(list(pkg_resources.iter_entry_points('test-group'))) == 2
+    dep.stop()
+    assert list(pkg_resources.iter_entry_points('test-group')) == []
+
+
+def test_dynamic_entrypoints_share_scope_with_dynamic_entrypoint():
+    with dynamic_entrypoint('test-group', ep_1):
+        with dynamic_entrypoints([('test-group', ep_2),
+                                  ('test-group', ep_3)]):
+            eps = list(pkg_resources.iter_entry_points('test-group'))
+            assert [ep.name for ep in eps] == ['ep_1', 'ep_2', 'ep_3']
+
+        eps = list(pkg_resources.iter_entry_points('test-group'))
+        assert [ep.name for ep in eps] == ['ep_1']
+
+
+@pytest.mark.parametrize('existing, batch', [
+    # Conflicts with an already registered entrypoint
+    ([('test-group', ep_2)], [('test-group', ep_1), ('test-group', ep_2)]),
+    # Conflicts within the batch itself
+    ([], [('test-group', ep_1), ('test-group', ep_2),
+          ('test-group', f'ep_1 = {__name__}:ep_3')]),
+])
+def test_dynamic_entrypoints_registration_is_all_or_nothing(existing, batch):
+    with dynamic_entrypoints(existing):
+        before = [ep.name for ep in
+                  pkg_resources.iter_entry_points('test-group')]
+
+        dep = dynamic_entrypoints(batch)
+        with pytest.raises(ValueError) as excinfo:
+            with dep:
+                pytest.fail('must not enter')
+        assert 'is already registered under \'test-group\'' in str(
+            excinfo.value)
+
+        assert before == [ep.name for ep in
+                          pkg_resources.iter_entry_points('test-group')]
+        assert all(ep.dist is None for _, ep in dep.entrypoints)
+
+        # A failed __enter__() doesn't leave the batch half active
+        with pytest.raises(RuntimeError):
+            dep.__exit__(None, None, None)
+
+
+@pytest.mark.parametrize('entrypoints, exc, msg', [
+    ([(42, ep_1)], TypeError, 'group must be a string, got: 42'),
+    ([('test-group', None)], TypeError,
+     'entrypoint must be specified for group \'test-group\''),
+    ([('test-group', 42)], TypeError, 'unsupported entrypoint: 42'),
+])
+def test_dynamic_entrypoints_invalid_arguments(entrypoints, exc, msg):
+    with pytest.raises(exc) as excinfo:
+        dynamic_entrypoints(entrypoints)
+    assert str(excinfo.value) == msg
+
+
+def test_importing_prybar_does_not_import_pkg_resources():
+    code = 'import sys, prybar; print("pkg_resources" in sys.modules)'
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(prybar.__file__)))
+    assert output.strip() == b'False'
+
+
+@requires_metadata
+@pytest.mark.parametrize('name', prybar.__all__)
+def test_annotations_resolve_with_lazily_imported_modules(name):
+    import typing
+    obj = getattr(prybar, name)
+    localns = {'pkg_resources': pkg_resources,
+               'importlib': types.SimpleNamespace(metadata=importlib_metadata)}
+    functions = [obj] if callable(obj) else []
+    if isinstance(obj, type):
+        functions = [value for value in vars(obj).values()
+                     if isinstance(value, types.FunctionType)]
+    for function in functions:
+        typing.get_type_hints(function, localns=localns)
+
+
+def metadata_entry_points(group, name=None):
+    eps = importlib_metadata.entry_points()
+    # entry_points() returns a dict of groups before Python 3.10
+    eps = (eps.select(group=group) if hasattr(eps, 'select')
+           else eps.get(group, ()))
+    return [ep for ep in eps if name is None or ep.name == name]
+
+
+@requires_metadata
+def test_metadata_backend_registers_entrypoint_via_with():
+    assert metadata_entry_points('test-group') == []
+
+    with dynamic_entrypoint('test-group', ep_1,
+                            backend='importlib.metadata'):
+        eps = metadata_entry_points('test-group')
+        assert [ep.name for ep in eps] == ['ep_1']
+        assert eps[0].load() is ep_1
+        assert prybar.metadata_working_set in sys.meta_path
+
+    assert metadata_entry_points('test-group') == []
+
+
+@requires_metadata
+def test_metadata_backend_supports_decorator_and_start_stop():
+    dep = dynamic_entrypoint('test-group', ep_1, backend='importlib.metadata')
+
+    @dep
+    def func():
+        return [ep.load() for ep in metadata_entry_points('test-group')]
+    assert func() == [ep_1]
+    assert metadata_entry_points('test-group') == []
+
+    dep.start()
+    assert [ep.load() for ep in metadata_entry_points('test-group')] == [ep_1]
+    dep.stop()
+    assert metadata_entry_points('test-group') == []
+
+
+@requires_metadata
+def test_metadata_backend_does_not_register_with_pkg_resources():
+    with dynamic_entrypoint('test-group', ep_1, backend='importlib.metadata'):
+        assert list(pkg_resources.iter_entry_points('test-group')) == []
+
+
+@requires_metadata
+def test_metadata_backend_scopes_are_distributions():
+    with dynamic_entrypoints([('test-group', ep_1), ('other-group', ep_2)],
+                             scope='foo_bar', backend='importlib.metadata'):
+        dist = importlib_metadata.distribution('foo-bar')
+        assert dist.metadata['Name'] == 'foo_bar'
+        assert sorted((ep.group, ep.name) for ep in dist.entry_points) == [
+            ('other-group', 'ep_2'), ('test-group', 'ep_1')]
+
+        with pytest.raises(ValueError) as excinfo:
+            with dynamic_entrypoint('test-group', ep_1, scope='foo.bar',
+                                    backend='importlib.metadata'):
+                pass
+        assert str(excinfo.value) == (
+            "'ep_1' is already registered under 'test-group' in scope "
+            "'foo.bar' ('foo-bar')")
+
+
+@requires_metadata
+def test_metadata_backend_names_need_not_be_unique_in_different_scopes():
+    with dynamic_entrypoint('test-group', name='foo', entrypoint=ep_1,
+                            scope='a', backend='importlib.metadata'):
+        with dynamic_entrypoint('test-group', name='foo', entrypoint=ep_2,
+                                scope='b', backend='importlib.metadata'):
+            foos = metadata_entry_points('test-group', 'foo')
+            assert [ep.load() for ep in foos] == [ep_1, ep_2]
+
+
+@requires_metadata
+def test_metadata_backend_scope_cant_shadow_existing_distribution():
+    with pytest.raises(ValueError) as excinfo:
+        with dynamic_entrypoint('test-group', ep_1, scope='pytest',
+                                backend='importlib.metadata'):
+            pytest.fail('must not enter')
+
+    assert str(excinfo.value).startswith(
+        "scope 'pytest' already exists in working set at location /")
+
+
+@pytest.mark.parametrize('args, kwargs', [
+    (['test-group', ep_1], {}),
+    (['test-group', pkg_resources.EntryPoint('ep_1', __name__,
+                                             attrs=('ep_1',))], {}),
+    pytest.param(['test-group', importlib_metadata and
+                  importlib_metadata.EntryPoint(
+                      'ep_1', f'{__name__}:ep_1', 'other-group')], {},
+                 marks=requires_metadata),
+    (['test-group', f'ep_1 = {__name__}:ep_1'], {}),
+    (['test-group'], dict(name='ep_1', module=__name__)),
+    (['test-group'], dict(name='ep_1', module=__name__, attribute='ep_1')),
+    (['test-group'], dict(name='ep_1', module=__name__, attribute=('ep_1',))),
+])
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_valid_arguments_for_each_backend(args, kwargs, backend):
+    with dynamic_entrypoint(*args, backend=backend, **kwargs):
+        if backend == 'pkg_resources':
+            eps = list(pkg_resources.iter_entry_points('test-group'))
+        else:
+            eps = metadata_entry_points('test-group')
+        assert ['ep_1'] == [ep.name for ep in eps]
+        assert eps[0].load() is ep_1
+
+
+@requires_metadata
+@pytest.mark.parametrize('args, kwargs, exc, msg', [
+    (['test-group', 'not an entrypoint'], {}, ValueError,
+     'EntryPoint must be in \'name=module:attrs [extras]\' format'),
+    (['test-group', f'ep_1 = {__name__}:ep_1'], dict(name='abc'), TypeError,
+     'can\'t specify name, module_name or attribute when entrypoint is an '
+     'entrypoint string or EntryPoint'),
+    (['test-group', 42], {}, TypeError, 'unsupported entrypoint: 42'),
+    (['test-group', ep_1], dict(backend='foo'), ValueError,
+     'unknown backend: \'foo\', expected one of: \'pkg_resources\', '
+     '\'importlib.metadata\''),
+    (['test-group', ep_1], dict(working_set=pkg_resources.working_set),
+     TypeError, 'can\'t be used with the \'importlib.metadata\' backend'),
+])
+def test_metadata_backend_invalid_arguments(args, kwargs, exc, msg):
+    kwargs.setdefault('backend', 'importlib.metadata')
+    with pytest.raises(exc) as excinfo:
+        dynamic_entrypoint(*args, **kwargs)
+    assert msg in str(excinfo.value)
+
+
+@requires_metadata
+def test_backend_is_inferred_from_working_set():
+    ws = prybar.MetadataWorkingSet()
+    dep = dynamic_entrypoint('test-group', ep_1, working_set=ws)
+    assert dep.working_set is ws
+    with dep:
+        assert [ep.load() for ep in metadata_entry_points('test-group')] == [
+            ep_1]
+        assert list(pkg_resources.iter_entry_points('test-group')) == []
+    assert ws not in sys.meta_path
+
+
+@requires_metadata
+def test_set_default_backend():
+    previous = prybar.set_default_backend('importlib.metadata')
+    try:
+        assert previous == 'pkg_resources'
+        dep = dynamic_entrypoint('test-group', ep_1)
+        assert dep.working_set is prybar.metadata_working_set
+    finally:
+        assert prybar.set_default_backend(previous) == 'importlib.metadata'
+
+    with pytest.raises(ValueError):
+        prybar.set_default_backend('foo')
+
+
+@requires_metadata
+def test_metadata_backend_does_not_import_pkg_resources():
+    code = (
+        'import sys, prybar\n'
+        'with prybar.dynamic_entrypoint("g", "x = os:getcwd", scope="s",\n'
+        '                               backend="importlib.metadata"):\n'
+        '    ep, = prybar._importlib_metadata().distribution("s")'
+        '.entry_points\n'
+        '    assert ep.load() is __import__("os").getcwd\n'
+        'print("pkg_resources" in sys.modules)\n')
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(prybar.__file__)))
+    assert output.strip() == b'False'
+
+
+def test_concurrent_use_of_a_shared_entrypoint():
+    dep = dynamic_entrypoint('test-group', ep_1)
+    others = [dynamic_entrypoint('test-group', name=f'ep_{i}',
+                                 module=__name__, attribute='ep_2')
+              for i in range(10, 18)]
+    barrier = threading.Barrier(8)
+
+    def worker(other):
+        barrier.wait()
+        for _ in range(200):
+            with dep, other:
+                names = [ep.name for ep in
+                         pkg_resources.iter_entry_points('test-group')]
+                assert 'ep_1' in names
+                assert other.entrypoint.name in names
+
+    with ThreadPoolExecutor(8) as pool:
+        for future in [pool.submit(worker, other) for other in others]:
+            future.result()
+
+    assert list(pkg_resources.iter_entry_points('test-group')) == []
+
+
+def test_lookups_during_concurrent_scope_churn():
+    live = dynamic_entrypoints([('test-group', ep_1)])
+    scopes = [dynamic_entrypoint('test-group', ep_2, scope=f'scope-{i}')
+              for i in range(50)]
+    churning = [dynamic_entrypoint('test-group', ep_2, scope=f'churn-{i}')
+                for i in range(5)]
+    stop = threading.Event()
+
+    def churn():
+        while not stop.is_set():
+            for registration in churning:
+                with registration:
+                    pass
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(live)
+        for scope in scopes:
+            stack.enter_context(scope)
+        thread = threading.Thread(target=churn)
+        thread.start()
+        try:
+            for _ in range(3000):
+                entrypoints = list(
+                    pkg_resources.iter_entry_points('test-group'))
+                assert len(entrypoints) >= 51
+        finally:
+            stop.set()
+            thread.join()
+
+
+def test_reentering_an_active_entrypoint_does_not_take_global_lock():
+    dep = dynamic_entrypoint('test-group', ep_1)
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with prybar._lock:
+            locked.set()
+            release.wait()
+
+    def reenter():
+        with dep:
+            pass
+
+    with dep:
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        try:
+            reentrant = threading.Thread(target=reenter, daemon=True)
+            reentrant.start()
+            reentrant.join(timeout=5)
+            assert not reentrant.is_alive()
+        finally:
+            release.set()
+            holder.join()
+
+
+def entry_point_names(group, backend='pkg_resources'):
+    if backend == 'pkg_resources':
+        eps = pkg_resources.iter_entry_points(group)
+    else:
+        eps = metadata_entry_points(group)
+    return sorted(ep.name for ep in eps)
+
+
+@requires_contextvars
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_context_local_entrypoints_are_isolated_between_tasks(backend):
+    shared = dynamic_entrypoint('test-group', ep_1, context_local=True,
+                                backend=backend)
+
+    async def task(name, entrypoint, started):
+        with shared, dynamic_entrypoint('test-group', name=name,
+                                        entrypoint=entrypoint,
+                                        context_local=True, backend=backend):
+            await started.wait()
+            return entry_point_names('test-group', backend)
+
+    async def main():
+        # Before Python 3.10, an Event is bound to the loop current when it's
+        # created
+        started = asyncio.Event()
+        tasks = [asyncio.ensure_future(task('a', ep_2, started)),
+                 asyncio.ensure_future(task('b', ep_3, started))]
+        await asyncio.sleep(0)
+        assert entry_point_names('test-group', backend) == ['global']
+        started.set()
+        return await asyncio.gather(*tasks)
+
+    with dynamic_entrypoint('test-group', name='global', entrypoint=ep_1,
+                            backend=backend):
+        results = asyncio.run(main())
+
+    assert results == [['a', 'ep_1', 'global'], ['b', 'ep_1', 'global']]
+    assert entry_point_names('test-group', backend) == []
+
+
+@requires_contextvars
+def test_context_local_entrypoints_are_isolated_between_threads():
+    dep = dynamic_entrypoint('test-group', ep_1, context_local=True)
+    seen = []
+
+    with dep:
+        thread = threading.Thread(
+            target=lambda: seen.append(entry_point_names('test-group')))
+        thread.start()
+        thread.join()
+        assert entry_point_names('test-group') == ['ep_1']
+
+        # Contexts copied from ours see our entry points
+        assert contextvars.copy_context().run(
+            entry_point_names, 'test-group') == ['ep_1']
+
+    assert seen == [[]]
+
+
+@requires_contextvars
+def test_context_local_entrypoints_are_bound_to_their_dist():
+    dep = dynamic_entrypoint('test-group', ep_1, context_local=True)
+    with dep:
+        ep, = pkg_resources.iter_entry_points('test-group')
+        assert ep.dist.key == 'prybar.scope.default'
+        assert ep.load() is ep_1
+        # The template entrypoint is never attached to a dist
+        assert ep is not dep.entrypoint
+        assert dep.entrypoint.dist is None
+
+
+@requires_contextvars
+def test_context_local_entrypoints_via_start_stop():
+    dep = dynamic_entrypoint('test-group', ep_1, context_local=True)
+
+    def start_and_check():
+        dep.start()
+        assert entry_point_names('test-group') == ['ep_1']
+        with pytest.raises(RuntimeError):
+            with dep:
+                pass
+        dep.stop()
+        assert entry_point_names('test-group') == []
+
+    dep.start()
+    try:
+        # Started independently in an unrelated context
+        contextvars.Context().run(start_and_check)
+        assert entry_point_names('test-group') == ['ep_1']
+    finally:
+        dep.stop()
+    assert entry_point_names('test-group') == []
+
+
+@requires_contextvars
+def test_context_local_registration_can_be_stopped_from_copied_context():
+    dep = dynamic_entrypoint('test-group', ep_1, context_local=True)
+    dep.start()
+    context = contextvars.copy_context()
+    assert context.run(entry_point_names, 'test-group') == ['ep_1']
+
+    # Copies share the activation, so stopping it in the copy ends it
+    context.run(dep.stop)
+    assert context.run(entry_point_names, 'test-group') == []
+    assert entry_point_names('test-group') == []
+
+    # Stopping it here cleans up the original context
+    dep.stop()
+    assert prybar._context_entrypoints.get() == {}
+
+
+@requires_contextvars
+def test_context_local_names_must_not_conflict_with_visible_entrypoints():
+    with dynamic_entrypoint('test-group', ep_1):
+        with pytest.raises(ValueError):
+            with dynamic_entrypoint('test-group', ep_1, context_local=True):
+                pytest.fail('must not enter')
+
+    with dynamic_entrypoint('test-group', ep_1, context_local=True):
+        with pytest.raises(ValueError):
+            with dynamic_entrypoint('test-group', ep_1):
+                pytest.fail('must not enter')
+
+        # Other contexts don't see the context-local entrypoint
+        def register_globally():
+            with dynamic_entrypoint('test-group', ep_1):
+                pass
+        contextvars.Context().run(register_globally)
+
+
+@requires_contextvars
+def test_async_with():
+    async def main():
+        dep = dynamic_entrypoint('test-group', ep_1)
+        async with dep:
+            await asyncio.sleep(0)
+            assert entry_point_names('test-group') == ['ep_1']
+            async with dep:
+                assert entry_point_names('test-group') == ['ep_1']
+        assert entry_point_names('test-group') == []
+
+    asyncio.run(main())
+
+
+@requires_contextvars
+def test_decorated_coroutine_function_keeps_entrypoint_while_running():
+    @dynamic_entrypoint('test-group', ep_1)
+    async def func(*args, **kwargs):
+        await asyncio.sleep(0)
+        return args, kwargs, entry_point_names('test-group')
+
+    async def main():
+        coro = func(1, b=2)
+        # Creating the coroutine doesn't activate the entrypoint
+        assert entry_point_names('test-group') == []
+        return await coro
+
+    assert asyncio.run(main()) == ((1,), {'b': 2}, ['ep_1'])
+    assert entry_point_names('test-group') == []
+
+
+@requires_contextvars
+def test_decorated_coroutine_function_maintains_raised_exceptions():
+    @dynamic_entrypoint('test-group', ep_1)
+    async def func():
+        await asyncio.sleep(0)
+        raise ValueError('foo')
+
+    with pytest.raises(ValueError) as excinfo:
+        asyncio.run(func())
+    assert str(excinfo.value) == 'foo'
+    assert entry_point_names('test-group') == []
+
+
+@requires_contextvars
+def test_decorated_async_generator_keeps_entrypoint_while_iterating():
+    @dynamic_entrypoint('test-group', ep_1)
+    async def agen(n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield i, entry_point_names('test-group')
+
+    async def main():
+        return [item async for item in agen(2)]
+
+    assert asyncio.run(main()) == [(0, ['ep_1']), (1, ['ep_1'])]
+    assert entry_point_names('test-group') == []
+
+
+@requires_contextvars
+def test_decorated_async_generator_supports_asend_athrow_and_aclose():
+    closed = []
+
+    @dynamic_entrypoint('test-group', ep_1)
+    async def agen():
+        try:
+            received = yield 'first'
+            try:
+                yield received
+            except KeyError as e:
+                yield f'caught {e}'
+            yield 'last'
+        finally:
+            closed.append(entry_point_names('test-group'))
+
+    async def main():
+        gen = agen()
+        assert await gen.__anext__() == 'first'
+        assert await gen.asend('sent') == 'sent'
+        assert await gen.athrow(KeyError('x')) == "caught 'x'"
+        assert entry_point_names('test-group') == ['ep_1']
+        await gen.aclose()
+        assert entry_point_names('test-group') == []
+
+    asyncio.run(main())
+    assert closed == [['ep_1']]
+
+
+def test_position_places_dynamic_distributions_first():
+    entries = list(pkg_resources.working_set.entries)
+    with dynamic_entrypoint('test-group', ep_1, position=0):
+        assert pkg_resources.working_set.entries[0] == prybar.__file__
+        assert pkg_resources.working_set.entries[1:] == entries
+        dist = next(iter(pkg_resources.working_set))
+        assert dist.location == prybar.__file__
+        assert next(pkg_resources.iter_entry_points('test-group')).load() \
+            is ep_1
+    assert pkg_resources.working_set.entries == entries
+
+
+def test_position_is_shared_by_all_dynamic_distributions():
+    with dynamic_entrypoint('test-group', ep_1, scope='a', position=0):
+        with dynamic_entrypoint('test-group', ep_2, scope='b', position=2):
+            assert pkg_resources.working_set.entries.index(
+                prybar.__file__) == 0
+            assert entry_point_names('test-group') == ['ep_1', 'ep_2']
+
+
+@requires_metadata
+def test_metadata_backend_position_places_working_set_in_meta_path():
+    meta_path = list(sys.meta_path)
+    with dynamic_entrypoint('test-group', ep_1, backend='importlib.metadata',
+                            position=0):
+        assert sys.meta_path == [prybar.metadata_working_set, *meta_path]
+    assert sys.meta_path == meta_path
+
+
+def test_scope_keys_are_indexed_and_cleaned_up():
+    ws = pkg_resources.working_set
+    with dynamic_entrypoint('test-group', ep_1, scope='a'), \
+            dynamic_entrypoint('test-group', ep_2, scope='B_c'):
+        keys = ws.entry_keys[prybar.__file__]
+        assert list(keys) == ['a', 'b-c']
+        assert 'a' in keys and len(keys) == 2
+        # setuptools 62.3 added normalized_to_canonical_keys
+        canonical_keys = getattr(ws, 'normalized_to_canonical_keys', None)
+        if canonical_keys is not None:
+            assert canonical_keys['b-c'] == 'b-c'
+    assert prybar.__file__ not in ws.entry_keys
+    if canonical_keys is not None:
+        assert 'b-c' not in canonical_keys
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_get_group_is_cached_until_entrypoints_change(backend):
+    assert prybar.get_group('test-group', backend=backend) == ()
+    with dynamic_entrypoint('test-group', ep_1, backend=backend):
+        eps = prybar.get_group('test-group', backend=backend)
+        assert [ep.name for ep in eps] == ['ep_1']
+        assert prybar.get_group('test-group', backend=backend) is eps
+
+        with dynamic_entrypoint('test-group', ep_2, backend=backend):
+            assert sorted(ep.name for ep in prybar.get_group(
+                'test-group', backend=backend)) == ['ep_1', 'ep_2']
+        assert prybar.get_group('test-group', backend=backend) == eps
+    assert prybar.get_group('test-group', backend=backend) == ()
+
+
+def test_entrypoint_changes_increment_generation():
+    generation = prybar._generation
+    with dynamic_entrypoints([('test-group', ep_1), ('test-group', ep_2)]):
+        assert prybar._generation == generation + 1
+    assert prybar._generation == generation + 2
+
+
+def test_get_group_cache_notices_dists_added_to_working_set():
+    working_set = pkg_resources.WorkingSet([])
+    assert prybar.get_group('test-group', working_set=working_set) == ()
+    dist = pkg_resources.Distribution(project_name='other', location='x')
+    dist._ep_map = {'test-group': {
+        'other': pkg_resources.EntryPoint.parse('other = os', dist=dist)}}
+    working_set.add(dist)
+    assert [ep.name for ep in prybar.get_group(
+        'test-group', working_set=working_set)] == ['other']
+
+
+def test_iter_entry_points():
+    with dynamic_entrypoints([('test-group', ep_1), ('test-group', ep_2)]):
+        assert [ep.name for ep in prybar.iter_entry_points('test-group')] \
+            == ['ep_1', 'ep_2']
+        assert [ep.load() for ep in prybar.iter_entry_points(
+            'test-group', 'ep_2')] == [ep_2]
+        assert list(prybar.iter_entry_points('test-group', 'ep_3')) == []
+
+
+@requires_contextvars
+def test_get_group_includes_context_local_entrypoints():
+    with dynamic_entrypoint('test-group', ep_1):
+        assert len(prybar.get_group('test-group')) == 1
+        with dynamic_entrypoint('test-group', ep_2, context_local=True):
+            assert len(prybar.get_group('test-group')) == 2
+            assert len(contextvars.Context().run(
+                prybar.get_group, 'test-group')) == 1
+        assert len(prybar.get_group('test-group')) == 1
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_subscribe_receives_added_and_removed_events(backend):
+    events = []
+    unsubscribe = prybar.subscribe('test-group', events.append)
+    try:
+        batch = dynamic_entrypoints(
+            [('test-group', ep_1), ('other-group', ep_2)], scope='a',
+            backend=backend)
+        with batch:
+            assert [(e.kind, e.group, e.entrypoint.name, e.scope)
+                    for e in events] == [('added', 'test-group', 'ep_1', 'a')]
+            assert events[0].entrypoint is batch.entrypoints[0][1]
+            assert events[0].working_set is batch.working_set
+        assert [e.kind for e in events] == ['added', 'removed']
+    finally:
+        unsubscribe()
+
+    with dynamic_entrypoint('test-group', ep_1, backend=backend):
+        pass
+    assert len(events) == 2
+
+
+def test_subscribe_to_all_groups():
+    events = []
+    unsubscribe = prybar.subscribe(None, events.append)
+    try:
+        with dynamic_entrypoints([('test-group', ep_1),
+                                  ('other-group', ep_2)]):
+            pass
+    finally:
+        unsubscribe()
+    assert [(e.kind, e.group) for e in events] == [
+        ('added', 'test-group'), ('added', 'other-group'),
+        ('removed', 'test-group'), ('removed', 'other-group')]
+
+
+def test_subscribers_can_use_the_working_set_and_errors_are_logged(caplog):
+    seen = []
+
+    def callback(event):
+        seen.append([ep.name for ep in
+                     pkg_resources.iter_entry_points('test-group')])
+        raise RuntimeError('callback failed')
+
+    unsubscribe = prybar.subscribe('test-group', callback)
+    try:
+        with dynamic_entrypoint('test-group', ep_1):
+            pass
+    finally:
+        unsubscribe()
+    assert seen == [['ep_1'], []]
+    assert 'callback failed' in caplog.text
+
+
+def test_subscribers_can_use_the_registration_that_changed():
+    registration = dynamic_entrypoint('test-group', ep_1)
+    seen = []
+
+    def callback(event):
+        seen.append((event.kind, [active.registration
+                                  for active in prybar.active()]))
+        if event.kind == 'added':
+            registration.swap('test_prybar:ep_2')
+        elif event.kind == 'replaced':
+            registration.stop()
+
+    unsubscribe = prybar.subscribe('test-group', callback)
+    # Run in a thread so that a deadlock fails the test rather than hanging
+    thread = threading.Thread(target=registration.start, daemon=True)
+    try:
+        thread.start()
+        thread.join(5)
+    finally:
+        unsubscribe()
+    assert not thread.is_alive()
+    assert seen == [('added', [registration]), ('replaced', [registration]),
+                    ('removed', [])]
+
+
+@requires_contextvars
+def test_context_local_registrations_do_not_generate_events():
+    events = []
+    unsubscribe = prybar.subscribe(None, events.append)
+    try:
+        with dynamic_entrypoint('test-group', ep_1, context_local=True):
+            pass
+    finally:
+        unsubscribe()
+    assert events == []
+
+
+def test_load_is_memoised_while_registered(monkeypatch):
+    original, replacement = ep_1, ep_2
+    entrypoint = dynamic_entrypoint('test-group', ep_1)
+    with entrypoint:
+        ep = next(pkg_resources.iter_entry_points('test-group'))
+        assert ep.load() is original
+        monkeypatch.setattr(sys.modules[__name__], 'ep_1', replacement)
+        assert ep.load() is original
+    assert entrypoint.entrypoint._loaded is prybar._NOT_LOADED
+
+    monkeypatch.undo()
+    with entrypoint:
+        assert entrypoint.entrypoint.load() is original
+
+
+def test_load_is_not_memoised_for_entrypoint_objects():
+    entrypoint = pkg_resources.EntryPoint.parse('ep = test_prybar:ep_1')
+    with dynamic_entrypoint('test-group', entrypoint):
+        assert not hasattr(entrypoint, '_loaded')
+        assert entrypoint.load() is ep_1
+
+
+@pytest.mark.parametrize('require, require_calls', [(True, 1), (False, 0)])
+def test_load_require(monkeypatch, require, require_calls):
+    calls = []
+    ep = dynamic_entrypoint('test-group', ep_1, require=require)
+    with ep:
+        monkeypatch.setattr(type(ep.entrypoint), 'require',
+                            lambda self, *args: calls.append(args))
+        assert ep.entrypoint.load() is ep_1
+        assert ep.entrypoint.load() is ep_1
+    assert len(calls) == require_calls
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('obj', [
+    lambda: 1,
+    functools.partial(int, '2'),
+    SomeClass(),
+    'a string',
+])
+def test_objects_can_be_registered_directly(backend, obj):
+    with dynamic_entrypoint('test-group', name='obj', obj=obj,
+                            backend=backend):
+        ep, = (metadata_entry_points('test-group')
+               if backend == 'importlib.metadata'
+               else pkg_resources.iter_entry_points('test-group'))
+        assert ep.name == 'obj'
+        assert ep.load() is obj
+
+
+def test_object_entrypoints_do_not_import(monkeypatch):
+    def closure():
+        pass
+
+    with dynamic_entrypoint('test-group', name='closure', obj=closure):
+        ep = next(pkg_resources.iter_entry_points('test-group'))
+        monkeypatch.setattr('builtins.__import__', None)
+        assert ep.resolve() is closure
+
+
+def test_object_is_released_with_its_entrypoint():
+    registration = dynamic_entrypoint('test-group', name='obj', obj=object())
+    attrs = set(vars(prybar._objects))
+    assert len(attrs) >= 1
+    del registration
+    gc.collect()
+    assert len(vars(prybar._objects)) == len(attrs) - 1
+
+
+class TupleEntryPoint(collections.namedtuple('EntryPoint',
+                                             'name value group')):
+    """importlib.metadata.EntryPoint as it is before Python 3.11."""
+    __slots__ = ()
+
+
+@requires_metadata
+def test_tuple_metadata_entrypoint_objects_are_released_with_registration(
+        monkeypatch):
+    monkeypatch.setattr(importlib_metadata, 'EntryPoint', TupleEntryPoint)
+    registration = dynamic_entrypoint('test-group', name='obj', obj=object(),
+                                      backend='importlib.metadata')
+    assert isinstance(registration.entrypoint, TupleEntryPoint)
+    attrs = set(vars(prybar._objects))
+    registration.swap(obj=object())
+    assert len(vars(prybar._objects)) == len(attrs) + 1
+    del registration
+    gc.collect()
+    assert len(vars(prybar._objects)) == len(attrs) - 1
+
+
+@pytest.mark.parametrize('kwargs, msg', [
+    ({'name': 'obj', 'module': 'os'}, "can't specify entrypoint, module_name "
+                                      "or attribute alongside obj"),
+    ({'entrypoint': ep_1}, "can't specify entrypoint, module_name or "
+                           "attribute alongside obj"),
+    ({}, 'name must be specified with obj'),
+])
+def test_object_entrypoint_invalid_arguments(kwargs, msg):
+    with pytest.raises(TypeError) as excinfo:
+        dynamic_entrypoint('test-group', obj=object(), **kwargs)
+    assert msg in str(excinfo.value)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_entrypoint_strings_are_parsed_once(backend):
+    spec = 'cached = test_prybar:SomeClass.func [extra]'
+    first = dynamic_entrypoint('test-group', spec, backend=backend)
+    parse = (prybar._parse_entrypoint if backend == 'importlib.metadata'
+             else prybar._parse_pkg_resources_entrypoint)
+    hits = parse.cache_info().hits
+    second = dynamic_entrypoint('test-group', spec, backend=backend,
+                                scope='other')
+    assert parse.cache_info().hits == hits + 1
+    assert str(first.entrypoint) == str(second.entrypoint)
+    if backend == 'pkg_resources':
+        assert first.entrypoint is not second.entrypoint
+        assert second.entrypoint.extras == ('extra',)
+        with first:
+            with second:
+                pass
+
+
+def snapshot_working_set(working_set):
+    return (list(working_set.entries),
+            {k: list(v) for k, v in working_set.entry_keys.items()},
+            dict(working_set.by_key),
+            # setuptools 62.3 added normalized_to_canonical_keys
+            dict(getattr(working_set, 'normalized_to_canonical_keys', {})))
+
+
+def test_isolated_working_set_contains_base_distributions():
+    isolated = prybar.isolated_working_set()
+    assert list(isolated) == list(pkg_resources.working_set)
+    assert isolated.find(pkg_resources.Requirement.parse('pytest')) is \
+        pkg_resources.working_set.find(
+            pkg_resources.Requirement.parse('pytest'))
+
+
+def test_isolated_working_set_registrations_do_not_affect_base():
+    base = pkg_resources.working_set
+    before = snapshot_working_set(base)
+    isolated = prybar.isolated_working_set()
+
+    with dynamic_entrypoint('test-group', ep_1, working_set=isolated):
+        assert [ep.load() for ep in isolated.iter_entry_points(
+            'test-group')] == [ep_1]
+        assert list(base.iter_entry_points('test-group')) == []
+        assert snapshot_working_set(base) == before
+    assert list(isolated.iter_entry_points('test-group')) == []
+    assert snapshot_working_set(base) == before
+
+
+def test_isolated_working_set_copies_base_scopes_on_write():
+    base = pkg_resources.working_set
+    with dynamic_entrypoint('test-group', ep_1, scope='shared'):
+        isolated = prybar.isolated_working_set()
+        before = snapshot_working_set(base)
+        base_dist = base.by_key['shared']
+
+        with dynamic_entrypoint('test-group', ep_2, scope='shared',
+                                working_set=isolated):
+            assert sorted(ep.name for ep in isolated.iter_entry_points(
+                'test-group')) == ['ep_1', 'ep_2']
+            assert [ep.name for ep in base.iter_entry_points(
+                'test-group')] == ['ep_1']
+            assert isolated.by_key['shared'] is not base_dist
+            assert snapshot_working_set(base) == before
+        assert snapshot_working_set(base) == before
+
+
+def test_isolated_working_set_follows_base_scopes_removed_later():
+    base_a = dynamic_entrypoint('test-group', ep_1, scope='scope-a')
+    base_shared = dynamic_entrypoint('test-group', ep_2, scope='shared')
+    base_a.start()
+    base_shared.start()
+    try:
+        isolated = prybar.isolated_working_set()
+        with dynamic_entrypoint('test-group', ep_3, scope='scope-b',
+                                working_set=isolated), \
+                dynamic_entrypoint('test-group', name='obj', obj=object(),
+                                   scope='shared', working_set=isolated):
+            base_a.stop()
+            base_shared.stop()
+            assert sorted(ep.name for ep in isolated.iter_entry_points(
+                'test-group')) == ['ep_2', 'ep_3', 'obj']
+            base_a.start()
+            assert sorted(ep.name for ep in isolated.iter_entry_points(
+                'test-group')) == ['ep_1', 'ep_2', 'ep_3', 'obj']
+        # The copy of the shared scope keeps the entry points it was copied
+        # with
+        assert sorted(ep.name for ep in isolated.iter_entry_points(
+            'test-group')) == ['ep_1', 'ep_2']
+    finally:
+        base_a.stop()
+        base_shared.stop()
+    assert [ep.name for ep in isolated.iter_entry_points(
+        'test-group')] == ['ep_2']
+
+
+def test_isolated_working_sets_are_independent():
+    first = prybar.isolated_working_set()
+    second = prybar.isolated_working_set(first)
+    with dynamic_entrypoint('test-group', ep_1, working_set=first):
+        with dynamic_entrypoint('test-group', ep_2, working_set=second):
+            assert sorted(ep.name for ep in second.iter_entry_points(
+                'test-group')) == ['ep_1', 'ep_2']
+            assert [ep.name for ep in first.iter_entry_points(
+                'test-group')] == ['ep_1']
+        assert [ep.name for ep in second.iter_entry_points(
+            'test-group')] == ['ep_1']
+    assert list(first.iter_entry_points('test-group')) == []
+
+
+def installed_entry_point_group():
+    """Get a group which installed distributions have entry points in."""
+    for dist in pkg_resources.working_set:
+        if dist.location != prybar.__file__ and dist.get_entry_map():
+            return next(iter(dist.get_entry_map()))
+    pytest.skip('no installed distributions have entry points')
+
+
+def test_only_dynamic_hides_installed_entrypoints():
+    group = installed_entry_point_group()
+    installed = list(pkg_resources.iter_entry_points(group))
+    dists = list(pkg_resources.working_set)
+
+    with dynamic_entrypoint(group, ep_1):
+        with prybar.only_dynamic():
+            assert [ep.name for ep in pkg_resources.iter_entry_points(
+                group)] == ['ep_1']
+            assert all(dist.get_entry_map() == {} for dist in dists)
+        assert len(list(pkg_resources.iter_entry_points(group))) == \
+            len(installed) + 1
+
+    assert list(pkg_resources.iter_entry_points(group)) == installed
+    assert all('get_entry_map' not in vars(dist) for dist in dists)
+
+
+def test_only_dynamic_hides_selected_groups():
+    group = installed_entry_point_group()
+    installed = list(pkg_resources.iter_entry_points(group))
+    with prybar.only_dynamic(groups=['test-group']):
+        assert list(pkg_resources.iter_entry_points(group)) == installed
+    with prybar.only_dynamic(groups=[group]):
+        assert list(pkg_resources.iter_entry_points(group)) == []
+        assert all(group not in dist.get_entry_map()
+                   for dist in pkg_resources.working_set)
+
+
+def test_only_dynamic_restores_existing_overrides_and_nests():
+    group = installed_entry_point_group()
+    dist = next(iter(pkg_resources.iter_entry_points(group))).dist
+    override = dist.get_entry_map = lambda group=None: {}
+    try:
+        with prybar.only_dynamic(groups=['a']):
+            with prybar.only_dynamic(groups=['b']):
+                assert dist.get_entry_map is not override
+        assert dist.get_entry_map is override
+    finally:
+        del dist.get_entry_map
+
+
+def test_only_dynamic_in_isolated_working_set_leaves_base_visible():
+    group = installed_entry_point_group()
+    installed = list(pkg_resources.iter_entry_points(group))
+    isolated = prybar.isolated_working_set()
+
+    with dynamic_entrypoint(group, ep_1, working_set=isolated), \
+            prybar.only_dynamic(working_set=isolated):
+        assert [ep.name for ep in isolated.iter_entry_points(group)] == \
+            ['ep_1']
+        assert list(pkg_resources.iter_entry_points(group)) == installed
+
+    assert [str(ep) for ep in isolated.iter_entry_points(group)] == \
+        [str(ep) for ep in installed]
+    assert isolated.by_key.maps[0] == {}
+    assert all('get_entry_map' not in vars(dist)
+               for dist in pkg_resources.working_set)
+
+
+def test_only_dynamic_invalidates_get_group_cache():
+    group = installed_entry_point_group()
+    installed = prybar.get_group(group)
+    assert installed
+    with prybar.only_dynamic():
+        assert prybar.get_group(group) == ()
+    assert prybar.get_group(group) == installed
+
+
+def worker_entry_points(group):
+    return ([(ep.name, ep.load()) for ep in
+             pkg_resources.iter_entry_points(group)],
+            sorted((ep.name, ep.load()) for ep in
+                   metadata_entry_points(group)))
+
+
+@requires_metadata
+def test_snapshot_is_applied_in_spawned_workers():
+    registrations = [
+        dynamic_entrypoints([('test-group', ep_1),
+                             ('test-group', 'two = test_prybar:ep_2')],
+                            scope='a'),
+        dynamic_entrypoint('test-group', name='obj',
+                           obj=functools.partial(int, '3'), scope='b'),
+        dynamic_entrypoint('test-group', ep_3,
+                           backend='importlib.metadata'),
+    ]
+    for registration in registrations:
+        registration.start()
+    try:
+        snapshot = prybar.snapshot_registrations()
+        context = multiprocessing.get_context('spawn')
+        # ProcessPoolExecutor only takes an initializer from Python 3.7
+        with context.Pool(1, initializer=prybar.init_worker,
+                          initargs=(snapshot,)) as pool:
+            pkg_eps, metadata_eps = pool.apply(
+                worker_entry_points, ('test-group',))
+    finally:
+        for registration in registrations:
+            registration.stop()
+
+    assert [name for name, _ in pkg_eps] == ['ep_1', 'two', 'obj']
+    assert pkg_eps[:2] == [('ep_1', ep_1), ('two', ep_2)]
+    assert pkg_eps[2][1]() == 3
+    assert metadata_eps == [('ep_3', ep_3)]
+
+
+def test_snapshot_apply_skips_registered_entrypoints():
+    with dynamic_entrypoints([('test-group', ep_1)], scope='a'):
+        snapshot = prybar.snapshot_registrations()
+        assert snapshot.apply() == []
+    registrations = snapshot.apply()
+    try:
+        assert [ep.load() for ep in
+                pkg_resources.iter_entry_points('test-group')] == [ep_1]
+        assert pickle.loads(pickle.dumps(snapshot)).entrypoints == \
+            snapshot.entrypoints
+    finally:
+        for registration in registrations:
+            registration.stop()
+
+
+def test_snapshot_leaves_out_unpicklable_objects():
+    with dynamic_entrypoint('test-group', name='lambda', obj=lambda: 1), \
+            dynamic_entrypoint('test-group', ep_1, scope='a'):
+        with pytest.warns(RuntimeWarning, match="entry point 'lambda' in "
+                          "group 'test-group' .* can't be pickled"):
+            snapshot = prybar.snapshot_registrations()
+    assert [entry[3] for entry in snapshot.entrypoints] == ['ep_1']
+    assert pickle.loads(pickle.dumps(snapshot)).entrypoints == \
+        snapshot.entrypoints
+
+
+def read_dist_infos(path):
+    return {name: (open(os.path.join(path, name, 'entry_points.txt')).read())
+            for name in sorted(os.listdir(path))}
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_materialised_entrypoints_follow_registrations(backend):
+    with dynamic_entrypoint('test-group', ep_1, scope='a.b',
+                            backend=backend):
+        with prybar.materialise_entrypoints(backend=backend) as materialised:
+            path = materialised.path
+            assert read_dist_infos(path) == {
+                'a_b-0.dist-info': '[test-group]\nep_1 = test_prybar:ep_1\n\n'}
+
+            with dynamic_entrypoints([('test-group', ep_2),
+                                      ('other-group', ep_3)],
+                                     scope='a.b', backend=backend):
+                assert read_dist_infos(path) == {
+                    'a_b-0.dist-info': '[test-group]\n'
+                                       'ep_1 = test_prybar:ep_1\n'
+                                       'ep_2 = test_prybar:ep_2\n\n'
+                                       '[other-group]\n'
+                                       'ep_3 = test_prybar:ep_3\n\n'}
+                with dynamic_entrypoint('test-group', ep_3, scope='c',
+                                        backend=backend):
+                    assert sorted(read_dist_infos(path)) == [
+                        'a_b-0.dist-info', 'c-0.dist-info']
+                assert sorted(read_dist_infos(path)) == ['a_b-0.dist-info']
+        assert not os.path.exists(path)
+
+
+def test_materialised_entrypoints_write_each_scope_once_per_change(
+        monkeypatch):
+    writes = []
+    write = prybar.MaterialisedEntrypoints._write
+    monkeypatch.setattr(prybar.MaterialisedEntrypoints, '_write',
+                        staticmethod(lambda directory, filename, text: (
+                            writes.append(filename),
+                            write(directory, filename, text))))
+    batch = dynamic_entrypoints(
+        [('test-group', f'ep{i} = os:getcwd') for i in range(1000)] +
+        [('other-group', 'x = os:getcwd')], scope='a')
+    with prybar.materialise_entrypoints() as materialised:
+        with batch:
+            assert writes == ['METADATA', 'entry_points.txt']
+            text = read_dist_infos(materialised.path)['a-0.dist-info']
+            assert text.count(' = os:getcwd') == 1001
+        assert writes == ['METADATA', 'entry_points.txt']
+        assert read_dist_infos(materialised.path) == {}
+
+
+def test_materialised_entrypoints_are_visible_to_subprocesses(tmp_path):
+    materialised = prybar.materialise_entrypoints(directory=tmp_path)
+    try:
+        with dynamic_entrypoint('test_group', 'name = os.path:join'), \
+                dynamic_entrypoint('test_group', name='obj', obj=object(),
+                                   scope='objects'):
+            with open(tmp_path / 'prybar_scope_default-0.dist-info' /
+                      'METADATA') as f:
+                assert 'Name: prybar.scope.default\n' in f.read()
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 'import pkg_resources; print([str(ep) for ep in '
+                 'pkg_resources.iter_entry_points("test_group")])'],
+                env=materialised.env({'PATH': os.environ['PATH']}),
+                universal_newlines=True)
+            assert output.strip() == "['name = os.path:join']"
+        assert os.listdir(tmp_path) == []
+    finally:
+        materialised.close()
+    assert os.path.isdir(tmp_path)
+
+
+def test_materialised_entrypoints_env():
+    with prybar.materialise_entrypoints() as materialised:
+        assert materialised.env({})['PYTHONPATH'] == materialised.path
+        assert materialised.env({'PYTHONPATH': 'x'})['PYTHONPATH'] == \
+            materialised.path + os.pathsep + 'x'
+
+
+ENTRY_POINTS_TXT = '''\
+# A comment
+[test-group]
+ep_1 = test_prybar:ep_1
+two=test_prybar:ep_2
+
+; Another comment
+[other-group]
+ep_3 = test_prybar:ep_3 [extra]
+'''
+
+PYPROJECT_TOML = '''\
+[project]
+name = "example"
+scripts = {ep_1 = "test_prybar:ep_1"}
+
+[project.entry-points.test-group]
+two = "test_prybar:ep_2"
+
+[project.entry-points."other.group"]
+ep_3 = "test_prybar:ep_3"
+
+[tool.example]
+ignored = "x:y"
+'''
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_from_manifest_entry_points_txt(tmp_path, backend):
+    path = tmp_path / 'entry_points.txt'
+    path.write_text(ENTRY_POINTS_TXT)
+    with prybar.from_manifest(path, scope='manifest', backend=backend):
+        assert entry_point_names('test-group', backend) == ['ep_1', 'two']
+        assert entry_point_names('other-group', backend) == ['ep_3']
+
+
+def test_from_manifest_pyproject_toml(tmp_path):
+    path = tmp_path / 'pyproject.toml'
+    path.write_text(PYPROJECT_TOML)
+    registration = prybar.from_manifest(str(path))
+    assert [(group, ep.name) for group, ep in registration.entrypoints] == [
+        ('console_scripts', 'ep_1'), ('test-group', 'two'),
+        ('other.group', 'ep_3')]
+    with registration:
+        assert [ep.load() for ep in
+                pkg_resources.iter_entry_points('other.group')] == [ep_3]
+
+
+@pytest.mark.parametrize('content, format', [
+    (ENTRY_POINTS_TXT, None), (PYPROJECT_TOML, 'toml')])
+def test_from_manifest_file_objects(content, format):
+    for f in [io.StringIO(content), io.BytesIO(content.encode())]:
+        registration = prybar.from_manifest(f, format=format)
+        assert len(registration.entrypoints) == 3
+
+
+def test_from_manifest_streams_entry_points_txt():
+    class LineByLine(io.StringIO):
+        def read(self, *args):
+            raise AssertionError('the whole file was read')
+
+    registration = prybar.from_manifest(LineByLine(ENTRY_POINTS_TXT))
+    assert len(registration.entrypoints) == 3
+
+
+@pytest.mark.parametrize('content, msg', [
+    ('a = b:c\n', "<manifest>:1: entry point outside of a group section"),
+    ('[group\n', "<manifest>:1: invalid section header"),
+    ('[group]\n\nabc\n', "<manifest>:3: expected an entry point"),
+])
+def test_from_manifest_invalid_entry_points_txt(content, msg):
+    f = io.StringIO(content)
+    f.name = '<manifest>'
+    with pytest.raises(ValueError) as excinfo:
+        prybar.from_manifest(f)
+    assert msg in str(excinfo.value)
+
+
+def test_exported_index_contains_installed_and_dynamic_entrypoints(tmp_path):
+    group = installed_entry_point_group()
+    path = tmp_path / 'index.json'
+    with dynamic_entrypoints([(group, ep_1), ('test-group', ep_2)]), \
+            dynamic_entrypoint('test-group', name='obj', obj=object(),
+                               scope='objects'):
+        expected = [str(ep) for ep in pkg_resources.iter_entry_points(group)]
+        prybar.export_index(path)
+
+    working_set = prybar.load_index(path).to_working_set()
+    assert [str(ep) for ep in working_set.iter_entry_points(group)] == \
+        expected
+    assert [ep.load() for ep in working_set.iter_entry_points(
+        'test-group')] == [ep_2]
+    dist = working_set.by_key['prybar.scope.default']
+    assert dist.location == str(path)
+    assert dist.get_entry_map() == {
+        group: dist.get_entry_map(group), 'test-group': {
+            'ep_2': dist.get_entry_map('test-group')['ep_2']}}
+
+
+def test_load_index_parses_groups_on_demand(tmp_path):
+    path = tmp_path / 'index.json'
+    with dynamic_entrypoints([('test-group', ep_1), ('other-group', ep_2)]):
+        prybar.export_index(path)
+    dist = prybar.load_index(path).to_working_set().by_key[
+        'prybar.scope.default']
+    assert dist._ep_map == {}
+    assert list(dist.get_entry_map('test-group')) == ['ep_1']
+    assert list(dist._ep_map) == ['test-group']
+    assert dist.get_entry_map('missing') == {}
+
+
+def test_load_index_finds_entrypoints_in_pkg_resources_order(tmp_path):
+    group = installed_entry_point_group()
+    path = tmp_path / 'index.json'
+    with dynamic_entrypoints([(group, ep_1), ('test-group', ep_2)]):
+        expected = [(ep.name, ep.dist.project_name)
+                    for ep in pkg_resources.iter_entry_points(group)]
+        prybar.export_index(path)
+
+    index = prybar.load_index(path)
+    assert [(ep.name, ep.distribution)
+            for ep in index.iter_entry_points(group)] == expected
+    assert [ep.load() for ep in index.iter_entry_points('test-group')] == \
+        [ep_2]
+    assert list(index.iter_entry_points('test-group', 'missing')) == []
+    assert index.get_group('missing') == ()
+
+
+def test_load_index_does_not_import_pkg_resources(tmp_path):
+    path = tmp_path / 'index.json'
+    with dynamic_entrypoint('test-group', 'ep = os.path:join'):
+        prybar.export_index(path)
+    code = ('import sys, prybar; '
+            f'ep, = prybar.load_index({str(path)!r})'
+            '.iter_entry_points("test-group"); '
+            'import os.path; assert ep.load() is os.path.join; '
+            'print(sorted({"pkg_resources", "importlib.metadata"} '
+            '& set(sys.modules)))')
+    assert subprocess.check_output(
+        [sys.executable, '-c', code],
+        universal_newlines=True).strip() == '[]'
+
+
+def test_load_index_rejects_other_versions(tmp_path):
+    path = tmp_path / 'index.json'
+    path.write_text('{"version": 2, "distributions": []}')
+    with pytest.raises(ValueError) as excinfo:
+        prybar.load_index(path)
+    assert 'unsupported index version: 2, expected 1' in str(excinfo.value)
+
+
+@requires_metadata
+def test_collect_stats_counts_registration_reads_and_loads(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'colorsys', raising=False)
+    events = []
+    with prybar.collect_stats(events.append) as stats:
+        with dynamic_entrypoint('test-group', name='rgb_to_hsv',
+                                module='colorsys'):
+            for ep in pkg_resources.iter_entry_points('test-group'):
+                ep.load()
+                ep.load()
+        with dynamic_entrypoint('test-group', ep_1,
+                                backend='importlib.metadata'):
+            metadata_entry_points('test-group')
+
+    assert (stats.enters, stats.exits, stats.mutations) == (2, 2, 4)
+    assert stats.reads >= 2
+    assert stats.reads_by_group['test-group'] >= 1
+    assert None in stats.reads_by_group
+    assert stats.loads == 2
+    assert list(stats.imports) == ['colorsys']
+    assert stats.enter_time > 0
+    assert stats.load_time >= stats.imports['colorsys']
+    assert [e.kind for e in events if e.kind != 'read'] == [
+        'mutation', 'enter', 'import', 'load', 'load', 'mutation', 'exit',
+        'mutation', 'enter', 'mutation', 'exit']
+    assert stats.as_dict()['loads'] == 2
+
+    # Collection has stopped
+    with dynamic_entrypoint('test-group', ep_1):
+        pass
+    assert stats.enters == 2
+    stats.reset()
+    assert stats.as_dict() == {
+        'enters': 0, 'enter_time': 0.0, 'exits': 0, 'exit_time': 0.0,
+        'mutations': 0, 'mutation_time': 0.0, 'reads': 0,
+        'read_time': 0.0, 'reads_by_group': {}, 'loads': 0,
+        'load_time': 0.0, 'imports': {}}
+
+
+@requires_metadata
+def test_collect_stats_times_reading_metadata_entry_points(monkeypatch):
+    render_entry_points = prybar._render_entry_points
+
+    def slow_render_entry_points(entry_map):
+        time.sleep(0.01)
+        return render_entry_points(entry_map)
+
+    monkeypatch.setattr(prybar, '_render_entry_points',
+                        slow_render_entry_points)
+    with dynamic_entrypoint('test-group', ep_1, backend='importlib.metadata'):
+        dist, = prybar.metadata_working_set
+        with prybar.collect_stats() as stats:
+            assert dist.read_text('entry_points.txt').startswith(
+                '[test-group]')
+    assert stats.reads_by_group == {None: 1}
+    assert stats.read_time >= 0.01
+
+
+def test_collect_stats_counts_a_read_per_scope_searched():
+    registrations = [dynamic_entrypoint('test-group', ep_1, scope=f's{i}')
+                     for i in range(3)]
+    with contextlib.ExitStack() as stack:
+        for registration in registrations:
+            stack.enter_context(registration)
+        with prybar.collect_stats() as stats:
+            list(pkg_resources.iter_entry_points('test-group'))
+    assert stats.reads_by_group == {'test-group': 3}
+
+
+@requires_contextvars
+def test_collect_stats_times_context_local_registrations():
+    with prybar.collect_stats() as stats:
+        with dynamic_entrypoint('test-group', ep_1, context_local=True):
+            pass
+    assert (stats.enters, stats.exits, stats.mutations) == (1, 1, 0)
+
+
+def test_collect_stats_hook_errors_are_logged(caplog):
+    def hook(event):
+        raise RuntimeError('hook failed')
+
+    with prybar.collect_stats(hook) as stats:
+        with dynamic_entrypoint('test-group', ep_1):
+            pass
+    assert stats.enters == 1
+    assert 'hook failed' in caplog.text
+
+
+def test_trace_discovery_records_queries_and_callers():
+    original = (pkg_resources.iter_entry_points, pkg_resources.get_entry_map,
+                pkg_resources.get_entry_info)
+    dist = pkg_resources.get_distribution('pytest')
+
+    with dynamic_entrypoints([('test-group', ep_1), ('test-group', ep_2)]):
+        with prybar.trace_discovery() as trace:
+            first = next(pkg_resources.iter_entry_points('test-group'))
+            list(pkg_resources.working_set.iter_entry_points('test-group',
+                                                             'ep_2'))
+            pkg_resources.get_entry_map(dist, 'console_scripts')
+            pkg_resources.get_entry_info(dist, 'console_scripts', 'missing')
+            list(prybar.iter_entry_points('test-group'))
+            del first
+
+    assert (pkg_resources.iter_entry_points, pkg_resources.get_entry_map,
+            pkg_resources.get_entry_info) == original
+    assert 'iter_entry_points' not in vars(pkg_resources.working_set)
+
+    assert [(q.function, q.group, q.name, q.results)
+            for q in trace.queries] == [
+        ('iter_entry_points', 'test-group', None, 1),
+        ('iter_entry_points', 'test-group', 'ep_2', 1),
+        ('get_entry_map', 'console_scripts', None,
+         len(dist.get_entry_map('console_scripts'))),
+        ('get_entry_info', 'console_scripts', 'missing', 0),
+        ('iter_entry_points', 'test-group', None, 2)]
+    this_test = 'test_trace_discovery_records_queries_and_callers'
+    assert all(q.caller.startswith(f'{__file__}:') and
+               q.caller.endswith(f' in {this_test}') and q.seconds >= 0
+               for q in trace.queries)
+
+
+def test_trace_discovery_reports_top_callers():
+    working_set = pkg_resources.WorkingSet([])
+
+    def search_once():
+        list(working_set.iter_entry_points('test-group'))
+
+    def search_often():
+        for _ in range(5):
+            list(working_set.iter_entry_points('test-group'))
+
+    with prybar.trace_discovery(working_set) as trace:
+        search_once()
+        search_often()
+        # Only the given working set is traced
+        list(pkg_resources.iter_entry_points('test-group'))
+
+    assert 'iter_entry_points' not in vars(working_set)
+    assert len(trace.queries) == 6
+    callers = trace.top_callers(None)
+    assert sorted((caller.rsplit(' in ', 1)[1], count)
+                  for caller, count, _ in callers) == [
+        ('search_often', 5), ('search_once', 1)]
+    assert callers[0][2] >= callers[1][2]
+    assert trace.top_callers(1) == callers[:1]
+    report = trace.report().splitlines()
+    assert report[0].split() == ['seconds', 'queries', 'caller']
+    assert report[1].endswith(callers[0][0])
+
+
+def test_trace_discovery_rejects_other_working_sets():
+    with pytest.raises(TypeError):
+        with prybar.trace_discovery(prybar.metadata_working_set):
+            pass
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_preload_imports_target_modules_when_registered(backend, monkeypatch):
+    for module in ['colorsys', 'tabnanny']:
+        monkeypatch.delitem(sys.modules, module, raising=False)
+    batch = dynamic_entrypoints(
+        [('test-group', 'a = colorsys:rgb_to_hsv'),
+         ('test-group', 'b = tabnanny:check'),
+         ('test-group', 'c = os.path:join [extra]')],
+        backend=backend, preload=True)
+    assert batch.preload
+    assert 'colorsys' not in sys.modules
+    with batch:
+        assert 'colorsys' in sys.modules and 'tabnanny' in sys.modules
+
+
+@pytest.mark.parametrize('context_local', [
+    False, pytest.param(True, marks=requires_contextvars)])
+@pytest.mark.parametrize('spec, message', [
+    ('a = prybar_missing_module:f', "No module named 'prybar_missing_module'"),
+    ('a = os.path:missing', "has no attribute 'missing'"),
+])
+def test_preload_errors_prevent_registration(spec, message, context_local):
+    batch = dynamic_entrypoints(
+        [('test-group', ep_1), ('test-group', 'b = colorsys:rgb_to_hsv'),
+         ('test-group', spec)],
+        preload=True, context_local=context_local)
+    with pytest.raises(ImportError) as excinfo:
+        batch.start()
+    assert str(excinfo.value).startswith(
+        "failed to preload 'a' in group 'test-group': ")
+    assert message in str(excinfo.value)
+    assert list(pkg_resources.iter_entry_points('test-group')) == []
+
+    # Nothing was left registered
+    with dynamic_entrypoint('test-group', ep_1, preload=True):
+        assert [ep.name for ep in
+                pkg_resources.iter_entry_points('test-group')] == ['ep_1']
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_swap_replaces_an_active_entrypoint(backend):
+    events = []
+    registration = dynamic_entrypoint('test-group', ep_1, backend=backend)
+    old = registration.entrypoint
+    unsubscribe = prybar.subscribe('test-group', events.append)
+    try:
+        with registration:
+            assert prybar.get_group('test-group', backend=backend) == (old,)
+            assert registration.swap('test_prybar:ep_2') is old
+            new = registration.entrypoint
+            assert new is not old and new.name == 'ep_1'
+            assert prybar.get_group('test-group', backend=backend) == (new,)
+            assert new.load() is ep_2
+            if backend == 'pkg_resources':
+                assert new.dist is not None and old.dist is None
+            else:
+                assert [ep.value for ep in metadata_entry_points(
+                    'test-group')] == ['test_prybar:ep_2']
+    finally:
+        unsubscribe()
+    assert [(e.kind, e.entrypoint) for e in events] == [
+        ('added', old), ('replaced', new), ('removed', new)]
+    # The swapped entry point is used when re-registered
+    with registration:
+        assert prybar.get_group('test-group', backend=backend) == (new,)
+
+
+def test_swap_accepts_each_form_of_target():
+    registration = dynamic_entrypoint('test-group', ep_1)
+    registration.swap(ep_2)
+    assert str(registration.entrypoint) == 'ep_1 = test_prybar:ep_2'
+    registration.swap('ep_1 = os.path:join')
+    assert str(registration.entrypoint) == 'ep_1 = os.path:join'
+    registration.swap(pkg_resources.EntryPoint.parse('ep_1 = os:getcwd'))
+    assert str(registration.entrypoint) == 'ep_1 = os:getcwd'
+    target = object()
+    registration.swap(obj=target)
+    with registration:
+        assert registration.entrypoint.load() is target
+
+    with pytest.raises(ValueError) as excinfo:
+        registration.swap('other = os:getcwd')
+    assert "can't swap entry point 'ep_1' for one named 'other'" in str(
+        excinfo.value)
+
+
+def test_swap_is_never_missing_from_concurrent_lookups():
+    registration = dynamic_entrypoint('test-group', ep_1)
+    missing = []
+    stop = threading.Event()
+
+    def lookup():
+        while not stop.is_set():
+            if not list(pkg_resources.iter_entry_points('test-group')):
+                missing.append(True)
+
+    with registration:
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        try:
+            for i in range(200):
+                registration.swap(ep_2 if i % 2 else ep_1)
+        finally:
+            stop.set()
+            thread.join()
+    assert missing == []
+
+
+@requires_contextvars
+def test_swap_validates_with_preload_and_rejects_active_context_local():
+    registration = dynamic_entrypoint('test-group', ep_1, preload=True)
+    with registration:
+        with pytest.raises(ImportError):
+            registration.swap('os:missing')
+        assert registration.entrypoint.load() is ep_1
+
+    local = dynamic_entrypoint('test-group', ep_1, context_local=True)
+    with local:
+        with pytest.raises(RuntimeError):
+            local.swap(ep_2)
+    local.swap(ep_2)
+    with local:
+        assert next(pkg_resources.iter_entry_points('test-group')).load() \
+            is ep_2
+
+
+@requires_contextvars
+def test_active_lists_registrations_and_where_they_were_activated():
+    single = dynamic_entrypoint('test-group', ep_1, scope='a')
+    batch = dynamic_entrypoints([('test-group', ep_2)], scope='b')
+    local = dynamic_entrypoint('other-group', ep_1, context_local=True)
+    assert prybar.active() == []
+
+    single.start()
+    try:
+        with batch, local, batch:
+            registrations = prybar.active()
+            line = sys._getframe().f_lineno - 2
+    finally:
+        single.stop()
+    assert prybar.active() == []
+
+    this_test = ('test_active_lists_registrations_and_where_they_were_'
+                 'activated')
+    assert [(r.registration, r.scope, r.working_set)
+            for r in registrations] == [
+        (single, 'a', pkg_resources.working_set),
+        (batch, 'b', pkg_resources.working_set)]
+    assert registrations[0].caller.endswith(f' in {this_test}')
+    assert registrations[1].caller == f'{__file__}:{line} in {this_test}'
+    assert str(registrations[0]) == (
+        f"test-group:ep_1 in scope 'a', registered at "
+        f"{registrations[0].caller}")
+
+
+def test_active_reports_the_caller_of_decorated_functions():
+    @dynamic_entrypoint('test-group', ep_1)
+    def decorated():
+        return prybar.active()[0].caller
+
+    assert decorated().endswith(
+        ' in test_active_reports_the_caller_of_decorated_functions')
+
+
+@requires_metadata
+def test_stop_all_stops_registrations_in_a_scope_or_all():
+    a = dynamic_entrypoint('test-group', ep_1, scope='scope-a')
+    b = dynamic_entrypoints([('test-group', ep_2)], scope='scope-b',
+                            backend='importlib.metadata')
+    a.start()
+    b.__enter__()
+
+    stopped = prybar.stop_all('Scope_A')
+    assert [r.registration for r in stopped] == [a]
+    assert [ep.name for ep in pkg_resources.iter_entry_points(
+        'test-group')] == []
+    assert [r.registration for r in prybar.active()] == [b]
+
+    assert [r.registration for r in prybar.stop_all()] == [b]
+    assert prybar.active() == [] and prybar.stop_all() == []
+    assert metadata_entry_points('test-group') == []
+
+    # The registrations can be used again
+    a.stop()
+    with pytest.raises(RuntimeError):
+        b.__exit__(None, None, None)
+    with a, b:
+        assert len(prybar.active()) == 2
+
+
+@requires_metadata
+def test_stop_all_matches_scopes_as_their_backend_does():
+    dotted = dynamic_entrypoint('test-group', ep_1, scope='a.b')
+    underscored = dynamic_entrypoint('test-group', ep_2, scope='a_b')
+    metadata = dynamic_entrypoint('test-group', ep_3, scope='a_b',
+                                  backend='importlib.metadata')
+    for registration in (dotted, underscored, metadata):
+        registration.start()
+    try:
+        # pkg_resources keeps a.b and a_b apart, importlib.metadata doesn't
+        assert [r.registration for r in prybar.stop_all('a.b')] == \
+            [dotted, metadata]
+        assert [r.registration for r in prybar.active()] == [underscored]
+    finally:
+        for registration in (dotted, underscored, metadata):
+            registration.stop()
+
+
+def test_detect_leaks_reports_and_stops_leaked_registrations():
+    already_active = dynamic_entrypoint('other-group', ep_2)
+    with already_active:
+        with pytest.raises(RuntimeError) as excinfo:
+            with prybar.detect_leaks():
+                with dynamic_entrypoint('test-group', ep_2, scope='ok'):
+                    pass
+                batch = dynamic_entrypoints(
+                    [('test-group', f'ep{i} = os:getcwd') for i in range(5)])
+                batch.start()
+                line = sys._getframe().f_lineno - 1
+        assert [r.registration for r in prybar.active()] == [already_active]
+
+    assert str(excinfo.value) == (
+        f"1 prybar registration was not stopped:\n"
+        f"  test-group:ep0, test-group:ep1, test-group:ep2 and 2 more in "
+        f"scope 'prybar.scope.default', registered at {__file__}:{line} in "
+        f"test_detect_leaks_reports_and_stops_leaked_registrations")
+
+
+def test_detect_leaks_without_stopping_and_with_errors():
+    leaked = dynamic_entrypoint('test-group', ep_1)
+    with pytest.raises(RuntimeError):
+        with prybar.detect_leaks(stop=False):
+            leaked.start()
+    assert [r.registration for r in prybar.active()] == [leaked]
+    leaked.stop()
+
+    with pytest.raises(KeyError):
+        with prybar.detect_leaks():
+            leaked.start()
+            raise KeyError()
+    assert prybar.active() == []
+
+
+@pytest.mark.parametrize('active', [False, True])
+def test_concurrent_swaps(active):
+    registration = dynamic_entrypoint('test-group', ep_1)
+    targets = [ep_1, ep_2]
+    barrier = threading.Barrier(4)
+    replaced = []
+
+    def swapper(i):
+        barrier.wait()
+        for j in range(200):
+            replaced.append(registration.swap(targets[(i + j) % 2]))
+
+    with contextlib.ExitStack() as stack:
+        if active:
+            stack.enter_context(registration)
+        # Switch threads often to make races likely
+        stack.callback(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        with ThreadPoolExecutor(4) as pool:
+            for future in [pool.submit(swapper, i) for i in range(4)]:
+                future.result()
+        current = registration.entrypoint
+        if active:
+            assert list(pkg_resources.iter_entry_points('test-group')) == [
+                current]
+            assert current.dist is not None
+
+    # Each swap replaced a different entry point
+    assert len({id(ep) for ep in replaced}) == len(replaced) == 800
+    assert current not in replaced and all(ep.dist is None for ep in replaced)